@@ -0,0 +1,92 @@
+"""The `nancy` command, which runs `--connect` without loading Nancy.
+
+Connecting to a server needs only a socket, so when `--connect` is given
+the arguments are sent to the server as they are, and the server parses
+them. Otherwise, or with `--serve`, Nancy itself is run.
+
+This is a top-level module rather than part of the `nancy` package,
+because importing any module of the package loads all of Nancy; the
+leading underscore marks it as private to Nancy.
+
+The protocol is described in `nancy.daemon`.
+
+© Reuben Thomas <rrt@sc3d.org> 2026.
+
+Released under the GPL version 3, or (at your option) any later version.
+"""
+
+import json
+import os
+import socket
+import sys
+from pathlib import Path
+from typing import BinaryIO
+
+
+def connect(
+    socket_path: Path, argv: list[str], stdout: BinaryIO, stderr: BinaryIO
+) -> int:
+    """Run Nancy in the server listening on `socket_path`.
+
+    Args:
+        socket_path (Path): the `Path` of the socket
+        argv (list[str]): the command-line arguments
+        stdout (BinaryIO): where to write the standard output
+        stderr (BinaryIO): where to write the standard error
+
+    Returns:
+        int: the exit status
+    """
+    with socket.socket(socket.AF_UNIX) as sock:
+        sock.connect(str(socket_path))
+        request = {"argv": argv, "cwd": os.getcwd(), "env": dict(os.environ)}
+        sock.sendall(json.dumps(request).encode("utf-8") + b"\n")
+        with sock.makefile("rb") as fh:
+            while True:
+                header = fh.read(5)
+                if len(header) < 5:
+                    raise ValueError("the server closed the connection")
+                channel, data = header[:1], fh.read(int.from_bytes(header[1:]))
+                if channel == b"x":
+                    return int.from_bytes(data, signed=True)
+                stream = stdout if channel == b"1" else stderr
+                stream.write(data)
+                stream.flush()
+
+
+def connect_socket(argv: list[str]) -> str | None:
+    """Find the socket given with `--connect` in `argv`, if any.
+
+    Returns `None` if `--serve` is also given, as that takes precedence.
+    """
+    socket_path = None
+    for i, arg in enumerate(argv):
+        if arg == "--":
+            break
+        if arg == "--serve" or arg.startswith("--serve="):
+            return None
+        if arg == "--connect" and i + 1 < len(argv):
+            socket_path = argv[i + 1]
+        elif arg.startswith("--connect="):
+            socket_path = arg.removeprefix("--connect=")
+    return socket_path
+
+
+def main(argv: list[str] = sys.argv[1:]) -> None:
+    socket_path = connect_socket(argv)
+    if socket_path is None:
+        from nancy import main as nancy_main
+
+        nancy_main(argv)
+    else:
+        try:
+            status = connect(
+                Path(socket_path), argv, sys.stdout.buffer, sys.stderr.buffer
+            )
+        except KeyboardInterrupt:
+            sys.exit(130)
+        except (OSError, ValueError) as e:
+            print(f"{os.path.basename(sys.argv[0])}: {e}", file=sys.stderr)
+            sys.exit(1)
+        if status != 0:
+            sys.exit(status)
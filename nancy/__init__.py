@@ -3,22 +3,61 @@
 
 import argparse
 import asyncio
+import atexit
+import functools
 import importlib.metadata
 import logging
+import multiprocessing
 import os
 import re
 import shutil
 import stat
 import sys
+import tempfile
+import threading
+import time
 import warnings
 from asyncio.subprocess import Process
-from collections.abc import Awaitable, Callable
-from dataclasses import dataclass
-from logging import debug
+from collections import OrderedDict, deque
+from collections.abc import (
+    AsyncIterable,
+    AsyncIterator,
+    Awaitable,
+    Callable,
+    Iterable,
+    Sequence,
+)
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from dataclasses import dataclass, field
+from enum import Enum
 from pathlib import Path
+from typing import IO
 
+from _nancy_client import connect
+
+from . import log
+from .daemon import serve
+from .database import DATABASE_NAME, Database, Dependency, Entry
+from .fileio import IO_THREADS, BatchedWriter, FileIO
+from .link import LinkMethod, link_file
+from .profiling import FileRecord, Profiler, RunRecord, current_record
 from .raw_version import RawVersionAction
+from .run_cache import RunCache
+from .server import Servers
+from .storage import (
+    LOCAL_STORE,
+    LocalOutput,
+    LocalStore,
+    ObjectKind,
+    OutputStore,
+    Store,
+    archive_format,
+    open_output,
+    open_store,
+    umask,
+)
 from .warnings_util import die, simple_warning
+from .watch import WATCH_INTERVAL, Changes, snapshot, watch_changes
 
 
 VERSION = importlib.metadata.version("nancy")
@@ -29,54 +68,76 @@ INPUT_REGEX = re.compile(r"\.in(?=\.[^.]+$|$)")
 
 MACRO_REGEX = re.compile(rb"(\\?)\$([^\W\d_]\w*)")
 
-umask = os.umask(0)
-os.umask(umask)
+# The text that matters when compiling macro arguments and inputs: macro
+# names, as for `MACRO_REGEX`; commas, with any backslashes before them;
+# and brackets.
+TOKEN_REGEX = re.compile(rb"(\\?)\$([^\W\d_]\w*)|(\\*),|[(){}]")
+
+BRACKET_REGEX = re.compile(rb"[(){}]")
+
+ESCAPED_COMMA_REGEX = re.compile(rb"(\\+),")
+
+CLOSING_BRACKETS = {ord(b"("): ord(b")"), ord(b"{"): ord(b"}")}
+
+# Default maximum total size of the file contents cached by a `Tree`.
+CONTENT_CACHE_SIZE = 64 * 1024 * 1024
+
+# Default maximum total estimated size of the compiled templates cached by
+# a `Tree`.
+TEMPLATE_CACHE_SIZE = 64 * 1024 * 1024
+
+# Estimated memory used by each segment of a compiled template, apart from
+# its text.
+TEMPLATE_SEGMENT_SIZE = 128
+
+# Size of the chunks in which data is passed to and from `$run` commands.
+PIPE_CHUNK_SIZE = 64 * 1024
+
+# Number of files that may be queued for processing for each worker.
+WORK_QUEUE_SIZE_PER_WORKER = 4
+
+# Number of batches into which files are divided for each worker process,
+# so that the work can be evened out between processes.
+BATCHES_PER_PROCESS = 8
+
+# Size above which the output of a `$run` command is kept in a temporary
+# file rather than in memory while the command is running.
+RUN_OUTPUT_SPILL_SIZE = 4 * 1024 * 1024
 
 
 def strip_final_newline(s: bytes) -> bytes:
     return re.sub(b"\n$", b"", s)
 
 
-def parse_arguments(
-    text: bytes, arg_start: int, initial_closing: int
-) -> tuple[list[bytes], int]:
-    """Parse macro arguments.
+# A piece of streamed output. Slices of large outputs are given as views, to
+# avoid copying them.
+type Chunk = bytes | memoryview
 
-    Parse macro arguments from `text[arg_start + 1:]` until the first
-    unpaired occurrence of `initial_closing`.
 
-    Args:
-        text (bytes): the string to parse
-        arg_start (int): the start position
-        initial_closing (int): the ASCII code of the closing bracket
+async def stream_strip_final_newline(
+    chunks: AsyncIterable[Chunk],
+) -> AsyncIterator[Chunk]:
+    """Yield `chunks`, stripped as by `strip_final_newline`.
 
-    Returns:
-        tuple[list[bytes], int]:
-        - list of arguments
-        - position within `text` of the character after closing delimiter
+    Newlines at the end of a chunk are held back until it is known whether
+    they are at the end of the output.
     """
-    args = []
-    closing = [initial_closing]  # Stack of expected close brackets
-    next_index = arg_start + 1
-    while next_index < len(text):
-        if text[next_index] == closing[-1]:
-            closing.pop()
-            if len(closing) == 0:
-                args.append(text[arg_start + 1 : next_index])
-                break
-        elif text[next_index] in {ord(b"("), ord(b"{")}:
-            closing.append(ord(b")") if text[next_index] == ord(b"(") else ord(b"}"))
-        elif (
-            len(closing) == 1
-            and text[next_index] == ord(b",")
-            and text[next_index - 1] != ord(b"\\")
-        ):
-            args.append(text[arg_start + 1 : next_index])
-            arg_start = next_index
-        next_index += 1
-    if next_index == len(text):
-        raise ValueError(f"missing {chr(closing[-1])}")
-    return args, next_index + 1
+    held = b""
+    async for chunk in chunks:
+        newlines = 0
+        while newlines < min(2, len(chunk)) and chunk[-1 - newlines] == ord(b"\n"):
+            newlines += 1
+        if newlines == len(chunk):
+            # Nothing but newlines, which may all be final.
+            held += chunk
+            if len(held) > 2:
+                yield held[:-2]
+                held = held[-2:]
+            continue
+        if held != b"":
+            yield held
+        yield chunk if newlines == 0 else memoryview(chunk)[:-newlines]
+        held = b"\n" * newlines
 
 
 def command_to_str(
@@ -90,14 +151,584 @@ def command_to_str(
     return b"$" + name + args_string + input_string
 
 
+@dataclass(frozen=True)
+class MacroCall:
+    """A macro invocation in a compiled template.
+
+    Fields:
+        name (bytes): the macro name
+        args (tuple[Template, ...] | None): the compiled arguments, if any
+        input (Template | None): the compiled input, if any
+    """
+
+    name: bytes
+    args: "tuple[Template, ...] | None"
+    input: "Template | None"
+
+
+# A compiled template is a sequence of literal text and macro calls.
+type Template = tuple[bytes | MacroCall, ...]
+
+
+def unescape_commas(text: bytes, level: int) -> bytes:
+    """Remove up to `level` backslashes before each comma in `text`."""
+    if level == 0:
+        return text
+    return ESCAPED_COMMA_REGEX.sub(
+        lambda m: m[1][: max(0, len(m[1]) - level)] + b",", text
+    )
+
+
+def match_brackets(text: bytes, pos: int, closing: int) -> int:
+    """Find the bracket that closes a macro's arguments or input.
+
+    Args:
+        text (bytes): the text to scan
+        pos (int): the position after the opening bracket
+        closing (int): the ASCII code of the closing bracket
+
+    Returns:
+        int: the position after the closing bracket
+    """
+    stack = [closing]  # Stack of expected close brackets
+    for res in BRACKET_REGEX.finditer(text, pos):
+        c = res[0][0]
+        if c == stack[-1]:
+            stack.pop()
+            if len(stack) == 0:
+                return res.end()
+        elif c in CLOSING_BRACKETS:
+            stack.append(CLOSING_BRACKETS[c])
+    raise ValueError(f"missing {chr(stack[-1])}")
+
+
+def merge_segments(segments: list[bytes | MacroCall]) -> Template:
+    """Merge adjacent text segments, and drop empty ones."""
+    template: list[bytes | MacroCall] = []
+    for s in segments:
+        if isinstance(s, bytes):
+            if s == b"":
+                continue
+            if len(template) > 0 and isinstance(template[-1], bytes):
+                template[-1] += s
+                continue
+        template.append(s)
+    return tuple(template)
+
+
+def scan_template(
+    text: bytes, pos: int, level: int, closing: int | None, separate: bool
+) -> tuple[list[Template], int]:
+    """Compile text up to the end of a macro's arguments or input.
+
+    The text is scanned once, jumping between macro names, commas and
+    brackets (only macro names outside macro calls), and nested macro calls
+    are compiled as they are found.
+
+    A comma in a macro's arguments or input is escaped by a backslash. Its
+    arguments and input are themselves unescaped, so each level of nesting
+    needs another backslash. A comma at nesting depth `level`, preceded by
+    `n` backslashes, is therefore an argument separator for a macro at
+    depth `level - 1` if `n < level`, and otherwise is literal text,
+    preceded by `n - level` backslashes.
+
+    Args:
+        text (bytes): the text to compile
+        pos (int): the position at which to start
+        level (int): the nesting depth of the text in macro arguments and
+            inputs
+        closing (int | None): the ASCII code of the bracket that ends the
+            text, or `None` to compile to the end of `text`
+        separate (bool): `True` if commas separate arguments
+
+    Returns:
+        tuple[list[Template], int]:
+        - the compiled arguments, or input
+        - the position after the closing bracket
+    """
+    parts: list[Template] = []
+    segments: list[bytes | MacroCall] = []
+    stack = [] if closing is None else [closing]  # Stack of expected closers
+    literal_start = pos
+    regex = MACRO_REGEX if closing is None else TOKEN_REGEX
+    while True:
+        res = regex.search(text, pos)
+        if res is None:
+            if closing is not None:
+                raise ValueError(f"missing {chr(stack[-1])}")
+            segments.append(text[literal_start:])
+            parts.append(merge_segments(segments))
+            return parts, len(text)
+        pos = res.end()
+        if res[2] is not None:
+            segments.append(text[literal_start : res.start()])
+            if res[1] != b"":
+                # Just remove the leading '\'
+                if pos < len(text) and text[pos] == ord(b"("):
+                    pos = match_brackets(text, pos + 1, ord(b")"))
+                if pos < len(text) and text[pos] == ord(b"{"):
+                    pos = match_brackets(text, pos + 1, ord(b"}"))
+                segments.append(unescape_commas(text[res.start() + 1 : pos], level))
+            else:
+                args = None
+                input = None
+                if pos < len(text) and text[pos] == ord(b"("):
+                    args, pos = scan_template(text, pos + 1, level + 1, ord(b")"), True)
+                if pos < len(text) and text[pos] == ord(b"{"):
+                    input_parts, pos = scan_template(
+                        text, pos + 1, level + 1, ord(b"}"), False
+                    )
+                    input = input_parts[0]
+                segments.append(
+                    MacroCall(res[2], None if args is None else tuple(args), input)
+                )
+            literal_start = pos
+        elif res[3] is not None:
+            segments.append(text[literal_start : res.start()])
+            backslashes = len(res[3])
+            if separate and len(stack) == 1 and backslashes < level:
+                parts.append(merge_segments(segments))
+                segments = []
+            else:
+                segments.append(res[3][: max(0, backslashes - level)] + b",")
+            literal_start = pos
+        elif closing is not None:
+            c = res[0][0]
+            if c == stack[-1]:
+                stack.pop()
+                if len(stack) == 0:
+                    segments.append(text[literal_start : res.start()])
+                    parts.append(merge_segments(segments))
+                    return parts, pos
+            elif c in CLOSING_BRACKETS:
+                stack.append(CLOSING_BRACKETS[c])
+
+
+def compile_template(text: bytes) -> Template:
+    """Compile `text` into a `Template`.
+
+    Arguments and inputs of macro calls are unescaped and compiled
+    recursively, so that expanding the result does not need to scan any
+    text. Escaped macro calls are compiled to literal text. The time taken
+    is linear in the length of `text`, however deeply macro calls are
+    nested.
+
+    Args:
+        text (bytes): the text to compile
+
+    Returns:
+        Template
+    """
+    return scan_template(text, 0, 0, None, False)[0][0]
+
+
+def template_size(template: Template) -> int:
+    """Estimate the memory used by `template`."""
+    size = 0
+    for segment in template:
+        size += TEMPLATE_SEGMENT_SIZE
+        if isinstance(segment, bytes):
+            size += len(segment)
+        else:
+            for arg in segment.args or ():
+                size += template_size(arg)
+            if segment.input is not None:
+                size += template_size(segment.input)
+    return size
+
+
+# The (mtime, size) of a file, used to decide whether cached data derived
+# from it is still valid.
+type Signature = tuple[int, int]
+
+
+def stat_signature(stats: os.stat_result) -> Signature:
+    return (stats.st_mtime_ns, stats.st_size)
+
+
+class SizedCache[T]:
+    """A cache of values derived from files, bounded by their total size.
+
+    Least-recently used entries are evicted first, and a value larger than
+    the whole cache is not stored. Entries are validated against the
+    file's `Signature` on every lookup. The cache may be shared between
+    threads.
+
+    Fields:
+        max_size (int): the maximum total size of the cached values
+        size (int): the current total size of the cached values
+    """
+
+    max_size: int
+    size: int
+    _entries: OrderedDict[Path, tuple[Signature, T, int]]
+    _lock: threading.Lock
+
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self.size = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __contains__(self, file_path: Path) -> bool:
+        with self._lock:
+            return file_path in self._entries
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._entries)
+
+    def get(self, file_path: Path, stats: os.stat_result) -> T | None:
+        """Return the cached value for `file_path`, if valid.
+
+        Args:
+            file_path (Path): the filesystem `Path` of the file
+            stats (os.stat_result): the current status of the file
+
+        Returns:
+            T | None
+        """
+        with self._lock:
+            entry = self._entries.get(file_path)
+            if entry is None:
+                return None
+            if entry[0] != stat_signature(stats):
+                self._remove(file_path)
+                return None
+            self._entries.move_to_end(file_path)
+            return entry[1]
+
+    def put(self, file_path: Path, stats: os.stat_result, value: T, size: int) -> None:
+        """Cache `value`, derived from `file_path` when its status was `stats`.
+
+        Args:
+            file_path (Path): the filesystem `Path` of the file
+            stats (os.stat_result): the status of the file
+            value (T): the value to cache
+            size (int): the size of `value`
+        """
+        if size <= self.max_size:
+            with self._lock:
+                # Another thread may have read the file meanwhile.
+                if file_path in self._entries:
+                    self._remove(file_path)
+                self._entries[file_path] = (stat_signature(stats), value, size)
+                self.size += size
+                while self.size > self.max_size:
+                    self._remove(next(iter(self._entries)))
+
+    def _remove(self, file_path: Path) -> None:
+        # Must be called with `_lock` held.
+        self.size -= self._entries.pop(file_path)[2]
+
+
+class ContentCache(SizedCache[bytes]):
+    """A cache of file contents, bounded by total size.
+
+    Fields:
+        hits (int): the number of reads satisfied from the cache
+        misses (int): the number of reads that went to the filesystem
+    """
+
+    hits: int
+    misses: int
+
+    def __init__(self, max_size: int = CONTENT_CACHE_SIZE):
+        super().__init__(max_size)
+        self.hits = 0
+        self.misses = 0
+
+    def read(self, file_path: Path, stats: os.stat_result | None = None) -> bytes:
+        """Read the contents of `file_path`, using the cache if possible.
+
+        Args:
+            file_path (Path): the filesystem `Path` of the file
+            stats (os.stat_result | None): the current status of the file,
+                if already known
+
+        Returns:
+            bytes
+        """
+        if stats is None:
+            stats = os.stat(file_path)
+        contents = self.lookup(file_path, stats)
+        if contents is None:
+            contents = file_path.read_bytes()
+            self.add(file_path, stats, contents)
+        return contents
+
+    def lookup(self, file_path: Path, stats: os.stat_result) -> bytes | None:
+        """Like `get`, but count a hit or a miss."""
+        contents = self.get(file_path, stats)
+        with self._lock:
+            if contents is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return contents
+
+    def add(self, file_path: Path, stats: os.stat_result, contents: bytes) -> None:
+        """Cache `contents`, read from `file_path` when its status was `stats`."""
+        self.put(file_path, stats, contents, len(contents))
+
+
+class ProcessScheduler:
+    """Limit the number of external commands running at once.
+
+    When a slot becomes free, it is given to each waiting owner in turn,
+    so that a file that runs many commands cannot hold up the others.
+
+    Fields:
+        max_procs (int | None): the maximum number of commands to run at
+            once, or `None` for no limit
+        running (int): the number of slots in use
+    """
+
+    max_procs: int | None
+    running: int
+    _waiting: OrderedDict[object, deque[asyncio.Future[None]]]
+
+    def __init__(self, max_procs: int | None = None):
+        self.max_procs = max_procs
+        self.running = 0
+        self._waiting = OrderedDict()
+
+    async def acquire(self, owner: object) -> None:
+        """Wait for a free slot.
+
+        Args:
+            owner (object): the owner of the command, used to share slots
+                fairly
+        """
+        if len(self._waiting) == 0 and (
+            self.max_procs is None or self.running < self.max_procs
+        ):
+            self.running += 1
+            return
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiting.setdefault(owner, deque()).append(waiter)
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                # We were given a slot, so pass it on.
+                self.release()
+            raise
+
+    def release(self) -> None:
+        """Free a slot, giving it to the next waiter, if any."""
+        while len(self._waiting) > 0:
+            owner, waiters = next(iter(self._waiting.items()))
+            waiter = waiters.popleft()
+            if len(waiters) == 0:
+                del self._waiting[owner]
+            else:
+                self._waiting.move_to_end(owner)
+            if not waiter.done():
+                waiter.set_result(None)
+                return
+        self.running -= 1
+
+
+class NameKind(Enum):
+    """How a file is processed, according to its name."""
+
+    COPY = 1
+    INPUT = 2
+    TEMPLATE = 3
+    PLAIN = 4
+
+
+def name_kind(name: str) -> NameKind:
+    """Classify a file name.
+
+    Args:
+        name (str): the name of the file
+
+    Returns:
+        NameKind
+    """
+    if re.search(COPY_REGEX, name):
+        return NameKind.COPY
+    if re.search(INPUT_REGEX, name):
+        return NameKind.INPUT
+    if re.search(TEMPLATE_REGEX, name):
+        return NameKind.TEMPLATE
+    return NameKind.PLAIN
+
+
+def directory_mtimes(inputs: Iterable[Store], dir: Path) -> tuple[int | None, ...]:
+    """Return the modification time of `dir` in each of `inputs`.
+
+    Args:
+        inputs (Iterable[Store]): the inputs
+        dir (Path): the input-relative `Path` of the directory
+
+    Returns:
+        tuple[int | None, ...]: the modification time in each input, or
+            `None` where it does not exist
+    """
+    mtimes = []
+    for input in inputs:
+        try:
+            mtimes.append(input.stat(input.root / dir).st_mtime_ns)
+        except (FileNotFoundError, NotADirectoryError):
+            mtimes.append(None)
+    return tuple(mtimes)
+
+
+class Caches:
+    """Caches that may be shared by successive `Tree`s with the same input.
+
+    Entries are validated before use, so a `Tree` may reuse the caches of
+    an earlier build even if the input has changed since.
+
+    Fields:
+        templates (SizedCache[Template]): as for `Tree`
+        contents (ContentCache): as for `Tree`
+        digests (dict[Path, tuple[Signature, str]]): as for `Tree`
+        index (dict[Path, dict[str, ObjectKind] | None]): as for `Tree`
+        index_mtimes (dict[Path, tuple[int | None, ...]]): as for `Tree`
+        index_roots (dict[Path, dict[str, tuple[Path, ...]]]): as for `Tree`
+        resolutions (dict[tuple[Path, Path], Path | None]): as for `Tree`
+        run_caches (dict[tuple[str | None, frozenset[str]], RunCache]): the
+            `RunCache` for each run cache directory and set of impure programs
+        servers (dict[frozenset[str], Servers]): the `Servers` for each set of
+            server programs
+    """
+
+    templates: SizedCache[Template]
+    contents: ContentCache
+    digests: dict[Path, tuple[Signature, str]]
+    index: dict[Path, dict[str, ObjectKind] | None]
+    index_mtimes: dict[Path, tuple[int | None, ...]]
+    index_roots: dict[Path, dict[str, tuple[Path, ...]]]
+    resolutions: dict[tuple[Path, Path], Path | None]
+    run_caches: dict[tuple[str | None, frozenset[str]], RunCache]
+    servers: dict[frozenset[str], Servers]
+
+    def __init__(self):
+        self.templates = SizedCache(TEMPLATE_CACHE_SIZE)
+        self.contents = ContentCache()
+        self.digests = {}
+        self.index = {}
+        self.index_mtimes = {}
+        self.index_roots = {}
+        self.resolutions = {}
+        self.run_caches = {}
+        self.servers = {}
+
+    def validate_index(self, inputs: Sequence[Store]) -> None:
+        """Forget directories in `index` that have changed.
+
+        When a directory has changed, its subdirectories are forgotten too,
+        as they may now be shadowed by, or merged from, different inputs.
+
+        Args:
+            inputs (Sequence[Store]): the inputs
+        """
+        changed = [
+            dir
+            for dir, mtimes in self.index_mtimes.items()
+            if directory_mtimes(inputs, dir) != mtimes
+        ]
+        if len(changed) > 0:
+            for dir in list(self.index):
+                if any(dir.is_relative_to(c) for c in changed):
+                    if log.walk.enabled:
+                        log.walk(f"Directory '{dir}' has changed")
+                    del self.index[dir]
+                    self.index_mtimes.pop(dir, None)
+                    self.index_roots.pop(dir, None)
+            # An entry for a non-directory lies below a directory whose
+            # change would have forgotten it, but resolutions may be affected.
+            self.resolutions.clear()
+
+    async def stop(self) -> None:
+        """Stop any servers."""
+        for servers in self.servers.values():
+            await servers.stop()
+
+
+async def feed_stdin(stdin: asyncio.StreamWriter, input: bytes) -> None:
+    """Write `input` to `stdin` as it is consumed, then close it."""
+    view = memoryview(input)
+    try:
+        for pos in range(0, len(view), PIPE_CHUNK_SIZE):
+            stdin.write(view[pos : pos + PIPE_CHUNK_SIZE])
+            await stdin.drain()
+    except (BrokenPipeError, ConnectionResetError):
+        pass  # The command exited without reading all its input.
+    finally:
+        stdin.close()
+
+
+async def collect_output(stream: asyncio.StreamReader, fh: IO[bytes]) -> None:
+    """Copy `stream` to `fh` until end of file."""
+    while chunk := await stream.read(PIPE_CHUNK_SIZE):
+        fh.write(chunk)
+
+
 @dataclass
 class Command:
+    """A running external command.
+
+    Fields:
+        command (str): a description of the command, for error messages
+        process (Process): the running process
+        input (bytes | None): the data to pass to `stdin`
+    """
+
     command: str
     process: Process
+    input: bytes | None = None
+
+    async def output(self, timeout: float | None = None) -> bytes:
+        """Wait for the command to finish, and return its output.
+
+        Input is fed to the command while its output is collected, so that
+        neither is buffered in full while the command runs. Large outputs
+        are kept in a temporary file until the command has finished, and
+        then read back in one piece, so the whole output is held in memory
+        only once, rather than both as chunks and joined.
+
+        Raises an error if the command fails, or does not finish within
+        `timeout` seconds.
+        """
+        assert self.process.stdout is not None
+        assert self.process.stderr is not None
+        with tempfile.SpooledTemporaryFile(RUN_OUTPUT_SPILL_SIZE) as stdout_file:
+            try:
+                async with asyncio.timeout(timeout):
+                    async with asyncio.TaskGroup() as tg:
+                        if self.input is not None:
+                            assert self.process.stdin is not None
+                            tg.create_task(feed_stdin(self.process.stdin, self.input))
+                        tg.create_task(collect_output(self.process.stdout, stdout_file))
+                        stderr_task = tg.create_task(self.process.stderr.read())
+                    await self.process.wait()
+            except TimeoutError:
+                raise ValueError(
+                    f"timed out after {timeout} seconds running: {self.command}"
+                ) from None
+            finally:
+                if self.process.returncode is None:
+                    self.process.kill()
+                    await self.process.wait()
+            if self.process.returncode != 0:
+                print(stderr_task.result().decode("iso-8859-1"), file=sys.stderr)
+                raise ValueError(
+                    f"Error code {self.process.returncode} running: {self.command}"
+                )
+            stdout_file.seek(0)
+            return stdout_file.read()
 
 
 async def filter_bytes(
-    input: bytes | None, exe_path: Path, exe_args: list[bytes]
+    input: bytes | None,
+    exe_path: Path,
+    exe_args: list[bytes],
+    env: dict[str, str] | None = None,
 ) -> Command:
     """Start an external command passing `input` on stdin.
 
@@ -105,33 +736,130 @@ async def filter_bytes(
         input (Optional[bytes]): passed to `stdin`
         exe_path (Path): `Path` of the command to run
         exe_args (list[bytes]): arguments to the command
+        env (dict[str, str] | None): the command's environment; if `None`,
+            Nancy's own
 
     Returns:
-        bytes: stdout of the command
+        Command: the running command
     """
-    debug(f"Running {exe_path} {b' '.join(exe_args)}")
+    if log.run.enabled:
+        log.run(f"Running {exe_path} {log.abbrev(b' '.join(exe_args))}")
     proc = await asyncio.create_subprocess_exec(
         exe_path.resolve(strict=True),
         *exe_args,
         stdout=asyncio.subprocess.PIPE,
         stdin=asyncio.subprocess.PIPE if input is not None else None,
         stderr=asyncio.subprocess.PIPE,
+        env=env,
     )
-    if input is not None:
-        assert proc.stdin is not None
-        proc.stdin.write(input)
+    return Command(command_description(exe_path, exe_args), proc, input)
+
+
+def command_description(exe_path: Path, exe_args: list[bytes]) -> str:
+    """Describe a command for error messages."""
     command = str(exe_path)
     if len(exe_args) > 0:
         command += f" {str(b' '.join(exe_args))}"
-    return Command(command, proc)
+    return command
+
+
+@dataclass(frozen=True)
+class WorkerConfig:
+    """The settings of a `Tree`, used to make one in a worker process.
+
+    Fields:
+        input (Path | Store | tuple[Path | Store, ...]): as for `Tree`;
+            directories are given as `Path`s
+        output (Path): as for `Tree`
+        process_hidden (bool): as for `Tree`
+        build (Path): as for `Tree`
+        update_newer (bool): as for `Tree`
+        hash_dependencies (bool): as for `Tree`
+        run_cache (tuple[Path | None, frozenset[str]] | None): the directory
+            and impure programs of the `Tree`'s `RunCache`, if any
+        max_procs (int | None): the maximum number of `$run` commands to
+            run at once in each worker
+        run_timeout (float | None): as for `Tree`
+        servers (frozenset[str] | None): the names of the `Tree`'s `Servers`,
+            if any
+        link (LinkMethod): as for `Tree`
+        io_threads (int): the number of threads for the `Tree`'s `FileIO`
+        profile (bool): `True` to profile the `Tree`
+    """
+
+    input: Path | Store | tuple[Path | Store, ...]
+    output: Path
+    process_hidden: bool
+    build: Path
+    update_newer: bool
+    hash_dependencies: bool
+    run_cache: tuple[Path | None, frozenset[str]] | None
+    max_procs: int | None
+    run_timeout: float | None
+    servers: frozenset[str] | None
+    link: LinkMethod = LinkMethod.COPY
+    io_threads: int = IO_THREADS
+    profile: bool = False
+
+
+@dataclass
+class WorkerResult:
+    """The result of processing a batch of files in a worker process.
+
+    Fields:
+        output_files (set[Path]): the files written
+        dependencies (dict[Path, set[Path]]): the dependencies of each file
+        entries (dict[Path, Entry]): the build database entry of each file
+        records (list[FileRecord]): the profile of each file, if profiled
+    """
+
+    output_files: set[Path]
+    dependencies: dict[Path, set[Path]]
+    entries: dict[Path, Entry]
+    records: list[FileRecord] = field(default_factory=list)
+
+
+@dataclass
+class ExpandResult:
+    """The result of expanding a template in memory.
+
+    Fields:
+        path (Path): the input-relative `Path` of the template
+        output_path (Path): the output-relative `Path` to which the output
+            would be written
+        output (bytes): the expanded template
+        inputs (set[Path]): the filesystem `Path`s of the files used
+    """
+
+    path: Path
+    output_path: Path
+    output: bytes
+    inputs: set[Path]
 
 
 class Tree:
     """The state that is constant for a whole invocation of Nancy.
 
+    The input tree is made by merging one or more input directories. Where
+    an input-relative `Path` exists in more than one of them, the leftmost
+    wins, except that directories are merged, until one of them is
+    shadowed by something that is not a directory.
+
+    An input directory may be held by any `Store`, such as an archive, and
+    the output may be written to any `OutputStore`; the files they hold
+    are named by `Path`s under their roots, as if they were in the
+    filesystem.
+
     Fields:
-        input (Path): the filesystem `Path` of the input directory
+        inputs (list[Path]): the filesystem `Path`s of the input directories,
+            in order of precedence; `Path`s outside the input tree are
+            relative to the first
+        stores (dict[Path, Store]): the `Store` of each input
+        local_input (bool): `True` if every input is a filesystem directory
         output (Path): the filesystem `Path` of the output directory
+        output_store (OutputStore): where the output is written; only an
+            output directory can be updated, or written by more than one
+            process or thread
         build (Path): the subtree of `input` to process. Defaults to the whole
             tree.
         process_hidden (bool): `True` to process hidden files (those whose
@@ -142,39 +870,148 @@ class Tree:
             files will only be updated if their macro arguments are newer than
             any current output file. Note this does not take into account macro
             invocations output by scripts.
+        hash_dependencies (bool): Used with `update_newer`; files will only be
+            updated if the contents of their dependencies have changed, as
+            recorded in `database`, regardless of modification times
         extant_files (dict[Path, os.stat_result]): the files in the output tree
             when we start (only set when `delete_ungenerated` is true)
         output_files (set[Path]): the files we write
+        templates (SizedCache[Template]): compiled input files, sized as
+            by `template_size`
+        contents (ContentCache): the contents of files read during expansion
+        index (dict[Path, dict[str, ObjectKind] | None]): the entries of each
+            input-relative directory that has been looked at, or `None` if
+            it is not a directory; filled in on demand
+        index_mtimes (dict[Path, tuple[int | None, ...]]): the modification
+            time of each directory in `index` in each input when it was
+            scanned, as returned by `directory_mtimes`
+        index_roots (dict[Path, dict[str, tuple[Path, ...]]]): for each
+            directory in `index`, when there is more than one input, the
+            inputs providing each entry: the winning input, or for a
+            directory the inputs merged into it
+        resolutions (dict[tuple[Path, Path], Path | None]): the result of
+            `Expand.find_on_path` for each (start path, file) pair, ignoring
+            the `$include` stack
+        database (Database | None): the dependencies of each file built,
+            stored in the output tree (only set when `update_newer` is true
+            and the output is a directory)
+        digests (dict[Path, tuple[Signature, str]]): the digest of each file
+            hashed, with the signature of the file when it was hashed
+        run_cache (RunCache | None): the outputs of `$run` commands, if they
+            are to be cached
+        scheduler (ProcessScheduler): limits the number of `$run` commands
+            running at once
+        run_timeout (float | None): the maximum time in seconds for which a
+            `$run` command may run
+        servers (Servers | None): the programs to run as servers, if any; the
+            caller must stop them
+        processes (int): the number of processes in which to process files;
+            if more than one, files are processed in worker processes
+        threads (int): the number of threads in which to process files; if
+            more than one, files are processed in worker threads, which share
+            `caches`
+        caches (Caches): the caches used by this `Tree`
+        link (LinkMethod): how to make output files that are copies of input
+            files
+        output_dirs (set[Path]): the output directories made by this build
+        io (FileIO): runs blocking file operations
+        profiler (Profiler | None): records the profile of the build, if any
+        dependencies (dict[Path, set[Path]]): the absolute `Path`s of the
+            files used to build each input-relative `Path`
+        dependents (dict[Path, set[Path]]): the input-relative `Path`s built
+            using each absolute `Path`; the inverse of `dependencies`
     """
 
-    input: Path
+    inputs: list[Path]
+    stores: dict[Path, Store]
+    local_input: bool
+    _store_roots: list[tuple[Path, Store]]
     output: Path
+    output_store: OutputStore
     build: Path
     process_hidden: bool
     delete_ungenerated: bool
     update_newer: bool
+    hash_dependencies: bool
     extant_files: dict[Path, os.stat_result]
     output_files: set[Path]
-    work_queue: asyncio.Queue[Awaitable]
+    templates: SizedCache[Template]
+    contents: ContentCache
+    index: dict[Path, dict[str, ObjectKind] | None]
+    index_mtimes: dict[Path, tuple[int | None, ...]]
+    index_roots: dict[Path, dict[str, tuple[Path, ...]]]
+    resolutions: dict[tuple[Path, Path], Path | None]
+    database: Database | None
+    digests: dict[Path, tuple[Signature, str]]
+    run_cache: RunCache | None
+    scheduler: ProcessScheduler
+    run_timeout: float | None
+    servers: Servers | None
+    processes: int
+    threads: int
+    caches: Caches
+    link: LinkMethod
+    output_dirs: set[Path]
+    io: FileIO
+    profiler: Profiler | None
+    dependencies: dict[Path, set[Path]]
+    dependents: dict[Path, set[Path]]
+    work_queue: asyncio.Queue[Callable[[], Awaitable]]
 
     def __init__(
         self,
-        input: Path,
-        output: Path,
+        input: Path | Store | Sequence[Path | Store],
+        output: Path | OutputStore,
         process_hidden: bool,
         build: Path | None = None,
         delete_ungenerated: bool = False,
         update_newer: bool = False,
+        hash_dependencies: bool = False,
+        run_cache: RunCache | None = None,
+        max_procs: int | None = None,
+        run_timeout: float | None = None,
+        servers: Servers | None = None,
+        caches: Caches | None = None,
+        processes: int = 1,
+        threads: int = 1,
+        link: LinkMethod = LinkMethod.COPY,
+        io_threads: int = IO_THREADS,
+        profiler: Profiler | None = None,
     ):
         self.delete_ungenerated = delete_ungenerated
         self.process_hidden = process_hidden
         self.update_newer = update_newer
-        if not input.exists():
-            raise ValueError(f"input '{input}' does not exist")
-        if not input.is_dir():
-            raise ValueError(f"input '{input}' is not a directory")
-        self.input = input
-        self.output = output
+        self.hash_dependencies = hash_dependencies
+        self.run_cache = run_cache
+        self.scheduler = ProcessScheduler(max_procs)
+        self.run_timeout = run_timeout
+        self.servers = servers
+        self.processes = processes
+        self.threads = threads
+        self.link = link
+        self.output_dirs = set()
+        self.io = FileIO(io_threads)
+        self.profiler = profiler
+        inputs = [input] if isinstance(input, Path | Store) else list(input)
+        if len(inputs) == 0:
+            raise ValueError("no input given")
+        self.stores = {}
+        for input in inputs:
+            store = open_store(input) if isinstance(input, Path) else input
+            self.stores[store.root] = store
+        self.inputs = list(self.stores)
+        self.local_input = all(
+            isinstance(store, LocalStore) for store in self.stores.values()
+        )
+        # Innermost first, as inputs may be nested.
+        self._store_roots = sorted(
+            (
+                (Path(os.path.abspath(root)), store)
+                for root, store in self.stores.items()
+            ),
+            key=lambda item: -len(item[0].parts),
+        )
+        self.output = output.root if isinstance(output, OutputStore) else output
         if build is None:
             build = Path()
         if build.is_absolute():
@@ -182,119 +1019,1013 @@ class Tree:
         self.build = build
         self.extant_files = {}
         self.output_files = set()
+        if caches is None:
+            caches = Caches()
+        caches.validate_index(list(self.stores.values()))
+        self.caches = caches
+        self.templates = caches.templates
+        self.contents = caches.contents
+        self.index = caches.index
+        self.index_mtimes = caches.index_mtimes
+        self.index_roots = caches.index_roots
+        self.resolutions = caches.resolutions
         self.work_queue = asyncio.Queue()
-        if delete_ungenerated or update_newer:
+        self.database = None
+        self.digests = caches.digests
+        self.dependencies = {}
+        self.dependents = {}
+        build_is_dir = self.object_kind(build) == ObjectKind.DIRECTORY
+        if isinstance(output, OutputStore):
+            if not (build_is_dir or isinstance(output, LocalOutput)):
+                raise ValueError("a single file can only be output to a file")
+            self.output_store = output
+        elif build_is_dir:
+            self.output_store = open_output(output)
+        else:
+            self.output_store = LocalOutput(output)
+        if not isinstance(self.output_store, LocalOutput):
+            if update_newer or delete_ungenerated:
+                raise ValueError("only an output directory can be updated")
+            if processes > 1 or threads > 1:
+                raise ValueError(
+                    "only an output directory can be written by multiple processes or threads"
+                )
+        if update_newer and build_is_dir:
+            self.database = Database(self.output / DATABASE_NAME)
+        if delete_ungenerated:
             self.find_existing_files()
 
-    def __del__(self):
-        if self.delete_ungenerated:
-            self.delete_ungenerated_files()
-            # Prevent the destructor running again
-            self.delete_ungenerated = False
+    def __del__(self):
+        if self.delete_ungenerated:
+            self.delete_ungenerated_files()
+            # Prevent the destructor running again
+            self.delete_ungenerated = False
+
+    async def run_program(
+        self,
+        owner: object,
+        name: bytes,
+        input: bytes | None,
+        exe_path: Path,
+        args: list[bytes],
+    ) -> bytes:
+        """Run a program when `scheduler` allows, and return its output.
+
+        If the program is one of `servers`, it is run as a server instead.
+        The program's environment has `NANCY_INPUT` set to `nancy_input()`. If the
+        file being processed is profiled, the time waited is recorded.
+
+        Args:
+            owner (object): the owner of the command, for `scheduler`
+            name (bytes): the program name given to `$run`
+            input (Optional[bytes]): passed to `stdin`
+            exe_path (Path): `Path` of the command to run
+            args (list[bytes]): arguments to the command
+
+        Returns:
+            bytes: stdout of the command
+        """
+        record = current_record()
+        if record is None:
+            return await self._run_program(owner, name, input, exe_path, args)
+        start = time.time()
+        try:
+            return await self._run_program(owner, name, input, exe_path, args)
+        finally:
+            record.runs.append(RunRecord(os.fsdecode(name), start, time.time()))
+
+    async def _run_program(
+        self,
+        owner: object,
+        name: bytes,
+        input: bytes | None,
+        exe_path: Path,
+        args: list[bytes],
+    ) -> bytes:
+        env = os.environ | {"NANCY_INPUT": self.nancy_input()}
+        if self.servers is not None and self.servers.wants(name, exe_path):
+            try:
+                result = await self.servers.run(
+                    exe_path, args, input, self.run_timeout, env
+                )
+            except TimeoutError:
+                raise ValueError(
+                    f"timed out after {self.run_timeout} seconds running: {command_description(exe_path, args)}"
+                ) from None
+            if result is not None:
+                status, output, error = result
+                if status != 0:
+                    print(error.decode("iso-8859-1"), file=sys.stderr)
+                    raise ValueError(
+                        f"Error code {status} running: {command_description(exe_path, args)}"
+                    )
+                return output
+        await self.scheduler.acquire(owner)
+        try:
+            command = await filter_bytes(input, exe_path, args, env)
+            return await command.output(self.run_timeout)
+        finally:
+            self.scheduler.release()
+
+    def nancy_input(self) -> str:
+        """Return the value of `NANCY_INPUT` for programs run by `$run`."""
+        return os.pathsep.join(str(input) for input in self.inputs)
+
+    def list_directory(self, dir: Path) -> dict[str, ObjectKind] | None:
+        """Return the entries of a directory in the input tree.
+
+        The directory is scanned in each input that provides it the first
+        time it is listed, and the result is kept in `index`, and the input
+        providing each entry in `index_roots`.
+
+        Args:
+            dir (Path): the normalized input-relative `Path` of the directory
+
+        Returns:
+            dict[str, ObjectKind] | None: the kind of each entry, or `None`
+                if `dir` is not a directory
+        """
+        if dir in self.index:
+            return self.index[dir]
+        entries = None
+        if dir == Path() or self.object_kind(dir) == ObjectKind.DIRECTORY:
+            if log.walk.enabled:
+                log.walk(f"Scanning directory '{dir}'")
+            self.index_mtimes[dir] = directory_mtimes(self.stores.values(), dir)
+            if len(self.inputs) == 1:
+                entries = self.stores[self.inputs[0]].scandir(self.inputs[0] / dir)
+            else:
+                entries, self.index_roots[dir] = self._merge_directory(dir)
+        self.index[dir] = entries
+        return entries
+
+    def _merge_directory(
+        self, dir: Path
+    ) -> tuple[dict[str, ObjectKind], dict[str, tuple[Path, ...]]]:
+        entries: dict[str, ObjectKind] = {}
+        roots: dict[str, tuple[Path, ...]] = {}
+        # Directories that are shadowed by a non-directory in a later input,
+        # so that no later inputs are merged into them.
+        shadowed: set[str] = set()
+        for root in self.object_roots(dir):
+            root_tuple = (root,)
+            for name, kind in self.stores[root].scandir(root / dir).items():
+                previous = entries.get(name)
+                if previous is None:
+                    entries[name] = kind
+                    roots[name] = root_tuple
+                elif previous == ObjectKind.DIRECTORY and name not in shadowed:
+                    if kind == ObjectKind.DIRECTORY:
+                        roots[name] += root_tuple
+                    else:
+                        shadowed.add(name)
+        return entries, roots
+
+    def input_store(self, file_path: Path) -> Store:
+        """Return the `Store` holding the filesystem `Path` `file_path`.
+
+        Files outside every input are in the filesystem.
+        """
+        if self.local_input:
+            return LOCAL_STORE
+        path = Path(os.path.abspath(file_path))
+        for root, store in self._store_roots:
+            if path.is_relative_to(root):
+                return store
+        return LOCAL_STORE
+
+    def local_path(self, file_path: Path) -> Path:
+        """Return a filesystem `Path` with the contents of `file_path`.
+
+        Files in inputs that are not directories are extracted.
+        """
+        return self.input_store(file_path).local_path(file_path)
+
+    def object_roots(self, obj: Path) -> tuple[Path, ...]:
+        """Find the inputs that provide `obj`.
+
+        Args:
+            obj (Path): the normalized input-relative `Path` to look up
+
+        Returns:
+            tuple[Path, ...]: the input whose `obj` wins, or, if `obj` is a
+                directory, the inputs merged into it; the first input if
+                `obj` is outside the input tree or does not exist
+        """
+        if obj == Path():
+            return tuple(self.inputs)
+        if (
+            len(self.inputs) > 1
+            and not obj.is_absolute()
+            and obj.parts[0] != ".."
+            and self.list_directory(obj.parent) is not None
+        ):
+            roots = self.index_roots[obj.parent].get(obj.name)
+            if roots is not None:
+                return roots
+        return (self.inputs[0],)
+
+    def input_path(self, obj: Path) -> Path:
+        """Return the filesystem `Path` of `obj` in the input that provides it.
+
+        Args:
+            obj (Path): the input-relative `Path`
+
+        Returns:
+            Path
+        """
+        if len(self.inputs) == 1:
+            return self.inputs[0] / obj
+        obj = Path(os.path.normpath(obj))
+        return self.object_roots(obj)[0] / obj
+
+    def object_kind(self, obj: Path) -> ObjectKind | None:
+        """Find the kind of `obj` in the input tree.
+
+        Args:
+            obj (Path): the input-relative `Path` to look up
+
+        Returns:
+            ObjectKind | None: `None` if `obj` does not exist
+        """
+        obj = Path(os.path.normpath(obj))
+        if obj == Path():
+            return ObjectKind.DIRECTORY
+        if obj.is_absolute() or obj.parts[0] == "..":
+            # Outside the input tree, so not indexed.
+            file_path = self.inputs[0] / obj
+            if file_path.is_dir():
+                return ObjectKind.DIRECTORY
+            if file_path.is_file():
+                return ObjectKind.FILE
+            return ObjectKind.OTHER if file_path.exists() else None
+        entries = self.list_directory(obj.parent)
+        return None if entries is None else entries.get(obj.name)
+
+    def object_exists(self, obj: Path) -> bool:
+        """Check if `obj` exists in the input tree."""
+        if log.resolve.enabled:
+            log.resolve(f"find_object {obj} {self.inputs}")
+        return self.object_kind(obj) is not None
+
+    async def read_file(
+        self, file_path: Path, stats: os.stat_result | None = None
+    ) -> bytes:
+        """Read the contents of `file_path`, using `contents` if possible.
+
+        Args:
+            file_path (Path): the filesystem `Path` of the file
+            stats (os.stat_result | None): the current status of the file,
+                if already known
+
+        Returns:
+            bytes
+        """
+        store = self.input_store(file_path)
+        if stats is None:
+            stats = await self.io.call(store.stat, file_path)
+        contents = self.contents.lookup(file_path, stats)
+        if contents is None:
+            contents = await self.io.call(store.read_bytes, file_path)
+            self.contents.add(file_path, stats, contents)
+        return contents
+
+    async def compile_file(self, file_path: Path) -> Template:
+        """Compile the file `file_path`.
+
+        A cached `Template` is reused if the file has not changed since it
+        was last compiled.
+
+        Args:
+            file_path (Path): the filesystem `Path` of the file
+
+        Returns:
+            Template
+        """
+        stats = await self.io.call(self.input_store(file_path).stat, file_path)
+        record = current_record()
+        if record is not None:
+            record.templates.add(str(file_path))
+            record.bytes_in += stats.st_size
+        template = self.templates.get(file_path, stats)
+        if template is not None:
+            if log.expand.enabled:
+                log.expand(f"Using cached template for '{file_path}'")
+            return template
+        template = compile_template(await self.read_file(file_path, stats))
+        self.templates.put(file_path, stats, template, template_size(template))
+        return template
+
+    def _check_output_newer(self, inputs: list[Path], output: Path) -> bool:
+        if not output.exists():
+            return False
+        output_mtime = output.stat().st_mtime
+        try:
+            return all(
+                self.input_store(i).stat(i).st_mtime <= output_mtime for i in inputs
+            )
+        except FileNotFoundError:
+            return False
+
+    async def digest_file(self, path: Path) -> tuple[Signature, str]:
+        """Compute the digest of a file, unless it is known.
+
+        Files are hashed by `io`, and each file is only hashed again
+        if its signature has changed.
+
+        Args:
+            path (Path): the `Path` of the file
+
+        Returns:
+            tuple[Signature, str]: the current signature and digest of the file
+        """
+        store = self.input_store(path)
+        signature = stat_signature(store.stat(path))
+        cached = self.digests.get(path)
+        if cached is not None and cached[0] == signature:
+            return cached
+        if log.io.enabled:
+            log.io(f"Hashing '{path}'")
+        digest = await self.io.call(store.digest, path)
+        self.digests[path] = (signature, digest)
+        return signature, digest
+
+    async def _check_dependencies_unchanged(self, entry: Entry, output: Path) -> bool:
+        # A file added where an input was searched for may be found instead.
+        if any(self.object_kind(path) == ObjectKind.FILE for path in entry.missing):
+            return False
+        if not self.hash_dependencies:
+            return await self.io.call(
+                self._check_output_newer, [d.path for d in entry.dependencies], output
+            )
+        if not output.exists():
+            return False
+        for d in entry.dependencies:
+            if d.signature is not None and d.digest is not None:
+                self.digests.setdefault(d.path, (d.signature, d.digest))
+        try:
+            digests = await asyncio.gather(
+                *(self.digest_file(d.path) for d in entry.dependencies)
+            )
+        except FileNotFoundError:
+            return False
+        if any(
+            d.digest != digest for d, (_, digest) in zip(entry.dependencies, digests)
+        ):
+            return False
+        # Remember the current signatures, to avoid hashing again.
+        entry.dependencies = [
+            Dependency(d.path, signature, digest)
+            for d, (signature, digest) in zip(entry.dependencies, digests)
+        ]
+        return True
+
+    def _index_dependencies(self, obj: Path, paths: set[Path]) -> None:
+        self._forget_dependencies(obj)
+        self.dependencies[obj] = paths
+        for path in paths:
+            self.dependents.setdefault(path, set()).add(obj)
+
+    def _forget_dependencies(self, obj: Path) -> None:
+        for path in self.dependencies.pop(obj, set()):
+            self.dependents[path].discard(obj)
+            if len(self.dependents[path]) == 0:
+                del self.dependents[path]
+
+    async def _record_dependencies(
+        self, obj: Path, output: Path, inputs: set[Path], searched: set[Path]
+    ) -> None:
+        paths = sorted(Path(os.path.abspath(i)) for i in inputs)
+        self._index_dependencies(obj, set(paths))
+        if self.database is None:
+            return
+        if self.hash_dependencies:
+            digests = await asyncio.gather(*(self.digest_file(p) for p in paths))
+            dependencies = [
+                Dependency(p, signature, digest)
+                for p, (signature, digest) in zip(paths, digests)
+            ]
+        else:
+            dependencies = [Dependency(p) for p in paths]
+        self.database.record(obj, Entry(output, dependencies, sorted(searched)))
+
+    async def process_file(self, obj: Path, only_newer: bool, kind: NameKind) -> None:
+        """Expand, copy or ignore a file.
+
+        Args:
+            obj (Path): the input-relative `Path`
+            only_newer (bool): `True` means only update the file if a
+                dependency is newer than any current output file.
+            kind (NameKind): the kind of the file's name
+        """
+        if kind == NameKind.INPUT:
+            return
+        if self.profiler is None:
+            await self._process_file(obj, only_newer, kind)
+        else:
+            with self.profiler.file(obj):
+                await self._process_file(obj, only_newer, kind)
+
+    async def _process_file(self, obj: Path, only_newer: bool, kind: NameKind) -> None:
+        if only_newer and self.database is not None:
+            entry = self.database.entries.get(obj)
+            if entry is not None:
+                output_file = self.output / entry.output
+                if log.build.enabled:
+                    log.build(
+                        f"Checking recorded inputs of '{obj}' against '{output_file}'"
+                    )
+                if await self._check_dependencies_unchanged(entry, output_file):
+                    log.build("Not updating")
+                    self.output_files.add(output_file)
+                    self.database.record(obj, entry)
+                    self._index_dependencies(obj, {d.path for d in entry.dependencies})
+                    return
+                # The file is known to be out of date.
+                only_newer = False
+            elif self.hash_dependencies:
+                # Without recorded digests, the file must be rebuilt.
+                only_newer = False
+        expand = Expand(RunMacros, self, obj)
+        inputs = await expand.set_output_path()
+        if log.build.enabled:
+            log.build(f"Processing file '{expand.input_file()}'")
+        record = current_record()
+        if record is not None:
+            record.output = str(expand.output_path())
+        self.output_files.add(expand.output_file())
+        if only_newer:
+            check_inputs: list[Path] = []
+            searched: set[Path] = set()
+            if kind == NameKind.TEMPLATE:
+                check_expand = Expand(Macros, self, obj)
+                await check_expand.set_output_path()
+                include_inputs: set[Path] = set()
+                async for _ in check_expand.stream_include(expand.path, include_inputs):
+                    pass
+                check_inputs += include_inputs
+                searched = check_expand.searched
+            else:
+                check_inputs.append(expand.input_file())
+            if log.build.enabled:
+                log.build(
+                    f"Checking inputs {check_inputs} against output {expand.output_file()}"
+                )
+            if await self.io.call(
+                self._check_output_newer, check_inputs, expand.output_file()
+            ):
+                log.build("Not updating")
+                await self._record_dependencies(
+                    obj,
+                    expand.output_path(),
+                    inputs | set(check_inputs),
+                    expand.searched | searched,
+                )
+                return
+            log.build("Updating")
+        await self.make_output_dir(expand.output_file().parent)
+        start = time.time()
+        if kind == NameKind.TEMPLATE:
+            if log.build.enabled:
+                log.build(f"Expanding '{obj}' to '{expand.output_file()}'")
+            output = expand.stream_include(expand.path, inputs)
+            if expand.tree.output == Path("-"):
+                await self.write_output(output, sys.stdout.buffer)
+            else:
+                fh = await self.io.call(expand.open_output_file)
+                try:
+                    await self.write_output(output, fh)
+                except BaseException:
+                    await self.io.call(
+                        self.output_store.discard, expand.output_file(), fh
+                    )
+                    raise
+                await self.io.call(self.output_store.commit, expand.output_file(), fh)
+        else:
+            await expand.copy_file()
+            inputs.add(expand.input_file())
+        if record is not None:
+            record.expansion = time.time() - start
+        await self._record_dependencies(
+            obj, expand.output_path(), inputs, expand.searched
+        )
+
+    async def write_output(self, output: AsyncIterable[Chunk], fh: IO[bytes]) -> None:
+        """Write `output` to `fh` in batches, using `io`."""
+        writer = BatchedWriter(self.io, fh)
+        record = current_record()
+        try:
+            async for chunk in output:
+                if record is not None:
+                    record.bytes_out += len(chunk)
+                await writer.write(chunk)
+            await writer.flush()
+        finally:
+            await writer.wait()
+
+    async def make_output_dir(self, dir: Path) -> None:
+        """Make an output directory, unless already made by this build."""
+        if dir not in self.output_dirs:
+            await self.io.call(self.output_store.makedirs, dir)
+            self.output_dirs.add(dir)
+
+    async def walk(self, obj: Path) -> AsyncIterator[tuple[Path, NameKind]]:
+        """Scan `obj`, and yield every file in it that is to be processed.
+
+        Directories are walked using `index`, and files are yielded as they
+        are found, together with the kind of their name. Output directories
+        are created as they are entered.
+
+        Args:
+            obj (Path): the `input`-relative `Path` to scan.
+        """
+        kind = self.object_kind(obj)
+        if kind is None:
+            raise ValueError(f"'{obj}' matches no path in the inputs")
+        if kind == ObjectKind.FILE:
+            yield obj, name_kind(obj.name)
+            return
+        if kind != ObjectKind.DIRECTORY:
+            raise ValueError(f"'{obj}' is not a file or directory")
+        if self.output == Path("-"):
+            raise ValueError("cannot output multiple files to stdout ('-')")
+        dirs = [obj]
+        while len(dirs) > 0:
+            dir = dirs.pop()
+            if re.search(INPUT_REGEX, dir.name):
+                continue
+            if log.walk.enabled:
+                log.walk(f"Entering directory '{dir}'")
+            expand = Expand(RunMacros, self, dir)
+            await expand.set_output_path()
+            await self.make_output_dir(expand.output_file())
+            entries = self.list_directory(Path(os.path.normpath(dir)))
+            assert entries is not None
+            for name, child_kind in entries.items():
+                if name[0] == "." and not self.process_hidden:
+                    continue
+                child = dir / name
+                if child_kind == ObjectKind.DIRECTORY:
+                    dirs.append(child)
+                elif child_kind == ObjectKind.FILE:
+                    child_name_kind = name_kind(name)
+                    if child_name_kind != NameKind.INPUT:
+                        yield child, child_name_kind
+                else:
+                    raise ValueError(f"'{child}' is not a file or directory")
+
+    async def walk_objects(
+        self, objs: set[Path]
+    ) -> AsyncIterator[tuple[Path, NameKind]]:
+        """Scan each of `objs` in turn with `walk`."""
+        for obj in sorted(objs):
+            async for file in self.walk(obj):
+                yield file
+
+    async def process_files(
+        self,
+        files: AsyncIterable[tuple[Path, NameKind]],
+        workers: int,
+        only_newer: bool,
+    ) -> None:
+        """Process files with parallel worker tasks.
+
+        Each file is queued for `process_file` in `work_queue` as it is
+        produced, and processed by `run_workers`.
+
+        Args:
+            files (AsyncIterable[tuple[Path, NameKind]]): the `input`-relative
+                `Path`s of the files, with the kinds of their names
+            workers (int): the number of tasks to use.
+            only_newer (bool): passed to `process_file`
+        """
+        self.work_queue = asyncio.Queue(WORK_QUEUE_SIZE_PER_WORKER * workers)
+
+        async def work() -> AsyncIterator[Callable[[], Awaitable]]:
+            async for file, kind in files:
+                yield functools.partial(self.process_file, file, only_newer, kind)
+
+        await run_workers(self.work_queue, work(), workers)
+
+    def worker_config(self) -> WorkerConfig:
+        """Describe this `Tree` for worker processes or threads."""
+        max_procs = self.scheduler.max_procs
+        if max_procs is not None:
+            max_procs = max(1, max_procs // max(self.processes, self.threads))
+        inputs = [
+            root if isinstance(store, LocalStore) else store
+            for root, store in self.stores.items()
+        ]
+        return WorkerConfig(
+            inputs[0] if len(inputs) == 1 else tuple(inputs),
+            self.output,
+            self.process_hidden,
+            self.build,
+            self.update_newer,
+            self.hash_dependencies,
+            None
+            if self.run_cache is None
+            else (self.run_cache.directory, frozenset(self.run_cache.impure)),
+            max_procs,
+            self.run_timeout,
+            None if self.servers is None else frozenset(self.servers.names),
+            self.link,
+            self.io.threads,
+            self.profiler is not None,
+        )
+
+    async def process_files_in_processes(
+        self,
+        files: AsyncIterable[tuple[Path, NameKind]],
+        workers: int,
+        only_newer: bool,
+    ) -> None:
+        """Process files in a pool of `processes` worker processes.
+
+        The files are divided into batches, which are handed out to the
+        worker processes as they become free. The results are merged into
+        this `Tree`.
+
+        Args:
+            files (AsyncIterable[tuple[Path, NameKind]]): as for
+                `process_files`
+            workers (int): the number of tasks to use in each process
+            only_newer (bool): passed to `process_file`
+        """
+        file_list = [file async for file in files]
+        batch_size = max(1, len(file_list) // (self.processes * BATCHES_PER_PROCESS))
+        config = self.worker_config()
+        loop = asyncio.get_running_loop()
+        with ProcessPoolExecutor(
+            self.processes, mp_context=multiprocessing.get_context("spawn")
+        ) as executor:
+            try:
+                results = await asyncio.gather(
+                    *(
+                        loop.run_in_executor(
+                            executor,
+                            process_files_in_worker,
+                            config,
+                            file_list[i : i + batch_size],
+                            workers,
+                            only_newer,
+                        )
+                        for i in range(0, len(file_list), batch_size)
+                    )
+                )
+            except BaseException:
+                executor.shutdown(cancel_futures=True)
+                raise
+        for result in results:
+            self.merge_result(result)
 
-    def object_exists(self, obj: Path) -> bool:
-        """Check if `obj` exists in the input tree."""
-        debug(f"find_object {obj} {self.input}")
-        return (self.input / obj).exists()
+    async def process_files_in_threads(
+        self,
+        files: AsyncIterable[tuple[Path, NameKind]],
+        workers: int,
+        only_newer: bool,
+    ) -> None:
+        """Process files in a pool of `threads` worker threads.
 
-    def _check_output_newer(self, inputs: list[Path], output: Path) -> bool:
-        if not output.exists():
-            return False
-        output_mtime = output.stat().st_mtime
-        return all(i.stat().st_mtime <= output_mtime for i in inputs)
+        Each thread runs its own event loop and `Tree`, sharing `caches`
+        with this one, and takes files one at a time from a common list.
+        The results are merged into this `Tree`.
 
-    async def process_file(self, obj: Path, only_newer: bool) -> None:
-        """Expand, copy or ignore a file.
+        Threads only run in parallel on free-threaded builds of Python.
 
         Args:
-            obj (Path): the `tree.input`-relative `Path`
-            only_newer (bool): `True` means only update the file if a
-                dependency is newer than any current output file.
+            files (AsyncIterable[tuple[Path, NameKind]]): as for
+                `process_files`
+            workers (int): the number of tasks to use in each thread
+            only_newer (bool): passed to `process_file`
         """
-        expand = Expand(RunMacros, self, obj)
-        await expand.set_output_path()
-        if not re.search(COPY_REGEX, obj.name) and re.search(INPUT_REGEX, obj.name):
-            return
-        debug(f"Processing file '{expand.input_file()}'")
-        self.output_files.add(expand.output_file())
-        if only_newer:
-            inputs: list[Path] = []
-            if re.search(COPY_REGEX, obj.name):
-                inputs.append(expand.input_file())
-            elif re.search(TEMPLATE_REGEX, obj.name):
-                check_expand = Expand(Macros, self, obj)
-                await check_expand.set_output_path()
-                _, include_inputs = await check_expand.include(expand.path)
-                inputs += include_inputs
-            else:
-                inputs.append(expand.input_file())
-            debug(f"Checking inputs {inputs} against output {expand.output_file()}")
-            if self._check_output_newer(inputs, expand.output_file()):
-                debug("Not updating")
-                return
-            debug("Updating")
-        os.makedirs(expand.output_file().parent, exist_ok=True)
-        if re.search(COPY_REGEX, obj.name):
-            expand.copy_file()
-        elif re.search(TEMPLATE_REGEX, obj.name):
-            debug(f"Expanding '{obj}' to '{expand.output_file()}'")
-            output, _ = await expand.include(expand.path)
-            if expand.tree.output == Path("-"):
-                sys.stdout.buffer.write(output)
-            else:
-                exe_perms = expand.get_new_execution_perms()
-                with open(expand.output_file(), "wb") as fh:
-                    fh.write(output)
-                expand.set_output_execution_perms(exe_perms)
-        else:
-            expand.copy_file()
+        pending = iter([file async for file in files])
+        lock = threading.Lock()
+        failed = threading.Event()
+
+        def take_file() -> tuple[Path, NameKind] | None:
+            with lock:
+                return None if failed.is_set() else next(pending, None)
+
+        config = self.worker_config()
+        trees = [worker_tree(config, self.caches) for _ in range(self.threads)]
+        loop = asyncio.get_running_loop()
+        with ThreadPoolExecutor(self.threads) as executor:
+            try:
+                results = await asyncio.gather(
+                    *(
+                        loop.run_in_executor(
+                            executor,
+                            process_files_in_thread,
+                            tree,
+                            take_file,
+                            workers,
+                            only_newer,
+                        )
+                        for tree in trees
+                    )
+                )
+            except BaseException:
+                failed.set()
+                raise
+        for result in results:
+            self.merge_result(result)
 
-    async def process_path(self, obj: Path) -> None:
-        """Recursively scan `obj` and pass every file to `process_file`.
+    def worker_result(self, objs: Iterable[Path]) -> WorkerResult:
+        """Collect the results of processing `objs` in a worker.
+
+        `output_files` and the record of files built in `database` are reset,
+        ready for the next batch.
+        """
+        result = WorkerResult(
+            self.output_files,
+            {obj: self.dependencies[obj] for obj in objs if obj in self.dependencies},
+            {}
+            if self.database is None
+            else {obj: self.database.entries[obj] for obj in self.database.recorded},
+            [] if self.profiler is None else self.profiler.take_records(),
+        )
+        self.output_files = set()
+        if self.database is not None:
+            self.database.recorded = set()
+        return result
+
+    def merge_result(self, result: WorkerResult) -> None:
+        """Merge the results of a worker into this `Tree`."""
+        self.output_files.update(result.output_files)
+        for obj, paths in result.dependencies.items():
+            self._index_dependencies(obj, paths)
+        if self.database is not None:
+            for obj, entry in result.entries.items():
+                self.database.record(obj, entry)
+        if self.profiler is not None:
+            self.profiler.records += result.records
+
+    async def process_objects(
+        self, objs: set[Path], workers: int, only_newer: bool
+    ) -> None:
+        """Process some input-relative `Path`s.
 
         Args:
-            obj (Path): the `input`-relative `Path` to scan.
+            objs (set[Path]): the `input`-relative `Path`s to process
+            workers (int): the number of tasks to use.
+            only_newer (bool): passed to `process_file`
         """
-        if not self.object_exists(obj):
-            raise ValueError(f"'{obj}' matches no path in the inputs")
-        if (self.input / obj).is_dir():
-            if self.output == Path("-"):
-                raise ValueError("cannot output multiple files to stdout ('-')")
-            if re.search(INPUT_REGEX, obj.name):
-                return
-            debug(f"Entering directory '{obj}'")
-            expand = Expand(RunMacros, self, obj)
-            await expand.set_output_path()
-            output_dir = expand.output_file()
-            os.makedirs(output_dir, exist_ok=True)
-            for child in os.listdir(self.input / obj):
-                if child[0] != "." or self.process_hidden:
-                    self.work_queue.put_nowait(self.process_path(obj / child))
-        elif (self.input / obj).is_file():
-            self.work_queue.put_nowait(self.process_file(obj, self.update_newer))
+        # Output directories may have been removed since the last build.
+        self.output_dirs = set()
+        if self.threads > 1 and self.output != Path("-"):
+            await self.process_files_in_threads(
+                self.walk_objects(objs), workers, only_newer
+            )
+        elif self.processes > 1 and self.output != Path("-"):
+            await self.process_files_in_processes(
+                self.walk_objects(objs), workers, only_newer
+            )
         else:
-            raise ValueError(f"'{obj}' is not a file or directory")
+            await self.process_files(self.walk_objects(objs), workers, only_newer)
+        if self.database is not None:
+            self.database.prune(self.build)
+            self.database.save()
+            self.output_files.add(self.database.path)
+        if self.run_cache is not None:
+            await self.io.call(self.run_cache.prune)
+        if log.build.enabled:
+            log.build(
+                f"Content cache: {self.contents.hits} hits, {self.contents.misses} misses"
+            )
+            if self.run_cache is not None:
+                log.build(
+                    f"Run cache: {self.run_cache.hits} hits, {self.run_cache.misses} misses"
+                )
 
     async def process(self, workers: int) -> None:
         """Process `self.build` with parallel worker tasks.
 
+        The output store is closed when processing finishes.
+
+        Args:
+            workers (int): the number of tasks to use.
+        """
+        try:
+            await self.process_objects({self.build}, workers, self.update_newer)
+        finally:
+            await self.io.call(self.output_store.close)
+
+    async def preload(self) -> None:
+        """Index the input tree, and compile its templates.
+
+        Nothing is written to the output. Expanding with a `Tree` fills its
+        caches in any case; preloading a `Tree` that is to be reused simply
+        makes its first expansions as fast as later ones.
+        """
+        dirs = [Path()]
+        while len(dirs) > 0:
+            dir = dirs.pop()
+            entries = self.list_directory(dir)
+            assert entries is not None
+            for name, kind in entries.items():
+                if name[0] == "." and not self.process_hidden:
+                    continue
+                if kind == ObjectKind.DIRECTORY:
+                    dirs.append(dir / name)
+                elif kind == ObjectKind.FILE and name_kind(name) == NameKind.TEMPLATE:
+                    await self.compile_file(self.input_path(dir / name))
+
+    async def expand_bytes(self, obj: Path, text: bytes) -> ExpandResult:
+        """Expand `text` as if it were the contents of the template `obj`.
+
+        `obj` need not exist. It gives the value of `$path`, and the
+        directory from which `$include` and `$paste` search for files.
+        Nothing is written to the output.
+
+        Args:
+            obj (Path): the input-relative `Path` of the template
+            text (bytes): the template
+
+        Returns:
+            ExpandResult
+        """
+        return await self._expand_in_memory(obj, text)
+
+    async def expand_path(self, obj: Path) -> ExpandResult:
+        """Expand the file `obj`, as `process` would, in memory.
+
+        Templates are expanded, other files are returned unchanged, and
+        input files, which `process` ignores, cannot be expanded. Nothing is
+        written to the output.
+
+        Args:
+            obj (Path): the input-relative `Path` of the file
+
+        Returns:
+            ExpandResult
+        """
+        kind = self.object_kind(obj)
+        if kind is None:
+            raise ValueError(f"'{obj}' matches no path in the inputs")
+        if kind != ObjectKind.FILE:
+            raise ValueError(f"'{obj}' is not a file")
+        if name_kind(obj.name) == NameKind.INPUT:
+            raise ValueError(f"'{obj}' is an input file")
+        return await self._expand_in_memory(obj, None)
+
+    async def expand_batch(
+        self, requests: Iterable[tuple[Path, bytes | None]], workers: int
+    ) -> list[ExpandResult]:
+        """Expand templates in memory with parallel worker tasks.
+
+        The expansions share this `Tree`'s caches. If any expansion fails,
+        the first error is raised.
+
         Args:
+            requests (Iterable[tuple[Path, bytes | None]]): the input-relative
+                `Path` of each template, with its text as for `expand_bytes`,
+                or `None` to expand the file as for `expand_path`
             workers (int): the number of tasks to use.
+
+        Returns:
+            list[ExpandResult]: the result of each request, in order
+        """
+        requests = list(requests)
+        results: dict[int, ExpandResult] = {}
+
+        async def expand(i: int) -> None:
+            obj, text = requests[i]
+            if text is None:
+                results[i] = await self.expand_path(obj)
+            else:
+                results[i] = await self.expand_bytes(obj, text)
+
+        async def work() -> AsyncIterator[Callable[[], Awaitable]]:
+            for i in range(len(requests)):
+                yield functools.partial(expand, i)
+
+        await run_workers(
+            asyncio.Queue(WORK_QUEUE_SIZE_PER_WORKER * workers), work(), workers
+        )
+        return [results[i] for i in range(len(requests))]
+
+    async def _expand_in_memory(self, obj: Path, text: bytes | None) -> ExpandResult:
+        if self.profiler is None:
+            return await self._expand_output(obj, text)
+        with self.profiler.file(obj):
+            return await self._expand_output(obj, text)
+
+    async def _expand_output(self, obj: Path, text: bytes | None) -> ExpandResult:
+        expand = Expand(RunMacros, self, obj)
+        inputs = await expand.set_output_path()
+        record = current_record()
+        if record is not None:
+            record.output = str(expand.output_path())
+        start = time.time()
+        if text is not None:
+            chunks = expand.stream_template(compile_template(text), inputs)
+            output = b"".join([chunk async for chunk in chunks])
+        elif name_kind(obj.name) == NameKind.TEMPLATE:
+            chunks = expand.stream_include(obj, inputs)
+            output = b"".join([chunk async for chunk in chunks])
+        else:
+            output = await self.read_file(expand.input_file())
+            inputs.add(expand.input_file())
+        if record is not None:
+            record.expansion += time.time() - start
+            record.bytes_out += len(output)
+        return ExpandResult(obj, expand.output_path(), output, inputs)
+
+    def affected_objects(self, changes: Changes) -> set[Path]:
+        """Find the input-relative `Path`s that must be rebuilt after `changes`.
+
+        A file must be rebuilt if one of its dependencies was modified or
+        removed. When files are added or removed, `$include` and friends may
+        find a different file, so files with a dependency of the same name
+        as an added file are rebuilt too, as are added files themselves, and
+        removed files, which another input may now provide.
+
+        Args:
+            changes (Changes): the changed files
+
+        Returns:
+            set[Path]: the input-relative `Path`s to rebuild; some may no
+                longer exist
         """
-        await self.process_path(self.build)
+        objs: set[Path] = set()
+        for path in changes.modified | changes.removed:
+            objs.update(self.dependents.get(path, set()))
+        if changes.added or changes.removed:
+            self.index.clear()
+            self.index_mtimes.clear()
+            self.index_roots.clear()
+            self.resolutions.clear()
+            names = {p.name for p in changes.added}
+            for obj, paths in self.dependencies.items():
+                if any(p.name in names for p in paths):
+                    objs.add(obj)
+        for input in self.inputs:
+            input = Path(os.path.abspath(input))
+            for path in changes.added:
+                if path.is_relative_to(input):
+                    obj = path.relative_to(input)
+                    if obj.is_relative_to(self.build) and self._is_processed(obj):
+                        objs.add(obj)
+            for path in changes.removed:
+                if path.is_relative_to(input):
+                    obj = path.relative_to(input)
+                    self._forget_dependencies(obj)
+                    if self.database is not None:
+                        self.database.entries.pop(obj, None)
+                    # Another input may provide the file instead.
+                    if obj.is_relative_to(self.build) and self._is_processed(obj):
+                        objs.add(obj)
+        return objs
+
+    def _is_processed(self, obj: Path) -> bool:
+        parts = obj.relative_to(self.build).parts
+        return all(self.process_hidden or p[0] != "." for p in parts) and not any(
+            re.search(INPUT_REGEX, p) for p in parts[:-1]
+        )
 
-        # Process the work queue
-        background_tasks = set()
+    async def watch(self, workers: int, interval: float = WATCH_INTERVAL) -> None:
+        """Process `self.build`, then reprocess files affected by changes.
+
+        Errors are reported as warnings, and the files being processed are
+        tried again after the next change. Runs until cancelled.
+
+        Args:
+            workers (int): the number of tasks to use.
+            interval (float): the time in seconds between checks for changes
+        """
+        if not self.local_input:
+            raise ValueError("only input directories can be watched")
+        if not isinstance(self.output_store, LocalOutput):
+            raise ValueError("only an output directory can be updated")
+        roots = [Path(os.path.abspath(input)) for input in self.inputs]
+        # Changes made during the first build must be noticed.
+        start = await asyncio.to_thread(snapshot, roots)
+        failed = await self._process_reporting_errors(
+            {self.build}, workers, self.update_newer
+        )
+        async for changes in watch_changes(
+            roots, start, self.dependents.keys, interval
+        ):
+            objs = {
+                obj
+                for obj in self.affected_objects(changes) | failed
+                if self.object_kind(obj) is not None
+            }
+            if log.build.enabled:
+                log.build(f"Rebuilding {objs}")
+            # The files are known to be out of date.
+            failed = await self._process_reporting_errors(objs, workers, False)
+
+    async def _process_reporting_errors(
+        self, objs: set[Path], workers: int, only_newer: bool
+    ) -> set[Path]:
         try:
-            async with asyncio.TaskGroup() as tg:
-                for i in range(workers):
-                    task = tg.create_task(worker(i, self.work_queue))
-                    background_tasks.add(task)
-                    task.add_done_callback(background_tasks.discard)
-                await self.work_queue.join()
-                self.work_queue.shutdown()
-        except BaseExceptionGroup as e:
-            raise e.exceptions[0]
+            await self.process_objects(objs, workers, only_newer)
+        except Exception as err:
+            warnings.warn(f"{err}")
+            return objs
+        return set()
 
     def find_existing_files(self) -> None:
         for dirpath, dirnames, filenames in os.walk(self.output):
@@ -308,7 +2039,8 @@ class Tree:
 
     def delete_ungenerated_files(self) -> None:
         for path in set(self.extant_files) - self.output_files:
-            debug(f"removed ungenerated file {path}")
+            if log.io.enabled:
+                log.io(f"removed ungenerated file {path}")
             os.remove(path)
 
         # Now remove empty directories
@@ -318,13 +2050,14 @@ class Tree:
             ):
                 try:
                     os.rmdir(dirpath)
-                    debug(f"removed empty directory {dirpath}")
+                    if log.io.enabled:
+                        log.io(f"removed empty directory {dirpath}")
                 except OSError:
                     pass  # The directory contained other (non-empty) directories.
 
 
 type Expansion = tuple[bytes, set[Path]]
-type CommandExpansion = tuple[Command | bytes, set[Path]]
+type CommandExpansion = tuple[asyncio.Future[bytes] | bytes, set[Path]]
 
 
 class Expand:
@@ -342,6 +2075,11 @@ class Expand:
     # `$include`d. This is used to avoid infinite loops.
     stack: list[Path]
 
+    # searched is the set of input-relative `Path`s looked at by
+    # `find_on_path` that were not files, shared by the `Expand`s of a
+    # file. It is only kept when there is a build database.
+    searched: set[Path]
+
     # The output file relative to `tree.output`.
     # `None` while the filename is being expanded.
     _output_path: Path | None
@@ -351,16 +2089,23 @@ class Expand:
         macrosClass: "type[Macros]",  # TODO: remove quotes with 3.14.
         tree: Tree,
         path: Path,
-        stack: list[Path] = [],
+        stack: list[Path] | None = None,
+        searched: set[Path] | None = None,
     ):
         self.tree = tree
         self.path = path
-        self.stack = stack
+        self.stack = [] if stack is None else stack
+        self.searched = set() if searched is None else searched
         self._output_path = None
         self._macros = macrosClass(self)
 
-    async def set_output_path(self):
-        """Recompute `_output_path` by expanding `path`."""
+    async def set_output_path(self) -> set[Path]:
+        """Recompute `_output_path` by expanding `path`.
+
+        Returns:
+            set[Path]: the inputs used to expand the file name
+        """
+        inputs = set()
         # Compute expanded filename
         if self.path.name != "":
             if re.search(COPY_REGEX, self.path.name):
@@ -369,8 +2114,7 @@ class Expand:
                 final_path = self.path.with_name(
                     re.sub(TEMPLATE_REGEX, "", self.path.name)
                 )
-            # Discard computed inputs when expanding filenames.
-            expanded_final_path, _ = await self.expand(bytes(final_path))
+            expanded_final_path, inputs = await self.expand(bytes(final_path))
             expanded_final_path = Path(os.fsdecode(expanded_final_path))
         else:
             expanded_final_path = Path("")
@@ -381,14 +2125,15 @@ class Expand:
         elif (
             self.tree.output.exists()
             and self.tree.output.is_dir()
-            and self.input_file().is_file()
+            and self.tree.object_kind(self.path) == ObjectKind.FILE
         ):
             output_path = Path(expanded_final_path.name)
         self._output_path = output_path
+        return inputs
 
     def input_file(self):
         """Returns the input `Path`."""
-        return self.tree.input / self.path
+        return self.tree.input_path(self.path)
 
     def output_path(self):
         """Returns the relative output `Path` for the current file.
@@ -422,15 +2167,57 @@ class Expand:
                 - not in `self.stack`
                 otherwise `None`.
         """
-        debug(f"Searching for '{file}' on {start_path}")
+        key = (start_path, file)
+        if key not in self.tree.resolutions:
+            self.tree.resolutions[key] = self.search_on_path(start_path, file, [])
+        obj = self.tree.resolutions[key]
+        if obj is not None and obj in self.stack:
+            # The nearest match is being included, so search past it.
+            obj = self.search_on_path(start_path, file, self.stack)
+        if self.tree.database is not None:
+            self.record_search(start_path, file, obj)
+        return obj
+
+    def record_search(self, start_path: Path, file: Path, found: Path | None) -> None:
+        """Add the places looked in for `file` before `found` to `searched`.
+
+        Args:
+            start_path (Path): input-relative `Path` searched up from
+            file (Path): the `Path` looked for
+            found (Path | None): the result of the search
+        """
+        for parent in (start_path / "_").parents:
+            obj = Path(os.path.normpath(parent / file))
+            if obj == found:
+                break
+            if self.tree.object_kind(obj) != ObjectKind.FILE:
+                self.searched.add(obj)
+
+    def search_on_path(
+        self, start_path: Path, file: Path, exclude: list[Path]
+    ) -> Path | None:
+        """Search for file starting at the given path, without caching.
+
+        Args:
+            start_path (Path): input-relative `Path` to search up from
+            file (Path): the `Path` to look for.
+            exclude (list[Path]): `Path`s to skip
+
+        Returns:
+            Optional[Path]: as for `find_on_path`, but excluding `exclude`
+                rather than `self.stack`.
+        """
+        if log.resolve.enabled:
+            log.resolve(f"Searching for '{file}' on {start_path}")
         for parent in (start_path / "_").parents:
             # Use os.path.normpath to remove .. segments
             obj = Path(os.path.normpath(parent / file))
-            debug(f"checking '{obj}'")
-            if self.tree.object_exists(obj):
-                if (self.tree.input / obj).is_file() and obj not in self.stack:
-                    debug(f"Found '{obj}'")
-                    return obj
+            if log.resolve.enabled:
+                log.resolve(f"checking '{obj}'")
+            if self.tree.object_kind(obj) == ObjectKind.FILE and obj not in exclude:
+                if log.resolve.enabled:
+                    log.resolve(f"Found '{obj}'")
+                return obj
         return None
 
     def file_arg(self, arg: bytes) -> Path:
@@ -460,38 +2247,42 @@ class Expand:
         filename = Path(os.fsdecode(arg))
         file_path = self.find_on_path(self.path.parent, filename)
         if file_path is not None:
-            return self.tree.input / file_path
+            return self.tree.input_path(file_path)
         exe_path_str = shutil.which(filename)
         if exe_path_str is not None:
             return Path(exe_path_str)
         raise ValueError(f"cannot find program '{filename}'")
 
-    async def expand_arg(self, arg: bytes) -> Expansion:
-        # Unescape escaped commas
-        debug(f"escaped arg {arg}")
-        unescaped_arg = re.sub(rb"\\,", b",", arg)
-        debug(f"unescaped arg {unescaped_arg}")
-        return await self.expand(unescaped_arg)
+    async def expand_arguments(
+        self, call: MacroCall
+    ) -> tuple[list[bytes] | None, bytes | None, set[Path]]:
+        """Expand the arguments and input of a macro call.
 
-    async def do_macro(
-        self,
-        name: bytes,
-        args: list[bytes] | None,
-        input: bytes | None,
-    ) -> CommandExpansion:
-        debug(f"do_macro {command_to_str(name, args, input)}")
-        name_str = name.decode("iso-8859-1")
+        Args:
+            call (MacroCall): the macro call
+
+        Returns:
+            tuple[list[bytes] | None, bytes | None, set[Path]]: the arguments,
+                the input, and the inputs used to expand them
+        """
         inputs = set()
-        if args is None:
-            args = None
-        else:
-            args_expansion = [await self.expand_arg(arg) for arg in args]
+        args = None
+        if call.args is not None:
+            args_expansion = [await self.expand_template(arg) for arg in call.args]
             args = [a[0] for a in args_expansion]
             for a in args_expansion:
                 inputs.update(a[1])
-        if input is not None:
-            input, input_inputs = await self.expand_arg(input)
+        input = None
+        if call.input is not None:
+            input, input_inputs = await self.expand_template(call.input)
             inputs.update(input_inputs)
+        return args, input, inputs
+
+    async def do_macro(self, call: MacroCall) -> CommandExpansion:
+        if log.expand.enabled:
+            log.expand(f"do_macro {log.abbrev(call)}")
+        name_str = call.name.decode("iso-8859-1")
+        args, input, inputs = await self.expand_arguments(call)
         macro: (
             Callable[[list[bytes] | None, bytes | None], Awaitable[CommandExpansion]]
             | None
@@ -512,83 +2303,90 @@ class Expand:
         Returns:
             Expansion
         """
-        debug(f"expand {text} {self.stack}")
+        if log.expand.enabled:
+            log.expand(f"expand {log.abbrev(text)} {self.stack}")
+        return await self.expand_template(compile_template(text))
 
-        startpos = 0
-        inputs = set()
-        expansions: list[tuple[int, int, bytes | Command]] = []
-        while True:
-            res = MACRO_REGEX.search(text, startpos)
-            if res is None:
-                break
-            debug(f"match: {res} {res.end()}")
-            escaped = res[1]
-            name = res[2]
-            startpos = res.end()
-            args = None
-            input = None
-            # Parse arguments
-            if startpos < len(text) and text[startpos] == ord(b"("):
-                args, startpos = parse_arguments(text, startpos, ord(")"))
-            # Parse input
-            if startpos < len(text) and text[startpos] == ord(b"{"):
-                input_args, startpos = parse_arguments(text, startpos, ord("}"))
-                input = b",".join(input_args)
-            if escaped != b"":
-                # Just remove the leading '\'
-                output = command_to_str(name, args, input)
+    async def expand_template(self, template: Template) -> Expansion:
+        """Expand a compiled template.
+
+        Args:
+            template (Template): the template to expand
+
+        Returns:
+            Expansion
+        """
+        inputs: set[Path] = set()
+        expanded = [chunk async for chunk in self.stream_template(template, inputs)]
+        if log.expand.enabled:
+            log.expand(f"expanded is now: {log.abbrev(expanded)}")
+            log.expand(f"expand found inputs {inputs}")
+        return b"".join(expanded), inputs
+
+    async def stream_template(
+        self, template: Template, inputs: set[Path]
+    ) -> AsyncIterator[Chunk]:
+        """Expand a compiled template, yielding the output as it is produced.
+
+        All macro calls are started, and the arguments of `$include` are
+        expanded, before any output is produced, so that commands run in
+        parallel even when separated by `$include`. The output of `$include`
+        is then streamed in its place rather than collected, so that only
+        the outputs of other macros are held in memory. `$include` is
+        expanded by `Macros.include`, which streams its output and adds its
+        inputs to `inputs` as it goes.
+
+        Args:
+            template (Template): the template to expand
+            inputs (set[Path]): the set to which to add the inputs used
+        """
+        pending: list[
+            Chunk | asyncio.Future[bytes] | tuple[list[bytes] | None, bytes | None]
+        ] = []
+        for segment in template:
+            if isinstance(segment, bytes):
+                pending.append(segment)
+            elif segment.name == b"include":
+                args, input, arg_inputs = await self.expand_arguments(segment)
+                inputs.update(arg_inputs)
+                pending.append((args, input))
             else:
-                output, macro_inputs = await self.do_macro(name, args, input)
+                output, macro_inputs = await self.do_macro(segment)
                 inputs.update(macro_inputs)
-            expansions.append((res.start(), startpos, output))
-
-        expanded: list[bytes] = []
-        last_nextpos = 0
-        for startpos, nextpos, e in expansions:
-            expanded.append(text[last_nextpos:startpos])
-            if isinstance(e, bytes):
-                expanded.append(e)
+                pending.append(output)
+        for e in pending:
+            if isinstance(e, tuple):
+                async for chunk in self._macros.include(*e, inputs):
+                    yield chunk
             else:
-                stdout_data, stderr_data = await e.process.communicate()
-                assert e.process.returncode is not None
-                expanded.append(stdout_data)
-                if e.process.returncode != 0:
-                    print(stderr_data.decode("iso-8859-1"), file=sys.stderr)
-                    raise ValueError(
-                        f"Error code {e.process.returncode} running: {e.command}"
-                    )
-            last_nextpos = nextpos
-        expanded.append(text[last_nextpos:])
-
-        debug(f"expanded is now: {expanded}")
-        debug(f"expand found inputs {inputs}")
-        return b"".join(expanded), inputs
+                yield await e if isinstance(e, asyncio.Future) else e
 
-    async def include(self, path: Path, context: Path | None = None) -> Expansion:
-        """Expand the contents of `path`.
+    async def stream_include(
+        self, path: Path, inputs: set[Path], context: Path | None = None
+    ) -> AsyncIterator[Chunk]:
+        """Expand the contents of `path`, yielding the output as it is produced.
 
         Args:
             path (Path): the input-relative path to include
+            inputs (set[Path]): the set to which to add the inputs used
             context (Path | None): the path relative to `Expand.input`; uses
                 `self.path` if `None` given.
-
-        Returns:
-            Expansion
         """
         if context is None:
             context = self.path
         self.stack.append(path)
-        file_path = self.tree.input / path
-        output = await Expand(
-            type(self._macros), self.tree, context, self.stack.copy()
-        ).expand(file_path.read_bytes())
+        file_path = self.tree.input_path(path)
+        async for chunk in Expand(
+            type(self._macros), self.tree, context, self.stack.copy(), self.searched
+        ).stream_template(await self.tree.compile_file(file_path), inputs):
+            yield chunk
         self.stack.pop()
-        output[1].add(file_path)
-        return output
+        inputs.add(file_path)
 
     def get_new_execution_perms(self):
         """Get the execution permissions for a new file."""
-        stats = os.stat(self.input_file())
+        input_file = self.input_file()
+        stats = self.tree.input_store(input_file).stat(input_file)
         return (
             stat.S_IMODE(stats.st_mode)
             & (stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH)
@@ -601,22 +2399,65 @@ class Expand:
             output_stats = os.stat(self.output_file())
             os.chmod(self.output_file(), output_stats.st_mode | exe_perms)
 
-    def copy_file(self) -> None:
-        """Copy the input file to the output file."""
+    def open_output_file(self) -> IO[bytes]:
+        """Open the output file for writing with `tree.output_store`."""
+        return self.tree.output_store.open(
+            self.output_file(), self.get_new_execution_perms()
+        )
+
+    async def copy_file(self) -> None:
+        """Copy the input file to the output file, using `tree.io`."""
+        record = current_record()
+        if record is not None:
+            input_file = self.input_file()
+            store = self.tree.input_store(input_file)
+            size = (await self.tree.io.call(store.stat, input_file)).st_size
+            record.bytes_in += size
+            record.bytes_out += size
         if self.tree.output == Path("-"):
-            file_contents = self.input_file().read_bytes()
-            sys.stdout.buffer.write(file_contents)
+            file_contents = await self.tree.read_file(self.input_file())
+            await self.tree.io.call(sys.stdout.buffer.write, file_contents)
         else:
-            exe_perms = self.get_new_execution_perms()
-            shutil.copyfile(self.input_file(), self.output_file())
-            self.set_output_execution_perms(exe_perms)
+            await self.tree.io.call(self.copy_to_output_file)
             self.tree.output_files.add(self.output_file())
 
+    def copy_to_output_file(self) -> None:
+        """Copy the input file to the output file, as `tree.link` says.
+
+        Files can only be linked from an input directory to an output
+        directory; otherwise, they are copied.
+        """
+        exe_perms = self.get_new_execution_perms()
+        input_file = self.input_file()
+        store = self.tree.input_store(input_file)
+        output = self.tree.output_store
+        # Only use the contents if already cached: most copied files are
+        # not otherwise read, and should not evict those that are.
+        file_contents = None
+        if self.tree.link == LinkMethod.COPY:
+            file_contents = self.tree.contents.get(input_file, store.stat(input_file))
+        if file_contents is None and (
+            isinstance(store, LocalStore) and isinstance(output, LocalOutput)
+        ):
+            link_file(input_file, self.output_file(), self.tree.link)
+            self.set_output_execution_perms(exe_perms)
+            return
+        if file_contents is None:
+            file_contents = store.read_bytes(input_file)
+        fh = output.open(self.output_file(), exe_perms)
+        try:
+            fh.write(file_contents)
+        except BaseException:
+            output.discard(self.output_file(), fh)
+            raise
+        output.commit(self.output_file(), fh)
+
 
 class Macros:
     """Defines the macros available to template files.
 
-    Each method `foo` defines the behaviour of `$foo`.
+    Each method `foo` defines the behaviour of `$foo`. `include` streams
+    its output, and so takes a set to which to add its inputs.
     """
 
     _expand: Expand
@@ -645,7 +2486,8 @@ class Macros:
             raise ValueError("$expand does not take arguments")
         if input is None:
             raise ValueError("$expand takes an input")
-        debug(command_to_str(b"expand", args, input))
+        if log.expand.enabled:
+            log.expand(log.abbrev(command_to_str(b"expand", args, input)))
 
         output, inputs = await self._expand.expand(input)
         return strip_final_newline(output), inputs
@@ -655,30 +2497,45 @@ class Macros:
             raise ValueError("$paste needs exactly one argument")
         if input is not None:
             raise ValueError("$paste does not take an input")
-        debug(command_to_str(b"paste", args, input))
-
-        file_path = self._expand.tree.input / self._expand.file_arg(args[0])
-        return file_path.read_bytes(), set((file_path,))
-
-    async def include(self, args: list[bytes] | None, input: bytes | None) -> Expansion:
+        if log.expand.enabled:
+            log.expand(log.abbrev(command_to_str(b"paste", args, input)))
+
+        file_path = self._expand.tree.input_path(self._expand.file_arg(args[0]))
+        contents = await self._expand.tree.read_file(file_path)
+        record = current_record()
+        if record is not None:
+            record.pastes += 1
+            record.bytes_in += len(contents)
+        return contents, set((file_path,))
+
+    async def include(
+        self, args: list[bytes] | None, input: bytes | None, inputs: set[Path]
+    ) -> AsyncIterator[Chunk]:
         if args is None or len(args) != 1:
             raise ValueError("$include needs exactly one argument")
         if input is not None:
             raise ValueError("$include does not take an input")
-        debug(command_to_str(b"include", args, input))
+        if log.expand.enabled:
+            log.expand(log.abbrev(command_to_str(b"include", args, input)))
+        record = current_record()
+        if record is not None:
+            record.includes += 1
 
         file_path = self._expand.file_arg(args[0])
-        output, inputs = await self._expand.include(
-            file_path, self._expand.path.parent / Path(os.fsdecode(args[0]))
-        )
-        return strip_final_newline(output), inputs
+        async for chunk in stream_strip_final_newline(
+            self._expand.stream_include(
+                file_path, inputs, self._expand.path.parent / Path(os.fsdecode(args[0]))
+            )
+        ):
+            yield chunk
 
     async def run(
         self, args: list[bytes] | None, input: bytes | None
     ) -> CommandExpansion:
         if args is None:
             raise ValueError("$run needs at least one argument")
-        debug(command_to_str(b"run", args, input))
+        if log.run.enabled:
+            log.run(log.abbrev(command_to_str(b"run", args, input)))
 
         exe_path = self._expand.exe_arg(args[0])
         return b"", set((exe_path,))
@@ -690,33 +2547,210 @@ class RunMacros(Macros):
     ) -> CommandExpansion:
         if args is None:
             raise ValueError("$run needs at least one argument")
-        debug(command_to_str(b"run", args, input))
+        if log.run.enabled:
+            log.run(log.abbrev(command_to_str(b"run", args, input)))
 
         exe_path = self._expand.exe_arg(args[0])
         expanded_input, inputs = (
             (None, set()) if input is None else await self._expand.expand(input)
         )
-        os.environ["NANCY_INPUT"] = str(self._expand.tree.input)
+        nancy_input = self._expand.tree.nancy_input()
         inputs.add(exe_path)
-        return await filter_bytes(expanded_input, exe_path, args[1:]), inputs
+        exe_path = self._expand.tree.local_path(exe_path)
+        run_cache = self._expand.tree.run_cache
+        cache_key = None
+        if run_cache is not None:
+            cache_key = run_cache.key(
+                args[0], exe_path, args[1:], expanded_input, nancy_input
+            )
+            if cache_key is not None:
+                output = run_cache.get(cache_key)
+                if output is not None:
+                    record = current_record()
+                    if record is not None:
+                        now = time.time()
+                        record.runs.append(
+                            RunRecord(os.fsdecode(args[0]), now, now, cached=True)
+                        )
+                    return output, inputs
+        output = asyncio.ensure_future(
+            self._expand.tree.run_program(
+                asyncio.current_task(), args[0], expanded_input, exe_path, args[1:]
+            )
+        )
+        if run_cache is not None and cache_key is not None:
+            run_cache.start(cache_key, output)
+        return output, inputs
+
+
+def worker_tree(config: WorkerConfig, caches: Caches | None = None) -> Tree:
+    """Make a `Tree` for a worker process or thread.
+
+    Args:
+        config (WorkerConfig): the settings of the `Tree`
+        caches (Caches | None): the caches to use, if any
+
+    Returns:
+        Tree
+    """
+    return Tree(
+        config.input,
+        config.output,
+        config.process_hidden,
+        config.build,
+        False,
+        config.update_newer,
+        config.hash_dependencies,
+        None
+        if config.run_cache is None
+        else RunCache(config.run_cache[0], set(config.run_cache[1])),
+        config.max_procs,
+        config.run_timeout,
+        None if config.servers is None else Servers(set(config.servers)),
+        caches,
+        link=config.link,
+        io_threads=config.io_threads,
+        profiler=Profiler() if config.profile else None,
+    )
+
+
+# The `Tree` of a worker process, with the event loop it runs in.
+_worker_state: tuple[WorkerConfig, Tree, asyncio.AbstractEventLoop] | None = None
+
+
+def process_files_in_worker(
+    config: WorkerConfig,
+    files: list[tuple[Path, NameKind]],
+    workers: int,
+    only_newer: bool,
+) -> WorkerResult:
+    """Process a batch of files in a worker process.
+
+    The worker's `Tree`, and the event loop it uses, are kept for later
+    batches with the same `config`.
+
+    Args:
+        config (WorkerConfig): the settings of the `Tree` to use
+        files (list[tuple[Path, NameKind]]): as for `Tree.process_files`
+        workers (int): the number of tasks to use.
+        only_newer (bool): passed to `Tree.process_file`
+
+    Returns:
+        WorkerResult
+    """
+    global _worker_state
+    if _worker_state is None or _worker_state[0] != config:
+        loop = asyncio.new_event_loop()
+        tree = worker_tree(config)
+        servers = tree.servers
+        if servers is not None:
+            atexit.register(lambda: loop.run_until_complete(servers.stop()))
+        _worker_state = config, tree, loop
+    _, tree, loop = _worker_state
+
+    async def iterate_files() -> AsyncIterator[tuple[Path, NameKind]]:
+        for file in files:
+            yield file
+
+    loop.run_until_complete(tree.process_files(iterate_files(), workers, only_newer))
+    return tree.worker_result(obj for obj, _ in files)
+
+
+def process_files_in_thread(
+    tree: Tree,
+    take_file: Callable[[], tuple[Path, NameKind] | None],
+    workers: int,
+    only_newer: bool,
+) -> WorkerResult:
+    """Process files in a worker thread, with its own event loop.
+
+    Args:
+        tree (Tree): the `Tree` to use, which is used only by this thread
+        take_file (Callable[[], tuple[Path, NameKind] | None]): returns the
+            next file to process, or `None` when there are no more
+        workers (int): the number of tasks to use.
+        only_newer (bool): passed to `Tree.process_file`
+
+    Returns:
+        WorkerResult
+    """
+    objs: list[Path] = []
+
+    async def iterate_files() -> AsyncIterator[tuple[Path, NameKind]]:
+        while (file := take_file()) is not None:
+            objs.append(file[0])
+            yield file
+
+    async def run() -> None:
+        try:
+            await tree.process_files(iterate_files(), workers, only_newer)
+        finally:
+            if tree.servers is not None:
+                await tree.servers.stop()
+
+    asyncio.run(run())
+    return tree.worker_result(objs)
+
 
+async def run_workers(
+    queue: asyncio.Queue[Callable[[], Awaitable]],
+    work: AsyncIterable[Callable[[], Awaitable]],
+    workers: int,
+) -> None:
+    """Run `work` with parallel worker tasks.
 
-async def worker(i: int, queue: asyncio.Queue[Awaitable]):
+    Each function is queued as it is produced. As `queue` should be bounded,
+    this waits while workers catch up. Work is queued as functions, so that
+    no coroutine is left unawaited if processing stops with an error.
+
+    Args:
+        queue (asyncio.Queue[Callable[[], Awaitable]]): the queue to use
+        work (AsyncIterable[Callable[[], Awaitable]]): the work to do
+        workers (int): the number of tasks to use.
+    """
+    background_tasks = set()
+    try:
+        async with asyncio.TaskGroup() as tg:
+            for i in range(workers):
+                task = tg.create_task(worker(i, queue))
+                background_tasks.add(task)
+                task.add_done_callback(background_tasks.discard)
+            async for process in work:
+                await queue.put(process)
+            await queue.join()
+            queue.shutdown()
+    except BaseExceptionGroup as e:
+        raise e.exceptions[0]
+
+
+async def worker(i: int, queue: asyncio.Queue[Callable[[], Awaitable]]):
     while True:
         try:
             process = await queue.get()
         except asyncio.queues.QueueShutDown:
             return
-        debug(f"worker {i} got task {process}")
+        if log.build.enabled:
+            log.build(f"worker {i} got task {process}")
         try:
-            await process
+            await process()
         finally:
             queue.task_done()
 
 
-async def real_main(argv: list[str] = sys.argv[1:]) -> None:
+async def real_main(
+    argv: list[str] = sys.argv[1:],
+    session: dict[tuple[Path, str], Caches] | None = None,
+) -> None:
+    """Run Nancy with the given command-line arguments.
+
+    Args:
+        argv (list[str]): the arguments
+        session (dict[tuple[Path, str], Caches] | None): when running in a
+            server, the `Caches` for each working directory and input
+    """
     if "DEBUG" in os.environ:
         logging.basicConfig(level=logging.DEBUG)
+        log.configure(os.environ["DEBUG"])
 
     # Read and process arguments
     parser = argparse.ArgumentParser(
@@ -726,11 +2760,15 @@ async def real_main(argv: list[str] = sys.argv[1:]) -> None:
     parser.register("action", "raw_version", RawVersionAction)
     parser.add_argument(
         "input",
-        metavar="INPUT",
-        help="input directory, or file",
+        metavar="INPUT-PATH",
+        help="input directories or archives, or file",
+        nargs="?",
     )
     parser.add_argument(
-        "output", metavar="OUTPUT", help="output directory, or file ('-' for stdout)"
+        "output",
+        metavar="OUTPUT",
+        help="output directory or archive, or file ('-' for stdout)",
+        nargs="?",
     )
     parser.add_argument(
         "--path", help="path to build relative to input tree [default: '']"
@@ -745,11 +2783,106 @@ async def real_main(argv: list[str] = sys.argv[1:]) -> None:
         help="only overwrite files in the output tree if their dependencies are newer than the current file",
         action="store_true",
     )
+    parser.add_argument(
+        "--update-method",
+        help="with --update, overwrite files whose dependencies are newer (METHOD 'mtime', the default), or have changed contents (METHOD 'hash')",
+        choices=["mtime", "hash"],
+        metavar="METHOD",
+    )
     parser.add_argument(
         "--delete",
         help="delete files and directories in the output tree that are not written",
         action="store_true",
     )
+    parser.add_argument(
+        "--watch",
+        help="after building, keep watching the input for changes, and rebuild the files they affect",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--watch-interval",
+        help="with --watch, check for changes every SECONDS seconds [default: %(default)s]",
+        type=float,
+        default=WATCH_INTERVAL,
+        metavar="SECONDS",
+    )
+    parser.add_argument(
+        "--cache-runs",
+        help="reuse the output of programs run with the same arguments and input",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--run-cache",
+        metavar="DIRECTORY",
+        help="keep the output of programs in DIRECTORY between runs (implies --cache-runs)",
+    )
+    parser.add_argument(
+        "--impure",
+        metavar="PROGRAM",
+        help="never cache the output of PROGRAM (may be given more than once)",
+        action="append",
+        default=[],
+    )
+    parser.add_argument(
+        "--server",
+        metavar="PROGRAM",
+        help="run PROGRAM as a server if it supports it (may be given more than once)",
+        action="append",
+        default=[],
+    )
+    parser.add_argument(
+        "--max-procs",
+        help="maximum number of programs to run at the same time [default is number of CPU cores, currently %(default)s]",
+        type=int,
+        default=os.cpu_count() or 1,
+    )
+    parser.add_argument(
+        "--run-timeout",
+        metavar="SECONDS",
+        help="stop with an error if a program runs for longer than SECONDS",
+        type=float,
+    )
+    parser.add_argument(
+        "--serve",
+        metavar="SOCKET",
+        help="instead of building, serve requests from --connect on SOCKET, keeping caches between requests",
+    )
+    parser.add_argument(
+        "--connect",
+        metavar="SOCKET",
+        help="build using the server listening on SOCKET",
+    )
+    parser.add_argument(
+        "--link",
+        help="make output files that are copies of input files by METHOD: 'copy' (the default); 'reflink', sharing storage with the input file if the filesystem supports it; or 'hardlink', linking to the input file; falls back to copying",
+        choices=["copy", "reflink", "hardlink"],
+        default="copy",
+        metavar="METHOD",
+    )
+    parser.add_argument(
+        "--io-threads",
+        metavar="THREADS",
+        help="number of threads to use for file input and output, or 0 to use none [default: %(default)s]",
+        type=int,
+        default=IO_THREADS,
+    )
+    parser.add_argument(
+        "--profile",
+        metavar="FILE",
+        help="write a JSON report of the time taken by each file, template and program to FILE",
+    )
+    parser.add_argument(
+        "--trace",
+        metavar="FILE",
+        help="write a trace of the build to FILE in Chrome trace-event format",
+    )
+    parser.add_argument(
+        "--backend",
+        help="process files in TYPE: 'tasks' of this process (the default), or 'processes' or 'threads', one per CPU core, each running --jobs tasks",
+        choices=["tasks", "processes", "threads"],
+        default="tasks",
+        metavar="TYPE",
+    )
     parser.add_argument(
         "--jobs",
         help="number of parallel tasks to run at the same time [default is number of CPU cores, currently %(default)s]",
@@ -768,26 +2901,92 @@ your option) any later version. There is no warranty.""",
     warnings.showwarning = simple_warning(parser.prog)
     args = parser.parse_args(argv)
 
+    if args.serve is not None:
+        if session is not None:
+            die("cannot start a server from a server")
+        return await run_server(Path(args.serve))
+    if args.input is None or args.output is None:
+        parser.error("the following arguments are required: INPUT-PATH, OUTPUT")
+    if args.update_method is not None and not args.update:
+        parser.error("--update-method requires --update")
+
     # Expand input
     try:
-        if args.input == "":
+        if args.connect is not None and session is None:
+            status = connect(
+                Path(args.connect), argv, sys.stdout.buffer, sys.stderr.buffer
+            )
+            if status != 0:
+                sys.exit(status)
+            return
+        if "" in args.input.split(os.pathsep):
             die("input path must not be empty")
-        input = Path(args.input)
+        inputs = [Path(input) for input in args.input.split(os.pathsep)]
 
         # Deal with special case where INPUT is a single file and --path is not
         # given.
-        if args.path is None and input.is_file():
-            args.path = input
-            input = Path.cwd()
+        if (
+            args.path is None
+            and len(inputs) == 1
+            and inputs[0].is_file()
+            and archive_format(inputs[0]) is None
+        ):
+            args.path = inputs[0]
+            inputs = [Path.cwd()]
+
+        caches = (
+            Caches()
+            if session is None
+            else session.setdefault(
+                (Path.cwd(), os.pathsep.join(map(str, inputs))), Caches()
+            )
+        )
+        run_cache = None
+        if args.cache_runs or args.run_cache:
+            run_cache = caches.run_caches.setdefault(
+                (args.run_cache, frozenset(args.impure)),
+                RunCache(
+                    Path(args.run_cache) if args.run_cache else None, set(args.impure)
+                ),
+            )
+        servers = None
+        if args.server:
+            servers = caches.servers.setdefault(
+                frozenset(args.server), Servers(set(args.server))
+            )
 
-        await Tree(
-            input,
+        tree = Tree(
+            inputs,
             Path(args.output),
             args.process_hidden,
             Path(args.path) if args.path else None,
             args.delete,
             args.update,
-        ).process(args.jobs)
+            args.update_method == "hash",
+            run_cache,
+            args.max_procs,
+            args.run_timeout,
+            servers,
+            caches,
+            (os.process_cpu_count() or 1) if args.backend == "processes" else 1,
+            (os.process_cpu_count() or 1) if args.backend == "threads" else 1,
+            LinkMethod(args.link),
+            args.io_threads,
+            None if args.profile is None and args.trace is None else Profiler(),
+        )
+        try:
+            if args.watch:
+                await tree.watch(args.jobs, args.watch_interval)
+            else:
+                await tree.process(args.jobs)
+        finally:
+            if tree.profiler is not None:
+                if args.profile is not None:
+                    tree.profiler.write_report(Path(args.profile))
+                if args.trace is not None:
+                    tree.profiler.write_trace(Path(args.trace))
+            if session is None:
+                await caches.stop()
 
     except Exception as err:
         if "DEBUG" in os.environ:
@@ -797,5 +2996,18 @@ your option) any later version. There is no warranty.""",
         sys.exit(1)
 
 
+async def run_server(socket_path: Path) -> None:
+    """Serve requests on `socket_path` until cancelled, sharing caches."""
+    session: dict[tuple[Path, str], Caches] = {}
+    try:
+        await serve(socket_path, lambda argv: real_main(argv, session))
+    finally:
+        for caches in session.values():
+            await caches.stop()
+
+
 def main(argv: list[str] = sys.argv[1:]) -> None:
-    asyncio.run(real_main(argv))
+    try:
+        asyncio.run(real_main(argv))
+    except KeyboardInterrupt:
+        sys.exit(130)
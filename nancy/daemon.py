@@ -0,0 +1,171 @@
+"""Long-running Nancy server, for `--serve` and `--connect`.
+
+The server listens on a Unix socket. A client sends a request as a line of
+JSON: an object whose `argv`, `cwd` and `env` members give the command-line
+arguments, working directory and environment with which to run Nancy.
+
+The server responds with a series of frames, each consisting of a channel
+byte, a 4-byte big-endian length, and that many bytes of data. Channel `1`
+is standard output, channel `2` is standard error, and the last frame,
+on channel `x`, gives the exit status as a 4-byte big-endian signed
+integer.
+
+Requests are handled one at a time, because Nancy's working directory,
+environment and standard streams belong to the whole process.
+
+The client is in the top-level module `_nancy_client`, so that it can run
+without loading Nancy.
+
+© Reuben Thomas <rrt@sc3d.org> 2026.
+
+Released under the GPL version 3, or (at your option) any later version.
+"""
+
+import asyncio
+import contextlib
+import io
+import json
+import os
+import socket
+import sys
+import threading
+from collections.abc import Awaitable, Buffer, Callable
+from pathlib import Path
+
+from . import log
+
+
+def frame(channel: bytes, data: bytes) -> bytes:
+    """Encode `data` as a frame on `channel`."""
+    return channel + len(data).to_bytes(4) + data
+
+
+class FrameWriter(io.RawIOBase):
+    """A binary stream that sends what is written as frames.
+
+    It must be created in the event loop's thread. Writes from other
+    threads, such as the I/O threads, are handed to the event loop, as
+    `asyncio.StreamWriter` is not thread-safe.
+    """
+
+    def __init__(self, writer: asyncio.StreamWriter, channel: bytes):
+        self._writer = writer
+        self._channel = channel
+        self._loop = asyncio.get_running_loop()
+        self._thread = threading.get_ident()
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, data: Buffer) -> int:
+        data = bytes(data)
+        if len(data) > 0:
+            if threading.get_ident() == self._thread:
+                self._writer.write(frame(self._channel, data))
+            else:
+                # The event loop runs callbacks in order, so this frame is
+                # sent before the loop learns that the write has returned.
+                self._loop.call_soon_threadsafe(
+                    self._writer.write, frame(self._channel, data)
+                )
+        return len(data)
+
+
+def exit_status(e: SystemExit) -> int:
+    """Find the exit status given by `SystemExit`."""
+    if e.code is None:
+        return 0
+    if isinstance(e.code, int):
+        return e.code
+    print(e.code, file=sys.stderr)
+    return 1
+
+
+async def serve(socket_path: Path, handle: Callable[[list[str]], Awaitable[None]]):
+    """Serve requests on `socket_path` until cancelled.
+
+    Args:
+        socket_path (Path): the `Path` of the socket
+        handle (Callable[[list[str]], Awaitable[None]]): runs Nancy with the
+            given arguments
+    """
+    if socket_path.exists():
+        with socket.socket(socket.AF_UNIX) as sock:
+            try:
+                sock.connect(str(socket_path))
+            except ConnectionRefusedError:
+                if log.build.enabled:
+                    log.build(f"Removing stale socket '{socket_path}'")
+                socket_path.unlink()
+            else:
+                raise ValueError(f"a server is already listening on '{socket_path}'")
+    lock = asyncio.Lock()
+
+    async def handle_client(
+        reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+    ) -> None:
+        try:
+            line = await reader.readline()
+            if len(line) == 0:
+                return  # The client hung up without sending a request.
+            request = json.loads(line)
+            async with lock:
+                status = await run_request(
+                    handle, request["argv"], request["cwd"], request["env"], writer
+                )
+            writer.write(frame(b"x", status.to_bytes(4, signed=True)))
+            await writer.drain()
+        finally:
+            writer.close()
+
+    # Requests run with the server's privileges, so only its user may
+    # connect.
+    old_umask = os.umask(0o177)
+    try:
+        server = await asyncio.start_unix_server(handle_client, socket_path)
+    finally:
+        os.umask(old_umask)
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        socket_path.unlink(missing_ok=True)
+
+
+async def run_request(
+    handle: Callable[[list[str]], Awaitable[None]],
+    argv: list[str],
+    cwd: str,
+    env: dict[str, str],
+    writer: asyncio.StreamWriter,
+) -> int:
+    """Run Nancy for a client, and return its exit status."""
+    if log.build.enabled:
+        log.build(f"Request: {argv} in '{cwd}'")
+    old_cwd = os.getcwd()
+    old_env = dict(os.environ)
+    # Debug logging is configured by each request.
+    old_channels = {name: channel.enabled for name, channel in log.CHANNELS.items()}
+    stdout = io.TextIOWrapper(io.BufferedWriter(FrameWriter(writer, b"1")))
+    stderr = io.TextIOWrapper(io.BufferedWriter(FrameWriter(writer, b"2")))
+    try:
+        os.chdir(cwd)
+        os.environ.clear()
+        os.environ.update(env)
+        for channel in log.CHANNELS.values():
+            channel.enabled = False
+        with contextlib.redirect_stdout(stdout), contextlib.redirect_stderr(stderr):
+            try:
+                await handle(argv)
+                return 0
+            except SystemExit as e:
+                return exit_status(e)
+            finally:
+                stdout.flush()
+                stderr.flush()
+    finally:
+        os.chdir(old_cwd)
+        os.environ.clear()
+        os.environ.update(old_env)
+        for name, enabled in old_channels.items():
+            log.CHANNELS[name].enabled = enabled
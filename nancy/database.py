@@ -0,0 +1,153 @@
+"""Build database, used to skip up-to-date files with `--update`.
+
+© Reuben Thomas <rrt@sc3d.org> 2026.
+
+Released under the GPL version 3, or (at your option) any later version.
+"""
+
+import hashlib
+import json
+import mmap
+import os
+from collections.abc import Buffer
+from dataclasses import dataclass, field
+from pathlib import Path
+
+from . import log
+
+
+# Name of the database file in the output tree.
+DATABASE_NAME = ".nancy-build.json"
+
+# Version of the database format; databases in other formats are ignored.
+DATABASE_VERSION = 3
+
+
+def contents_digest(contents: Buffer) -> str:
+    """Compute a digest of `contents`."""
+    return hashlib.blake2b(contents, digest_size=16).hexdigest()
+
+
+def file_digest(path: Path) -> str:
+    """Compute a digest of the contents of the file `path`."""
+    with open(path, "rb") as fh:
+        if os.fstat(fh.fileno()).st_size == 0:
+            return contents_digest(b"")
+        with mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ) as contents:
+            return contents_digest(contents)
+
+
+@dataclass
+class Dependency:
+    """A file used to build an output file.
+
+    Fields:
+        path (Path): the absolute `Path` of the file
+        signature (tuple[int, int] | None): the (mtime, size) of the file when
+            `digest` was computed
+        digest (str | None): the digest of the file's contents, if recorded
+    """
+
+    path: Path
+    signature: tuple[int, int] | None = None
+    digest: str | None = None
+
+
+@dataclass
+class Entry:
+    """The result of building one input file.
+
+    Fields:
+        output (Path): the output-relative `Path` of the file written
+        dependencies (list[Dependency]): the files used to build it
+        missing (list[Path]): the input-relative `Path`s searched for the
+            files it uses that were not files, in case one is added
+    """
+
+    output: Path
+    dependencies: list[Dependency]
+    missing: list[Path] = field(default_factory=list)
+
+
+class Database:
+    """The dependencies of each file built in an output tree.
+
+    Fields:
+        path (Path): the filesystem `Path` of the database file
+        entries (dict[Path, Entry]): the entry for each input-relative `Path`
+        recorded (set[Path]): the input-relative `Path`s recorded since the
+            database was loaded
+    """
+
+    path: Path
+    entries: dict[Path, Entry]
+    recorded: set[Path]
+
+    def __init__(self, path: Path):
+        self.path = path
+        self.entries = {}
+        self.recorded = set()
+        try:
+            with open(path, encoding="utf-8") as fh:
+                data = json.load(fh)
+        except FileNotFoundError:
+            return
+        except ValueError:
+            if log.io.enabled:
+                log.io(f"Ignoring corrupt build database '{path}'")
+            return
+        if data.get("version") != DATABASE_VERSION:
+            if log.io.enabled:
+                log.io(f"Ignoring build database '{path}' with wrong version")
+            return
+        for obj, (output, dependencies, missing) in data["files"].items():
+            self.entries[Path(obj)] = Entry(
+                Path(output),
+                [
+                    Dependency(
+                        Path(path),
+                        None if signature is None else (signature[0], signature[1]),
+                        digest,
+                    )
+                    for path, signature, digest in dependencies
+                ],
+                [Path(path) for path in missing],
+            )
+
+    def record(self, obj: Path, entry: Entry) -> None:
+        """Record the result of building `obj`.
+
+        Args:
+            obj (Path): the input-relative `Path` that was built
+            entry (Entry): the result
+        """
+        self.entries[obj] = entry
+        self.recorded.add(obj)
+
+    def prune(self, build: Path) -> None:
+        """Remove entries under `build` that were not recorded.
+
+        Args:
+            build (Path): the input-relative `Path` that was built
+        """
+        for obj in list(self.entries):
+            if obj not in self.recorded and obj.is_relative_to(build):
+                del self.entries[obj]
+
+    def save(self) -> None:
+        """Write the database, replacing any previous version."""
+        data = {
+            "version": DATABASE_VERSION,
+            "files": {
+                str(obj): [
+                    str(entry.output),
+                    [[str(d.path), d.signature, d.digest] for d in entry.dependencies],
+                    [str(path) for path in entry.missing],
+                ]
+                for obj, entry in sorted(self.entries.items())
+            },
+        }
+        tmp_path = self.path.with_name(f"{self.path.name}.tmp")
+        with open(tmp_path, "w", encoding="utf-8") as fh:
+            json.dump(data, fh, separators=(",", ":"))
+        os.replace(tmp_path, self.path)
@@ -0,0 +1,100 @@
+"""Blocking file operations, run in a thread pool.
+
+Reading, writing, copying and examining files are run in a thread pool
+dedicated to file I/O, so that filesystem latency overlaps with expansion
+and with waiting for `$run` commands. (The Python standard library does
+not support io_uring, so a thread pool is used on all platforms.)
+
+© Reuben Thomas <rrt@sc3d.org> 2026.
+
+Released under the GPL version 3, or (at your option) any later version.
+"""
+
+import asyncio
+import functools
+from collections.abc import Buffer, Callable
+from concurrent.futures import ThreadPoolExecutor
+from typing import IO
+
+
+# Default number of threads for file I/O.
+IO_THREADS = 8
+
+# Size of the batches in which output is written.
+WRITE_BATCH_SIZE = 1024 * 1024
+
+
+class FileIO:
+    """Runs blocking file operations in a thread pool.
+
+    The threads are started when first needed.
+
+    Fields:
+        threads (int): the number of threads; if 0, operations are run
+            directly, blocking the event loop
+    """
+
+    threads: int
+    _executor: ThreadPoolExecutor | None
+
+    def __init__(self, threads: int = IO_THREADS):
+        self.threads = threads
+        self._executor = None
+
+    async def call[T](self, func: Callable[..., T], *args, **kwargs) -> T:
+        """Run `func(*args, **kwargs)` in the thread pool, and return its result."""
+        if self.threads == 0:
+            return func(*args, **kwargs)
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(
+                self.threads, thread_name_prefix="nancy-io"
+            )
+        return await asyncio.get_running_loop().run_in_executor(
+            self._executor, functools.partial(func, *args, **kwargs)
+        )
+
+
+class BatchedWriter:
+    """Writes chunks of output to a file in batches, using `FileIO`.
+
+    While one batch is being written, the next is collected.
+    """
+
+    _io: FileIO
+    _fh: IO[bytes]
+    _batch: list[Buffer]
+    _size: int
+    _pending: asyncio.Future[None] | None
+
+    def __init__(self, io: FileIO, fh: IO[bytes]):
+        self._io = io
+        self._fh = fh
+        self._batch = []
+        self._size = 0
+        self._pending = None
+
+    async def write(self, chunk: Buffer) -> None:
+        """Add `chunk` to the output, writing a batch if one is full."""
+        self._batch.append(chunk)
+        self._size += len(memoryview(chunk))
+        if self._size >= WRITE_BATCH_SIZE:
+            await self._write_batch()
+
+    async def _write_batch(self) -> None:
+        await self.wait()
+        batch = self._batch
+        self._batch = []
+        self._size = 0
+        self._pending = asyncio.ensure_future(self._io.call(self._fh.writelines, batch))
+
+    async def flush(self) -> None:
+        """Write any remaining output, and wait until it has been written."""
+        await self._write_batch()
+        await self.wait()
+
+    async def wait(self) -> None:
+        """Wait until the batch being written, if any, has been written."""
+        if self._pending is not None:
+            pending = self._pending
+            self._pending = None
+            await pending
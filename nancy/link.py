@@ -0,0 +1,149 @@
+"""Making output files that are copies of input files, for `--link`.
+
+© Reuben Thomas <rrt@sc3d.org> 2026.
+
+Released under the GPL version 3, or (at your option) any later version.
+"""
+
+import errno
+import os
+import shutil
+from enum import Enum
+from pathlib import Path
+from typing import IO
+
+from . import log
+
+
+# `FICLONE` from <linux/fs.h>.
+FICLONE = 0x40049409
+
+# Maximum number of bytes to ask `os.copy_file_range` to copy at once.
+COPY_RANGE_SIZE = 1024 * 1024 * 1024
+
+# Errors meaning that a method of copying is not supported for the given
+# files, so another should be tried.
+UNSUPPORTED_ERRNOS = {
+    errno.EXDEV,
+    errno.EPERM,
+    errno.EINVAL,
+    errno.ENOSYS,
+    errno.ENOTTY,
+    errno.EOPNOTSUPP,
+    errno.ENOTSUP,
+    errno.EMLINK,
+    errno.EBADF,
+}
+
+
+class LinkMethod(Enum):
+    """How to make an output file that is a copy of an input file."""
+
+    COPY = "copy"
+    REFLINK = "reflink"
+    HARDLINK = "hardlink"
+
+
+def unshare(path: Path) -> None:
+    """Remove `path` if it is a hard link.
+
+    This stops writing to `path` from changing other files, such as an input
+    file that it was linked to by `--link=hardlink`.
+    """
+    try:
+        if os.stat(path).st_nlink > 1:
+            if log.io.enabled:
+                log.io(f"Unlinking hard link '{path}'")
+            os.unlink(path)
+    except FileNotFoundError:
+        pass
+
+
+def hardlink(src: Path, dst: Path) -> bool:
+    """Make `dst` a hard link to `src`, replacing any existing file.
+
+    Returns:
+        bool: `False` if the filesystem cannot link the files
+    """
+    try:
+        try:
+            os.link(src, dst)
+        except FileExistsError:
+            os.unlink(dst)
+            os.link(src, dst)
+    except OSError as e:
+        if e.errno not in UNSUPPORTED_ERRNOS:
+            raise
+        if log.io.enabled:
+            log.io(f"Cannot hard link '{src}' to '{dst}': {e}")
+        return False
+    return True
+
+
+def reflink(in_fh: IO[bytes], out_fh: IO[bytes]) -> bool:
+    """Make `out_fh` share the storage of `in_fh`, using `FICLONE`.
+
+    Returns:
+        bool: `False` if the filesystem cannot share the storage
+    """
+    try:
+        import fcntl
+
+        fcntl.ioctl(out_fh.fileno(), FICLONE, in_fh.fileno())
+    except ImportError:  # pragma: no cover
+        return False
+    except OSError as e:
+        if e.errno not in UNSUPPORTED_ERRNOS:
+            raise
+        return False
+    return True
+
+
+def copy_range(in_fh: IO[bytes], out_fh: IO[bytes]) -> bool:
+    """Copy `in_fh` to `out_fh` in the kernel, using `os.copy_file_range`.
+
+    Returns:
+        bool: `False` if the files cannot be copied this way
+    """
+    if not hasattr(os, "copy_file_range"):  # pragma: no cover
+        return False
+    copied = 0
+    while True:
+        try:
+            n = os.copy_file_range(in_fh.fileno(), out_fh.fileno(), COPY_RANGE_SIZE)
+        except OSError as e:
+            if copied > 0 or e.errno not in UNSUPPORTED_ERRNOS:
+                raise
+            return False
+        if n == 0:
+            # Some filesystems report nothing copied rather than an error.
+            return copied > 0 or os.fstat(in_fh.fileno()).st_size == 0
+        copied += n
+
+
+def link_file(src: Path, dst: Path, method: LinkMethod) -> None:
+    """Make `dst` a copy of `src`.
+
+    With `LinkMethod.HARDLINK`, `dst` is made a hard link to `src` if
+    possible. Otherwise, with `LinkMethod.HARDLINK` or `LinkMethod.REFLINK`,
+    `dst` is made to share `src`'s storage if possible, or else copied in the
+    kernel. If all else fails, or with `LinkMethod.COPY`, `src` is copied
+    with `shutil.copyfile`.
+
+    Args:
+        src (Path): the file to copy
+        dst (Path): the file to make
+        method (LinkMethod): how to make the file
+    """
+    if method == LinkMethod.HARDLINK and hardlink(src, dst):
+        return
+    unshare(dst)
+    if method != LinkMethod.COPY:
+        with open(src, "rb") as in_fh, open(dst, "wb") as out_fh:
+            if reflink(in_fh, out_fh):
+                return
+            if log.io.enabled:
+                log.io(f"Cannot reflink '{src}' to '{dst}'")
+            if copy_range(in_fh, out_fh):
+                return
+    shutil.copyfile(src, dst)
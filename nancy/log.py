@@ -0,0 +1,83 @@
+"""Debug logging, divided into channels that can be enabled separately.
+
+A disabled channel costs only a test of its `enabled` field, so callers
+check it before formatting a message:
+
+    if log.expand.enabled:
+        log.expand(f"expanding {log.abbrev(text)}")
+
+Channels are enabled by `configure`, from the `DEBUG` environment variable.
+
+© Reuben Thomas <rrt@sc3d.org> 2026.
+
+Released under the GPL version 3, or (at your option) any later version.
+"""
+
+import logging
+
+
+# Maximum length of a value formatted by `abbrev`.
+MAX_PAYLOAD_LENGTH = 200
+
+
+class Channel:
+    """A debug log channel.
+
+    Messages are logged at level `DEBUG` to the logger `nancy.NAME`.
+
+    Fields:
+        name (str): the name of the channel
+        enabled (bool): `True` if messages on this channel are logged
+    """
+
+    name: str
+    enabled: bool
+    _logger: logging.Logger
+
+    def __init__(self, name: str):
+        self.name = name
+        self.enabled = False
+        self._logger = logging.getLogger(f"nancy.{name}")
+
+    def __call__(self, message: str) -> None:
+        """Log `message`, if the channel is enabled."""
+        if self.enabled:
+            self._logger.debug(message)
+
+
+# Progress of the build as a whole.
+build = Channel("build")
+# Scanning and watching the input tree.
+walk = Channel("walk")
+# Finding files named by macros.
+resolve = Channel("resolve")
+# Expanding templates and macros.
+expand = Channel("expand")
+# Running programs, and caching their output.
+run = Channel("run")
+# Reading and writing files.
+io = Channel("io")
+
+CHANNELS = {c.name: c for c in (build, walk, resolve, expand, run, io)}
+
+
+def configure(spec: str) -> None:
+    """Enable the channels named in `spec`.
+
+    Args:
+        spec (str): a comma-separated list of channel names; if it contains
+            anything else (for example, `1`), all channels are enabled
+    """
+    names = [name.strip() for name in spec.split(",")]
+    if not all(name in CHANNELS for name in names):
+        names = list(CHANNELS)
+    for name, channel in CHANNELS.items():
+        channel.enabled = name in names
+
+
+def abbrev(value: object) -> str:
+    """Format `value` for a log message, truncating it if it is long."""
+    text = repr(value) if isinstance(value, bytes | bytearray) else str(value)
+    if len(text) <= MAX_PAYLOAD_LENGTH:
+        return text
+    return f"{text[:MAX_PAYLOAD_LENGTH]}... ({len(text)} characters)"
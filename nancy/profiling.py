@@ -0,0 +1,244 @@
+"""Build profiling, used for `--profile` and `--trace`.
+
+While a file is processed, its `FileRecord` is the value of a context
+variable, so that the macros and commands it uses can be accounted to it,
+even when they run in other tasks.
+
+© Reuben Thomas <rrt@sc3d.org> 2026.
+
+Released under the GPL version 3, or (at your option) any later version.
+"""
+
+import json
+import os
+import threading
+import time
+from collections.abc import Iterator
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Any
+
+
+@dataclass
+class RunRecord:
+    """A `$run` command used while processing a file.
+
+    Fields:
+        program (str): the program name given to `$run`
+        start (float): the time at which the output was requested
+        end (float): the time at which the output was available
+        cached (bool): `True` if the output was found in the run cache
+    """
+
+    program: str
+    start: float
+    end: float
+    cached: bool = False
+
+
+@dataclass
+class FileRecord:
+    """The profile of processing one input file.
+
+    Times are seconds since the epoch, so that records made in different
+    processes can be compared.
+
+    Fields:
+        path (str): the input-relative path of the file
+        process (int): the ID of the process that processed the file
+        thread (int): the ID of the thread that processed the file
+        start (float): the time at which processing started
+        end (float): the time at which processing finished
+        output (str | None): the output-relative path of the file, if known
+        expansion (float): the time spent writing the output file
+        bytes_in (int): the number of bytes of input read
+        bytes_out (int): the number of bytes of output written
+        includes (int): the number of `$include` calls
+        pastes (int): the number of `$paste` calls
+        templates (set[str]): the files expanded
+        runs (list[RunRecord]): the `$run` commands used
+    """
+
+    path: str
+    process: int
+    thread: int
+    start: float
+    end: float = 0.0
+    output: str | None = None
+    expansion: float = 0.0
+    bytes_in: int = 0
+    bytes_out: int = 0
+    includes: int = 0
+    pastes: int = 0
+    templates: set[str] = field(default_factory=set)
+    runs: list[RunRecord] = field(default_factory=list)
+
+
+_current: ContextVar[FileRecord | None] = ContextVar("current_record", default=None)
+
+
+def current_record() -> FileRecord | None:
+    """Return the record of the file being processed, if it is profiled."""
+    return _current.get()
+
+
+class Profiler:
+    """Records the profile of a build.
+
+    Fields:
+        start (float): the time at which the profiler was made
+        records (list[FileRecord]): the records of the files processed
+    """
+
+    start: float
+    records: list[FileRecord]
+
+    def __init__(self):
+        self.start = time.time()
+        self.records = []
+
+    @contextmanager
+    def file(self, path: Path) -> Iterator[FileRecord]:
+        """Profile processing the input-relative `path` in this context."""
+        record = FileRecord(str(path), os.getpid(), threading.get_ident(), time.time())
+        token = _current.set(record)
+        try:
+            yield record
+        finally:
+            record.end = time.time()
+            _current.reset(token)
+            self.records.append(record)
+
+    def take_records(self) -> list[FileRecord]:
+        """Return the records made so far, and forget them."""
+        records = self.records
+        self.records = []
+        return records
+
+    def report(self) -> dict[str, Any]:
+        """Summarize the profile.
+
+        Files are listed slowest first. Each template's time is the total
+        time of the files that used it, and each program's time is the total
+        time spent waiting for it.
+        """
+        files = []
+        templates: dict[str, dict[str, Any]] = {}
+        programs: dict[str, dict[str, Any]] = {}
+        for record in sorted(self.records, key=lambda r: r.end - r.start, reverse=True):
+            wall = record.end - record.start
+            files.append(
+                {
+                    "path": record.path,
+                    "output": record.output,
+                    "start": record.start - self.start,
+                    "wall": wall,
+                    "expansion": record.expansion,
+                    "bytes_in": record.bytes_in,
+                    "bytes_out": record.bytes_out,
+                    "includes": record.includes,
+                    "pastes": record.pastes,
+                    "runs": [
+                        {
+                            "program": run.program,
+                            "start": run.start - self.start,
+                            "wait": run.end - run.start,
+                            "cached": run.cached,
+                        }
+                        for run in record.runs
+                    ],
+                }
+            )
+            for template in record.templates:
+                stats = templates.setdefault(template, {"files": 0, "time": 0.0})
+                stats["files"] += 1
+                stats["time"] += wall
+            for run in record.runs:
+                stats = programs.setdefault(
+                    run.program, {"calls": 0, "cached": 0, "time": 0.0, "max": 0.0}
+                )
+                stats["calls"] += 1
+                stats["cached"] += run.cached
+                stats["time"] += run.end - run.start
+                stats["max"] = max(stats["max"], run.end - run.start)
+        return {
+            "wall": time.time() - self.start,
+            "files": files,
+            "templates": dict(
+                sorted(templates.items(), key=lambda item: -item[1]["time"])
+            ),
+            "programs": dict(
+                sorted(programs.items(), key=lambda item: -item[1]["time"])
+            ),
+        }
+
+    def trace_events(self) -> list[dict[str, Any]]:
+        """Return the profile as Chrome trace events.
+
+        Each file is an async slice, with its `$run` commands nested in it,
+        so that files processed at the same time appear on separate rows.
+        """
+
+        def micros(t: float) -> float:
+            return (t - self.start) * 1e6
+
+        events: list[dict[str, Any]] = []
+        for id, record in enumerate(self.records):
+            common = {
+                "cat": "file",
+                "id": id,
+                "pid": record.process,
+                "tid": record.thread,
+            }
+            events.append(
+                common
+                | {
+                    "name": record.path,
+                    "ph": "b",
+                    "ts": micros(record.start),
+                    "args": {
+                        "output": record.output,
+                        "bytes_in": record.bytes_in,
+                        "bytes_out": record.bytes_out,
+                    },
+                }
+            )
+            for run in record.runs:
+                events.append(
+                    common
+                    | {
+                        "name": f"$run {run.program}",
+                        "ph": "b",
+                        "ts": micros(run.start),
+                        "args": {"cached": run.cached},
+                    }
+                )
+                events.append(
+                    common
+                    | {
+                        "name": f"$run {run.program}",
+                        "ph": "e",
+                        "ts": micros(run.end),
+                    }
+                )
+            events.append(
+                common
+                | {
+                    "name": record.path,
+                    "ph": "e",
+                    "ts": micros(record.end),
+                }
+            )
+        return events
+
+    def write_report(self, path: Path) -> None:
+        """Write the report returned by `report` to `path` as JSON."""
+        with open(path, "w", encoding="utf-8") as fh:
+            json.dump(self.report(), fh, indent=1)
+
+    def write_trace(self, path: Path) -> None:
+        """Write the trace returned by `trace_events` to `path`."""
+        with open(path, "w", encoding="utf-8") as fh:
+            json.dump({"traceEvents": self.trace_events()}, fh)
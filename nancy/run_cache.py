@@ -0,0 +1,204 @@
+"""Cache of the output of programs run by `$run`.
+
+© Reuben Thomas <rrt@sc3d.org> 2026.
+
+Released under the GPL version 3, or (at your option) any later version.
+"""
+
+import asyncio
+import hashlib
+import os
+from collections import OrderedDict
+from pathlib import Path
+
+from . import log
+
+
+# Default maximum total size of the outputs kept in memory by a `RunCache`.
+RUN_CACHE_SIZE = 64 * 1024 * 1024
+
+# Default maximum total size of the outputs kept in a `RunCache`'s directory.
+RUN_CACHE_DIRECTORY_SIZE = 1024 * 1024 * 1024
+
+
+class RunCache:
+    """The output of programs run by `$run`.
+
+    Outputs are keyed on everything that can affect them: the program file
+    and its signature, its arguments and standard input, and `NANCY_INPUT`.
+
+    The outputs kept in memory, and those kept in `directory`, are bounded
+    by total size; the least-recently used are removed first. Outputs are
+    removed from `directory` by `prune`.
+
+    Fields:
+        directory (Path | None): the directory in which outputs are stored
+            between invocations of Nancy; if `None`, outputs are only kept in
+            memory
+        impure (set[str]): programs whose output must never be cached, given
+            as the name passed to `$run` or the name of the program file
+        max_size (int): the maximum total size of the outputs kept in memory
+        max_directory_size (int): the maximum total size of the outputs kept
+            in `directory`
+        size (int): the total size of the outputs kept in memory
+        hits (int): the number of runs satisfied from the cache
+        misses (int): the number of runs not found in the cache
+    """
+
+    directory: Path | None
+    impure: set[str]
+    max_size: int
+    max_directory_size: int
+    size: int
+    hits: int
+    misses: int
+    _outputs: OrderedDict[str, bytes]
+    _pending: dict[str, asyncio.Future[bytes]]
+
+    def __init__(
+        self,
+        directory: Path | None = None,
+        impure: set[str] | None = None,
+        max_size: int = RUN_CACHE_SIZE,
+        max_directory_size: int = RUN_CACHE_DIRECTORY_SIZE,
+    ):
+        self.directory = directory
+        self.impure = set() if impure is None else impure
+        self.max_size = max_size
+        self.max_directory_size = max_directory_size
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._outputs = OrderedDict()
+        self._pending = {}
+
+    def key(
+        self,
+        name: bytes,
+        exe_path: Path,
+        args: list[bytes],
+        input: bytes | None,
+        nancy_input: str,
+    ) -> str | None:
+        """Compute the cache key for a run of a program.
+
+        Args:
+            name (bytes): the program name given to `$run`
+            exe_path (Path): the `Path` of the program found
+            args (list[bytes]): the arguments to the program
+            input (bytes | None): the program's standard input, if any
+            nancy_input (str): the value of `NANCY_INPUT` for the program
+
+        Returns:
+            str | None: the key, or `None` if the program is impure
+        """
+        if os.fsdecode(name) in self.impure or exe_path.name in self.impure:
+            return None
+        exe_path = exe_path.resolve(strict=True)
+        stats = os.stat(exe_path)
+        h = hashlib.blake2b(digest_size=20)
+        parts = [
+            os.fsencode(exe_path),
+            f"{stats.st_mtime_ns} {stats.st_size}".encode(),
+            os.fsencode(nancy_input),
+            *args,
+        ]
+        if input is not None:
+            parts.append(input)
+        h.update(f"{len(args)} {input is not None}".encode())
+        for part in parts:
+            h.update(len(part).to_bytes(8))
+            h.update(part)
+        return h.hexdigest()
+
+    def _file(self, key: str) -> Path:
+        assert self.directory is not None
+        return self.directory / key[:2] / key[2:]
+
+    def get(self, key: str) -> asyncio.Future[bytes] | bytes | None:
+        """Return the cached output for `key`, if any.
+
+        If the program is still running, return its future output.
+        """
+        output: asyncio.Future[bytes] | bytes | None = self._outputs.get(key)
+        if output is not None:
+            self._outputs.move_to_end(key)
+        else:
+            output = self._pending.get(key)
+        if output is None and self.directory is not None:
+            try:
+                file = self._file(key)
+                output = file.read_bytes()
+                # Mark the file as recently used, for `prune`.
+                os.utime(file)
+                self._remember(key, output)
+            except FileNotFoundError:
+                pass
+        if output is None:
+            self.misses += 1
+        else:
+            if log.run.enabled:
+                log.run(f"Using cached output for run {key}")
+            self.hits += 1
+        return output
+
+    def start(self, key: str, output: asyncio.Future[bytes]) -> None:
+        """Record a running program.
+
+        Its output is stored for `key` when it has finished successfully.
+        """
+        self._pending[key] = output
+
+        def finished(output: asyncio.Future[bytes]) -> None:
+            del self._pending[key]
+            if not output.cancelled() and output.exception() is None:
+                self.put(key, output.result())
+
+        output.add_done_callback(finished)
+
+    def put(self, key: str, output: bytes) -> None:
+        """Store the output for `key`."""
+        self._remember(key, output)
+        if self.directory is not None:
+            file = self._file(key)
+            file.parent.mkdir(parents=True, exist_ok=True)
+            tmp_file = file.with_name(f"{file.name}.{os.getpid()}.tmp")
+            tmp_file.write_bytes(output)
+            os.replace(tmp_file, file)
+
+    def _remember(self, key: str, output: bytes) -> None:
+        if len(output) > self.max_size:
+            return
+        old_output = self._outputs.pop(key, None)
+        if old_output is not None:
+            self.size -= len(old_output)
+        self._outputs[key] = output
+        self.size += len(output)
+        while self.size > self.max_size:
+            self.size -= len(self._outputs.popitem(last=False)[1])
+
+    def prune(self) -> None:
+        """Remove the least-recently used outputs from `directory`.
+
+        Outputs are removed until their total size is at most
+        `max_directory_size`.
+        """
+        if self.directory is None:
+            return
+        files = []
+        for file in self.directory.glob("*/*"):
+            if file.suffix == ".tmp":
+                continue  # Another process is writing it.
+            try:
+                stats = file.stat()
+            except FileNotFoundError:
+                continue
+            files.append((stats.st_mtime_ns, stats.st_size, file))
+        size = sum(file_size for _, file_size, _ in files)
+        for _, file_size, file in sorted(files):
+            if size <= self.max_directory_size:
+                break
+            if log.run.enabled:
+                log.run(f"Removing cached output '{file}'")
+            file.unlink(missing_ok=True)
+            size -= file_size
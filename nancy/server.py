@@ -0,0 +1,219 @@
+"""Persistent co-processes for `$run`.
+
+A program that supports the server protocol is started once, and then
+handles every `$run` of that program, avoiding the cost of starting it
+each time.
+
+The program is started with no arguments and the environment variable
+`NANCY_SERVER` set. It declares its support for the protocol by writing
+`SERVER_HANDSHAKE` to standard output. It then repeatedly reads a request
+from standard input and writes a response to standard output, until its
+standard input is closed.
+
+Numbers are 4-byte unsigned big-endian integers, and a string is a number
+giving its length followed by that many bytes.
+
+A request consists of the number of arguments, followed by each argument
+as a string, followed by 1 and the input as a string if there is an input,
+or 0 if not.
+
+A response consists of the exit status, followed by the output and the
+error output as strings.
+
+© Reuben Thomas <rrt@sc3d.org> 2026.
+
+Released under the GPL version 3, or (at your option) any later version.
+"""
+
+import asyncio
+import os
+from asyncio.subprocess import Process
+from pathlib import Path
+
+from . import log
+
+
+SERVER_HANDSHAKE = b"nancy-server 1\n"
+
+# Time in seconds to wait for a server to declare support for the protocol.
+HANDSHAKE_TIMEOUT = 10
+
+
+def pack(data: bytes) -> bytes:
+    """Encode `data` as a protocol string."""
+    return len(data).to_bytes(4) + data
+
+
+class ServerCrashed(Exception):
+    pass
+
+
+class CoProcess:
+    """A running server.
+
+    Fields:
+        exe_path (Path): the `Path` of the program
+        process (Process | None): the server process, if running
+        lock (asyncio.Lock): held while a request is in progress
+    """
+
+    exe_path: Path
+    process: Process | None
+    lock: asyncio.Lock
+
+    def __init__(self, exe_path: Path):
+        self.exe_path = exe_path
+        self.process = None
+        self.lock = asyncio.Lock()
+
+    async def start(self, env: dict[str, str]) -> bool:
+        """Start the server.
+
+        Args:
+            env (dict[str, str]): the server's environment
+
+        Returns:
+            bool: `True` if the program declared support for the protocol
+        """
+        if log.run.enabled:
+            log.run(f"Starting server {self.exe_path}")
+        self.process = await asyncio.create_subprocess_exec(
+            self.exe_path.resolve(strict=True),
+            stdin=asyncio.subprocess.PIPE,
+            stdout=asyncio.subprocess.PIPE,
+            env=env | {"NANCY_SERVER": "1"},
+        )
+        assert self.process.stdout is not None
+        try:
+            async with asyncio.timeout(HANDSHAKE_TIMEOUT):
+                handshake = await self.process.stdout.readline()
+        except TimeoutError:
+            handshake = b""
+        if handshake != SERVER_HANDSHAKE:
+            if log.run.enabled:
+                log.run(f"{self.exe_path} does not support the server protocol")
+            await self.kill()
+            return False
+        return True
+
+    async def request(
+        self, args: list[bytes], input: bytes | None
+    ) -> tuple[int, bytes, bytes]:
+        """Send a request to the server, and return its response.
+
+        Raises `ServerCrashed` if the server does not respond.
+        """
+        assert self.process is not None
+        assert self.process.stdin is not None
+        assert self.process.stdout is not None
+        request = [len(args).to_bytes(4)] + [pack(a) for a in args]
+        if input is None:
+            request.append((0).to_bytes(4))
+        else:
+            request += [(1).to_bytes(4), pack(input)]
+        try:
+            self.process.stdin.writelines(request)
+            await self.process.stdin.drain()
+            stdout = self.process.stdout
+            status = int.from_bytes(await stdout.readexactly(4))
+            output = await stdout.readexactly(
+                int.from_bytes(await stdout.readexactly(4))
+            )
+            error = await stdout.readexactly(
+                int.from_bytes(await stdout.readexactly(4))
+            )
+        except (asyncio.IncompleteReadError, BrokenPipeError, ConnectionResetError):
+            await self.kill()
+            raise ServerCrashed() from None
+        return status, output, error
+
+    async def kill(self) -> None:
+        """Kill the server, if running."""
+        if self.process is not None:
+            if self.process.returncode is None:
+                self.process.kill()
+            await self.process.wait()
+            self.process = None
+
+    async def stop(self) -> None:
+        """Stop the server by closing its input."""
+        if self.process is not None:
+            assert self.process.stdin is not None
+            self.process.stdin.close()
+            await self.process.wait()
+            self.process = None
+
+
+class Servers:
+    """The servers used by `$run`.
+
+    Fields:
+        names (set[str]): programs that may be run as servers, given as the
+            name passed to `$run` or the name of the program file
+    """
+
+    names: set[str]
+    _servers: dict[Path, CoProcess | None]
+
+    def __init__(self, names: set[str]):
+        self.names = names
+        self._servers = {}
+
+    def wants(self, name: bytes, exe_path: Path) -> bool:
+        """Return `True` if the program should be run as a server."""
+        return (
+            os.fsdecode(name) in self.names or exe_path.name in self.names
+        ) and self._servers.get(exe_path, True) is not None
+
+    async def run(
+        self,
+        exe_path: Path,
+        args: list[bytes],
+        input: bytes | None,
+        timeout: float | None,
+        env: dict[str, str] | None = None,
+    ) -> tuple[int, bytes, bytes] | None:
+        """Run a program as a server, starting it if necessary.
+
+        Args:
+            exe_path (Path): `Path` of the program
+            args (list[bytes]): arguments to the program
+            input (Optional[bytes]): the program's input
+            timeout (float | None): the maximum time in seconds to wait for
+                the response
+            env (dict[str, str] | None): the environment with which to start
+                the program; if `None`, Nancy's own
+
+        Returns:
+            tuple[int, bytes, bytes] | None: the exit status, output and error
+                output, or `None` if the program does not support the server
+                protocol
+        """
+        server = self._servers.get(exe_path)
+        if server is None:
+            server = CoProcess(exe_path)
+            self._servers[exe_path] = server
+        async with server.lock:
+            for attempt in range(2):
+                if server.process is None and not await server.start(
+                    dict(os.environ) if env is None else env
+                ):
+                    self._servers[exe_path] = None
+                    return None
+                try:
+                    async with asyncio.timeout(timeout):
+                        return await server.request(args, input)
+                except TimeoutError:
+                    await server.kill()
+                    raise
+                except ServerCrashed:
+                    if log.run.enabled:
+                        log.run(f"Server {exe_path} crashed (attempt {attempt + 1})")
+        raise ValueError(f"server {exe_path} crashed")
+
+    async def stop(self) -> None:
+        """Stop all the servers."""
+        for server in self._servers.values():
+            if server is not None:
+                await server.stop()
+        self._servers = {}
@@ -0,0 +1,828 @@
+"""Storage of the input and output trees.
+
+The input tree is read from `Store`s, and the output is written to an
+`OutputStore`. Each store is mounted at a `root` `Path`, and its methods
+take `Path`s under that root, so that the rest of Nancy names files in
+the same way whatever holds them: a file `page.html` in an input archive
+`site.zip` is `site.zip/page.html`.
+
+Besides directories, inputs may be zip and tar archives, trees in a git
+repository, and files held in memory; outputs may be zip and tar archives,
+and memory.
+
+© Reuben Thomas <rrt@sc3d.org> 2026.
+
+Released under the GPL version 3, or (at your option) any later version.
+"""
+
+import atexit
+import errno
+import io
+import os
+import shutil
+import stat
+import subprocess
+import tarfile
+import tempfile
+import threading
+import time
+import zipfile
+from abc import ABC, abstractmethod
+from collections.abc import Mapping
+from enum import Enum
+from pathlib import Path
+from typing import IO, Any
+
+from . import log
+from .database import contents_digest, file_digest
+from .link import unshare
+
+
+umask = os.umask(0)
+os.umask(umask)
+
+# Suffixes of tar archives, with the compression each implies.
+TAR_SUFFIXES = {
+    ".tar": "",
+    ".tar.gz": "gz",
+    ".tgz": "gz",
+    ".tar.bz2": "bz2",
+    ".tbz2": "bz2",
+    ".tar.xz": "xz",
+    ".txz": "xz",
+}
+
+# Separates a git repository from a revision in an input path.
+GIT_REVISION_SEPARATOR = "#"
+
+# Maximum number of symbolic links followed when resolving a path in an
+# archive.
+MAX_SYMLINKS = 40
+
+
+class ObjectKind(Enum):
+    """The kind of an object in the input tree."""
+
+    FILE = 1
+    DIRECTORY = 2
+    OTHER = 3
+
+
+def entry_kind(entry: os.DirEntry[str]) -> ObjectKind | None:
+    """Classify a directory entry, following symbolic links.
+
+    Returns:
+        ObjectKind | None: `None` if `entry` is a dangling symbolic link
+    """
+    if entry.is_dir():
+        return ObjectKind.DIRECTORY
+    if entry.is_file():
+        return ObjectKind.FILE
+    if entry.is_symlink() and not os.path.exists(entry.path):
+        return None
+    return ObjectKind.OTHER
+
+
+def make_stat(mode: int, size: int, mtime_ns: int) -> os.stat_result:
+    """Make the status of a file that is not in the filesystem."""
+    mtime = mtime_ns / 1e9
+    return os.stat_result(
+        (mode, 0, 0, 1, 0, 0, size, mtime, mtime, mtime),
+        {"st_atime_ns": mtime_ns, "st_mtime_ns": mtime_ns, "st_ctime_ns": mtime_ns},
+    )
+
+
+def archive_format(path: Path) -> str | None:
+    """Return the kind of archive named by `path`, if any.
+
+    Returns:
+        str | None: `"zip"`, `"tar"`, or `None` if `path` does not have the
+            suffix of an archive
+    """
+    name = path.name.lower()
+    if name.endswith(".zip"):
+        return "zip"
+    if any(name.endswith(suffix) for suffix in TAR_SUFFIXES):
+        return "tar"
+    return None
+
+
+def tar_compression(path: Path) -> str:
+    """Return the compression of the tar archive `path`, as for `tarfile`."""
+    name = path.name.lower()
+    for suffix, compression in TAR_SUFFIXES.items():
+        if name.endswith(suffix) and suffix != ".tar":
+            return compression
+    return ""
+
+
+class Store(ABC):
+    """A read-only tree of input files.
+
+    Fields:
+        root (Path): the `Path` at which the tree is mounted
+    """
+
+    root: Path
+
+    def __init__(self, root: Path):
+        self.root = root
+
+    @abstractmethod
+    def scandir(self, path: Path) -> dict[str, ObjectKind]:
+        """Return the kind of each entry in the directory `path`.
+
+        Dangling symbolic links are omitted. Raises `FileNotFoundError` if
+        `path` does not exist, and `NotADirectoryError` if it is not a
+        directory.
+        """
+
+    @abstractmethod
+    def stat(self, path: Path) -> os.stat_result:
+        """Return the status of `path`, following symbolic links."""
+
+    @abstractmethod
+    def read_bytes(self, path: Path) -> bytes:
+        """Return the contents of the file `path`."""
+
+    def digest(self, path: Path) -> str:
+        """Compute a digest of the contents of the file `path`."""
+        return contents_digest(self.read_bytes(path))
+
+    @abstractmethod
+    def local_path(self, path: Path) -> Path:
+        """Return a filesystem `Path` with the contents of the file `path`.
+
+        This is used to run programs in the input tree.
+        """
+
+
+class LocalStore(Store):
+    """A directory in the filesystem."""
+
+    def scandir(self, path: Path) -> dict[str, ObjectKind]:
+        entries = {}
+        with os.scandir(path) as it:
+            for entry in it:
+                kind = entry_kind(entry)
+                if kind is not None:
+                    entries[entry.name] = kind
+        return entries
+
+    def stat(self, path: Path) -> os.stat_result:
+        return os.stat(path)
+
+    def read_bytes(self, path: Path) -> bytes:
+        return path.read_bytes()
+
+    def digest(self, path: Path) -> str:
+        return file_digest(path)
+
+    def local_path(self, path: Path) -> Path:
+        return path
+
+
+# The `Store` of files outside every input.
+LOCAL_STORE = LocalStore(Path())
+
+
+class IndexedStore(Store):
+    """A tree of files that is not in the filesystem.
+
+    The tree is indexed when the store is made. Subclasses add its objects
+    with `_add` and `_add_link`, and read files with `_read`. Files needed
+    by `local_path` are extracted to a temporary directory, which is
+    removed on exit.
+
+    Stores may be used from several threads, and pickled to send them to
+    worker processes.
+    """
+
+    _dirs: dict[Path, dict[str, ObjectKind]]
+    _stats: dict[Path, os.stat_result]
+    _links: dict[Path, Path | None]
+    _dir_stat: os.stat_result
+    _local_dir: Path | None
+    _lock: threading.RLock
+
+    def __init__(self, root: Path, mtime_ns: int):
+        super().__init__(root)
+        self._dir_stat = make_stat(stat.S_IFDIR | 0o755, 0, mtime_ns)
+        self._dirs = {Path(): {}}
+        self._stats = {Path(): self._dir_stat}
+        self._links = {}
+        self._local_dir = None
+        self._lock = threading.RLock()
+
+    def __getstate__(self) -> dict[str, Any]:
+        state = self.__dict__.copy()
+        del state["_lock"]
+        state["_local_dir"] = None
+        return state
+
+    def __setstate__(self, state: dict[str, Any]) -> None:
+        self.__dict__.update(state)
+        self._lock = threading.RLock()
+
+    def _relative(self, path: Path) -> Path:
+        try:
+            return Path(os.path.abspath(path)).relative_to(os.path.abspath(self.root))
+        except ValueError:
+            raise FileNotFoundError(
+                errno.ENOENT, os.strerror(errno.ENOENT), str(path)
+            ) from None
+
+    def _add_parents(self, rel: Path) -> None:
+        parent = rel.parent
+        if parent not in self._dirs:
+            self._add_parents(parent)
+            self._dirs[parent.parent][parent.name] = ObjectKind.DIRECTORY
+            self._dirs[parent] = {}
+            self._stats[parent] = self._dir_stat
+
+    def _add(self, rel: Path, kind: ObjectKind, stats: os.stat_result) -> None:
+        """Add the object `rel` to the index."""
+        if rel == Path():
+            return
+        self._add_parents(rel)
+        self._dirs[rel.parent][rel.name] = kind
+        self._stats[rel] = stats
+        if kind == ObjectKind.DIRECTORY:
+            self._dirs.setdefault(rel, {})
+
+    def _add_link(self, rel: Path, target: Path | None) -> None:
+        """Add the symbolic link `rel` to `target`, relative to the root.
+
+        The link must be resolved by `_resolve_links` once the tree is
+        indexed. A `target` of `None` is outside the tree.
+        """
+        self._add_parents(rel)
+        self._dirs[rel.parent][rel.name] = ObjectKind.OTHER
+        self._links[rel] = target
+
+    def _resolve_links(self) -> None:
+        """Give each symbolic link the kind of its target."""
+        for link in self._links:
+            try:
+                kind = self._kind(self._real(link))
+            except OSError:
+                kind = None
+            if kind is None:
+                del self._dirs[link.parent][link.name]
+            else:
+                self._dirs[link.parent][link.name] = kind
+
+    def _kind(self, rel: Path) -> ObjectKind | None:
+        if rel in self._dirs:
+            return ObjectKind.DIRECTORY
+        if rel in self._stats:
+            return ObjectKind.FILE
+        return None
+
+    def _real(self, rel: Path) -> Path:
+        """Resolve the symbolic links in `rel`."""
+        real = Path()
+        for part in rel.parts:
+            real = Path(os.path.normpath(real / part))
+            for _ in range(MAX_SYMLINKS):
+                if real not in self._links:
+                    break
+                target = self._links[real]
+                if target is None:
+                    raise FileNotFoundError(
+                        errno.ENOENT, os.strerror(errno.ENOENT), str(rel)
+                    )
+                real = target
+            else:
+                raise OSError(errno.ELOOP, os.strerror(errno.ELOOP), str(rel))
+        return real
+
+    def _lookup(self, path: Path) -> Path:
+        rel = self._real(self._relative(path))
+        if rel not in self._stats:
+            raise FileNotFoundError(errno.ENOENT, os.strerror(errno.ENOENT), str(path))
+        return rel
+
+    def scandir(self, path: Path) -> dict[str, ObjectKind]:
+        rel = self._lookup(path)
+        entries = self._dirs.get(rel)
+        if entries is None:
+            raise NotADirectoryError(
+                errno.ENOTDIR, os.strerror(errno.ENOTDIR), str(path)
+            )
+        return dict(entries)
+
+    def stat(self, path: Path) -> os.stat_result:
+        return self._stats[self._lookup(path)]
+
+    def read_bytes(self, path: Path) -> bytes:
+        rel = self._lookup(path)
+        if rel in self._dirs:
+            raise IsADirectoryError(errno.EISDIR, os.strerror(errno.EISDIR), str(path))
+        return self._read(rel)
+
+    @abstractmethod
+    def _read(self, rel: Path) -> bytes:
+        """Read the file `rel`, which has no symbolic links."""
+
+    def local_path(self, path: Path) -> Path:
+        rel = self._lookup(path)
+        with self._lock:
+            if self._local_dir is None:
+                self._local_dir = Path(tempfile.mkdtemp(prefix="nancy-"))
+                atexit.register(shutil.rmtree, self._local_dir, True)
+            local = self._local_dir / rel
+            if not local.exists():
+                if log.io.enabled:
+                    log.io(f"Extracting '{path}' to '{local}'")
+                local.parent.mkdir(parents=True, exist_ok=True)
+                local.write_bytes(self._read(rel))
+                os.chmod(local, stat.S_IMODE(self._stats[rel].st_mode))
+        return local
+
+
+class MemoryStore(IndexedStore):
+    """A tree of files held in memory.
+
+    Files may be added and changed with `write`; each write advances the
+    modification times of the file and of any directories it adds to, so
+    that the changes are seen by `Tree`s sharing `Caches`.
+    """
+
+    _contents: dict[Path, bytes]
+    _clock: int
+
+    def __init__(
+        self, files: Mapping[str, bytes] | None = None, root: Path = Path("memory")
+    ):
+        """Make a store.
+
+        Args:
+            files (Mapping[str, bytes] | None): the initial files, by
+                root-relative name
+            root (Path): the `Path` at which the tree is mounted
+        """
+        self._clock = time.time_ns()
+        super().__init__(root, self._clock)
+        self._contents = {}
+        for name, contents in (files or {}).items():
+            self.write(name, contents)
+
+    def write(self, name: str, contents: bytes, mode: int = 0o644) -> None:
+        """Set the contents of a file, adding it if necessary.
+
+        Args:
+            name (str): the root-relative name of the file
+            contents (bytes): the contents of the file
+            mode (int): the permissions of the file
+        """
+        rel = Path(os.path.normpath(name))
+        with self._lock:
+            self._clock = max(self._clock + 1, time.time_ns())
+            if rel not in self._stats:
+                # The nearest existing directory gains an entry.
+                parent = next(p for p in rel.parents if p in self._dirs)
+                self._stats[parent] = make_stat(stat.S_IFDIR | 0o755, 0, self._clock)
+            self._add(
+                rel,
+                ObjectKind.FILE,
+                make_stat(stat.S_IFREG | mode, len(contents), self._clock),
+            )
+            self._contents[rel] = contents
+
+    def _read(self, rel: Path) -> bytes:
+        return self._contents[rel]
+
+
+class ZipStore(IndexedStore):
+    """A zip archive."""
+
+    _zip: zipfile.ZipFile | None
+    _members: dict[Path, str]
+
+    def __init__(self, root: Path):
+        super().__init__(root, os.stat(root).st_mtime_ns)
+        self._members = {}
+        with zipfile.ZipFile(root) as zip:
+            for info in zip.infolist():
+                rel = Path(os.path.normpath(info.filename))
+                mode = info.external_attr >> 16
+                mtime_ns = int(time.mktime((*info.date_time, 0, 0, -1)) * 1e9)
+                if stat.S_ISLNK(mode):
+                    self._add_link(rel, link_target(rel, zip.read(info)))
+                elif info.is_dir():
+                    self._add(
+                        rel,
+                        ObjectKind.DIRECTORY,
+                        make_stat(stat.S_IFDIR | 0o755, 0, mtime_ns),
+                    )
+                else:
+                    self._members[rel] = info.filename
+                    self._add(
+                        rel,
+                        ObjectKind.FILE,
+                        make_stat(
+                            stat.S_IFREG | (stat.S_IMODE(mode) or 0o644),
+                            info.file_size,
+                            mtime_ns,
+                        ),
+                    )
+        self._resolve_links()
+        self._zip = None
+
+    def __getstate__(self) -> dict[str, Any]:
+        state = super().__getstate__()
+        state["_zip"] = None
+        return state
+
+    def _read(self, rel: Path) -> bytes:
+        with self._lock:
+            if self._zip is None:
+                self._zip = zipfile.ZipFile(self.root)
+            return self._zip.read(self._members[rel])
+
+
+class TarStore(IndexedStore):
+    """A tar archive, which may be compressed."""
+
+    _tar: tarfile.TarFile | None
+    _members: dict[Path, str]
+
+    def __init__(self, root: Path):
+        super().__init__(root, os.stat(root).st_mtime_ns)
+        self._members = {}
+        with tarfile.open(root) as tar:
+            for member in tar:
+                rel = Path(os.path.normpath(member.name))
+                if member.issym():
+                    self._add_link(rel, link_target(rel, os.fsencode(member.linkname)))
+                elif member.islnk():
+                    self._add_link(
+                        rel, link_target(Path("_"), os.fsencode(member.linkname))
+                    )
+                else:
+                    mtime_ns = int(member.mtime * 1e9)
+                    if member.isdir():
+                        kind = ObjectKind.DIRECTORY
+                        mode = stat.S_IFDIR | member.mode
+                    elif member.isfile():
+                        kind = ObjectKind.FILE
+                        mode = stat.S_IFREG | member.mode
+                        self._members[rel] = member.name
+                    else:
+                        kind = ObjectKind.OTHER
+                        mode = member.mode
+                    self._add(rel, kind, make_stat(mode, member.size, mtime_ns))
+        self._resolve_links()
+        self._tar = None
+
+    def __getstate__(self) -> dict[str, Any]:
+        state = super().__getstate__()
+        state["_tar"] = None
+        return state
+
+    def _read(self, rel: Path) -> bytes:
+        with self._lock:
+            if self._tar is None:
+                self._tar = tarfile.open(self.root)
+            fh = self._tar.extractfile(self._members[rel])
+            assert fh is not None
+            return fh.read()
+
+
+class GitStore(IndexedStore):
+    """A tree in a git repository, read with the `git` command.
+
+    Every object has the modification time of the commit.
+
+    Fields:
+        repository (Path): the repository, or a directory in its work tree
+        revision (str): the commit or tree to read
+    """
+
+    repository: Path
+    revision: str
+    _objects: dict[Path, str]
+
+    def __init__(self, repository: Path, revision: str):
+        self.repository = repository
+        self.revision = revision
+        commit_time = self._git("log", "-1", "--format=%ct", revision, "--").strip()
+        super().__init__(
+            Path(f"{repository}{GIT_REVISION_SEPARATOR}{revision}"),
+            int(commit_time or 0) * 1_000_000_000,
+        )
+        self._objects = {}
+        listing = self._git("ls-tree", "-r", "-t", "-l", "-z", "--full-tree", revision)
+        for line in listing.split(b"\0"):
+            if line == b"":
+                continue
+            info, name = line.split(b"\t", 1)
+            mode_str, object_type, object_id, size = info.split()
+            mode = int(mode_str, 8)
+            rel = Path(os.fsdecode(name))
+            if object_type == b"tree":
+                self._add(rel, ObjectKind.DIRECTORY, self._dir_stat)
+            elif object_type == b"blob" and stat.S_ISLNK(mode):
+                target = self._git("cat-file", "blob", object_id)
+                self._add_link(rel, link_target(rel, target))
+            elif object_type == b"blob":
+                self._objects[rel] = object_id.decode()
+                self._add(
+                    rel,
+                    ObjectKind.FILE,
+                    make_stat(mode, int(size), self._dir_stat.st_mtime_ns),
+                )
+        self._resolve_links()
+
+    def _git(self, *args: str | bytes) -> bytes:
+        result = subprocess.run(
+            ["git", "-C", self.repository, *args], capture_output=True
+        )
+        if result.returncode != 0:
+            raise ValueError(
+                f"cannot read '{self.revision}' in git repository '{self.repository}': {os.fsdecode(result.stderr).strip()}"
+            )
+        return result.stdout
+
+    def _read(self, rel: Path) -> bytes:
+        return self._git("cat-file", "blob", self._objects[rel])
+
+
+def link_target(rel: Path, target: bytes) -> Path | None:
+    """Return the root-relative target of the symbolic link `rel`.
+
+    Returns:
+        Path | None: `None` if the target is outside the tree
+    """
+    target_path = Path(os.fsdecode(target))
+    if target_path.is_absolute():
+        return None
+    resolved = Path(os.path.normpath(rel.parent / target_path))
+    if resolved.parts[:1] == ("..",):
+        return None
+    return resolved
+
+
+def open_store(path: Path) -> Store:
+    """Open the input `path`.
+
+    Args:
+        path (Path): a directory, an archive with a suffix that
+            `archive_format` recognizes, or `REPOSITORY#REVISION`, naming a
+            revision in a git repository
+
+    Returns:
+        Store
+    """
+    if path.is_dir():
+        return LocalStore(path)
+    if path.is_file():
+        format = archive_format(path)
+        if format == "zip":
+            return ZipStore(path)
+        if format == "tar":
+            return TarStore(path)
+        raise ValueError(f"input '{path}' is not a directory")
+    repository, separator, revision = str(path).rpartition(GIT_REVISION_SEPARATOR)
+    if separator != "" and Path(repository).is_dir():
+        return GitStore(Path(repository), revision)
+    raise ValueError(f"input '{path}' does not exist")
+
+
+class OutputStore(ABC):
+    """Where the output tree is written.
+
+    A file is written by opening it with `open`, writing to the handle
+    returned, and then finishing it with `commit`, or, if it could not be
+    written, with `discard`.
+
+    Fields:
+        root (Path): the `Path` at which the tree is mounted
+    """
+
+    root: Path
+
+    def __init__(self, root: Path):
+        self.root = root
+
+    @abstractmethod
+    def makedirs(self, path: Path) -> None:
+        """Make the directory `path`, and any missing parents."""
+
+    @abstractmethod
+    def open(self, path: Path, exe_perms: int) -> IO[bytes]:
+        """Open the file `path` for writing.
+
+        Args:
+            path (Path): the file to write
+            exe_perms (int): execute permissions to add to the file's mode
+        """
+
+    @abstractmethod
+    def commit(self, path: Path, fh: IO[bytes]) -> None:
+        """Close `fh`, opened by `open`, completing the file `path`."""
+
+    @abstractmethod
+    def discard(self, path: Path, fh: IO[bytes]) -> None:
+        """Close `fh`, opened by `open`, and remove the file `path`."""
+
+    def close(self) -> None:
+        """Finish writing the output."""
+
+
+class LocalOutput(OutputStore):
+    """A directory in the filesystem."""
+
+    def makedirs(self, path: Path) -> None:
+        os.makedirs(path, exist_ok=True)
+
+    def open(self, path: Path, exe_perms: int) -> IO[bytes]:
+        unshare(path)
+        fh = open(path, "wb")
+        if exe_perms != 0:
+            os.chmod(path, os.stat(path).st_mode | exe_perms)
+        return fh
+
+    def commit(self, path: Path, fh: IO[bytes]) -> None:
+        try:
+            fh.close()
+        except BaseException:
+            # Do not leave a partial file that looks up to date.
+            path.unlink(missing_ok=True)
+            raise
+
+    def discard(self, path: Path, fh: IO[bytes]) -> None:
+        try:
+            fh.close()
+        finally:
+            path.unlink(missing_ok=True)
+
+
+class OutputFile(io.BytesIO):
+    """A file being written to a `BufferedOutput`.
+
+    Fields:
+        mode (int): the mode of the file
+    """
+
+    mode: int
+
+    def __init__(self, mode: int):
+        super().__init__()
+        self.mode = mode
+
+
+class BufferedOutput(OutputStore):
+    """An output tree that is not in the filesystem.
+
+    Each file is held in memory until it is committed. Subclasses store
+    directories and files with `_add_dir` and `_add_file`. The store may be
+    used from several threads.
+
+    Fields:
+        dirs (set[Path]): the root-relative directories made
+    """
+
+    dirs: set[Path]
+    _lock: threading.Lock
+
+    def __init__(self, root: Path):
+        super().__init__(root)
+        self.dirs = {Path()}
+        self._lock = threading.Lock()
+
+    def _relative(self, path: Path) -> Path:
+        return Path(os.path.normpath(path)).relative_to(os.path.normpath(self.root))
+
+    def makedirs(self, path: Path) -> None:
+        rel = self._relative(path)
+        with self._lock:
+            for dir in (*reversed(rel.parents), rel):
+                if dir not in self.dirs:
+                    self.dirs.add(dir)
+                    self._add_dir(dir)
+
+    def open(self, path: Path, exe_perms: int) -> IO[bytes]:
+        return OutputFile(stat.S_IFREG | (0o666 & ~umask) | exe_perms)
+
+    def commit(self, path: Path, fh: IO[bytes]) -> None:
+        assert isinstance(fh, OutputFile)
+        with self._lock:
+            self._add_file(self._relative(path), fh.getvalue(), fh.mode)
+        fh.close()
+
+    def discard(self, path: Path, fh: IO[bytes]) -> None:
+        fh.close()
+
+    @abstractmethod
+    def _add_dir(self, rel: Path) -> None:
+        """Store the root-relative directory `rel`."""
+
+    @abstractmethod
+    def _add_file(self, rel: Path, contents: bytes, mode: int) -> None:
+        """Store the root-relative file `rel`."""
+
+
+class MemoryOutput(BufferedOutput):
+    """An output tree held in memory.
+
+    Fields:
+        files (dict[Path, bytes]): the contents of each root-relative file
+        modes (dict[Path, int]): the mode of each root-relative file
+    """
+
+    files: dict[Path, bytes]
+    modes: dict[Path, int]
+
+    def __init__(self, root: Path = Path("memory")):
+        super().__init__(root)
+        self.files = {}
+        self.modes = {}
+
+    def _add_dir(self, rel: Path) -> None:
+        pass
+
+    def _add_file(self, rel: Path, contents: bytes, mode: int) -> None:
+        self.files[rel] = contents
+        self.modes[rel] = mode
+
+
+class ZipOutput(BufferedOutput):
+    """A zip archive, written when the first file is added."""
+
+    _zip: zipfile.ZipFile | None
+
+    def __init__(self, root: Path):
+        super().__init__(root)
+        self._zip = None
+
+    def _archive(self) -> zipfile.ZipFile:
+        if self._zip is None:
+            self._zip = zipfile.ZipFile(self.root, "w", zipfile.ZIP_DEFLATED)
+        return self._zip
+
+    def _add_dir(self, rel: Path) -> None:
+        info = zipfile.ZipInfo(f"{rel.as_posix()}/", time.localtime()[:6])
+        info.external_attr = (stat.S_IFDIR | 0o755) << 16 | 0x10
+        self._archive().writestr(info, b"")
+
+    def _add_file(self, rel: Path, contents: bytes, mode: int) -> None:
+        info = zipfile.ZipInfo(rel.as_posix(), time.localtime()[:6])
+        info.external_attr = mode << 16
+        info.compress_type = zipfile.ZIP_DEFLATED
+        self._archive().writestr(info, contents)
+
+    def close(self) -> None:
+        self._archive().close()
+
+
+class TarOutput(BufferedOutput):
+    """A tar archive, written when the first file is added.
+
+    The archive is compressed according to its suffix.
+    """
+
+    _tar: tarfile.TarFile | None
+
+    def __init__(self, root: Path):
+        super().__init__(root)
+        self._tar = None
+
+    def _archive(self) -> tarfile.TarFile:
+        if self._tar is None:
+            self._tar = tarfile.open(self.root, f"w:{tar_compression(self.root)}")
+        return self._tar
+
+    def _add_dir(self, rel: Path) -> None:
+        info = tarfile.TarInfo(rel.as_posix())
+        info.type = tarfile.DIRTYPE
+        info.mode = 0o755
+        info.mtime = int(time.time())
+        self._archive().addfile(info)
+
+    def _add_file(self, rel: Path, contents: bytes, mode: int) -> None:
+        info = tarfile.TarInfo(rel.as_posix())
+        info.size = len(contents)
+        info.mode = stat.S_IMODE(mode)
+        info.mtime = int(time.time())
+        self._archive().addfile(info, io.BytesIO(contents))
+
+    def close(self) -> None:
+        self._archive().close()
+
+
+def open_output(path: Path) -> OutputStore:
+    """Open the output `path`.
+
+    The output is an archive if `archive_format` recognizes `path`, unless
+    it is an existing directory, and otherwise a directory.
+    """
+    if path.is_dir():
+        return LocalOutput(path)
+    format = archive_format(path)
+    if format == "zip":
+        return ZipOutput(path)
+    if format == "tar":
+        return TarOutput(path)
+    return LocalOutput(path)
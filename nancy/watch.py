@@ -0,0 +1,129 @@
+"""Watching the input tree for changes, for `--watch`.
+
+The tree is polled: each poll records the signature of every file, and
+compares it with the previous poll.
+
+© Reuben Thomas <rrt@sc3d.org> 2026.
+
+Released under the GPL version 3, or (at your option) any later version.
+"""
+
+import asyncio
+import os
+from collections.abc import AsyncIterator, Callable, Iterable
+from dataclasses import dataclass
+from pathlib import Path
+
+from . import log
+
+
+# Default time in seconds between polls of the input tree. Each poll scans
+# the whole tree, so this should not be too short.
+WATCH_INTERVAL = 1.0
+
+type Snapshot = dict[Path, tuple[int, int]]
+
+
+@dataclass
+class Changes:
+    """The files that changed between two polls.
+
+    Fields:
+        modified (set[Path]): files whose signature changed
+        added (set[Path]): files that appeared
+        removed (set[Path]): files that disappeared
+    """
+
+    modified: set[Path]
+    added: set[Path]
+    removed: set[Path]
+
+
+def snapshot(roots: Iterable[Path], extra: Iterable[Path] = ()) -> Snapshot:
+    """Record the (mtime, size) of every file under `roots`, and of `extra`.
+
+    Args:
+        roots (Iterable[Path]): the absolute `Path`s of the directories to
+            scan
+        extra (Iterable[Path]): other absolute `Path`s to check; those that
+            do not exist are omitted
+
+    Returns:
+        Snapshot
+    """
+    files: Snapshot = {}
+    seen: set[tuple[int, int]] = set()
+    dirs = list(roots)
+    while len(dirs) > 0:
+        dir = dirs.pop()
+        try:
+            stats = os.stat(dir)
+            if (stats.st_dev, stats.st_ino) in seen:
+                continue  # A symlink loop.
+            seen.add((stats.st_dev, stats.st_ino))
+            with os.scandir(dir) as it:
+                for entry in it:
+                    if entry.is_dir():
+                        dirs.append(Path(entry.path))
+                    elif entry.is_file():
+                        stats = entry.stat()
+                        files[Path(entry.path)] = (stats.st_mtime_ns, stats.st_size)
+        except (FileNotFoundError, NotADirectoryError):
+            # Removed while scanning; any files missed will be found next time.
+            pass
+    for path in extra:
+        if path not in files:
+            try:
+                stats = os.stat(path)
+                files[path] = (stats.st_mtime_ns, stats.st_size)
+            except FileNotFoundError:
+                pass
+    return files
+
+
+def compare(old: Snapshot, new: Snapshot) -> Changes:
+    """Find the differences between two `Snapshot`s."""
+    return Changes(
+        {p for p in old.keys() & new.keys() if old[p] != new[p]},
+        new.keys() - old.keys(),
+        old.keys() - new.keys(),
+    )
+
+
+async def watch_changes(
+    roots: list[Path],
+    start: Snapshot,
+    extra: Callable[[], Iterable[Path]],
+    interval: float = WATCH_INTERVAL,
+) -> AsyncIterator[Changes]:
+    """Yield the changes to `roots` and to `extra()` each time they change.
+
+    Args:
+        roots (list[Path]): the absolute `Path`s of the directories to watch
+        start (Snapshot): a snapshot of `roots`, from which the first
+            changes are found
+        extra (Callable[[], Iterable[Path]]): returns other absolute `Path`s
+            to watch; called before each poll
+        interval (float): the time in seconds between polls
+    """
+
+    def in_roots(path: Path) -> bool:
+        return any(path.is_relative_to(root) for root in roots)
+
+    previous_extra = set(extra())
+    previous = await asyncio.to_thread(snapshot, [], previous_extra) | start
+    while True:
+        await asyncio.sleep(interval)
+        current_extra = set(extra())
+        current = await asyncio.to_thread(snapshot, roots, current_extra)
+        changes = compare(previous, current)
+        # Files that have started or stopped being in `extra` did not change.
+        changes.added = {p for p in changes.added if in_roots(p) or p in previous_extra}
+        changes.removed = {
+            p for p in changes.removed if in_roots(p) or p in current_extra
+        }
+        previous, previous_extra = current, current_extra
+        if changes.modified or changes.added or changes.removed:
+            if log.walk.enabled:
+                log.walk(f"Changes: {changes}")
+            yield changes
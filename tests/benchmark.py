@@ -0,0 +1,268 @@
+"""Nancy benchmarks.
+
+Generates synthetic input trees, builds each with `Tree.process`, and
+reports the throughput and resource use of each build as JSON, so that
+runs can be compared with `--compare`.
+
+Each build runs in a fresh process, so that its peak RSS is its own.
+System call counts are the read and write calls counted by Linux in
+`/proc/self/io`, and are `null` on other systems.
+
+Run with: `python tests/benchmark.py [CONFIG...]`
+
+© Reuben Thomas <rrt@sc3d.org> 2026.
+
+Released under the GPL version 3, or (at your option) any later version.
+"""
+
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import asdict, dataclass, replace
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from typing import Any
+
+from nancy import VERSION, Tree
+
+
+@dataclass(frozen=True)
+class SiteConfig:
+    """The shape of a synthetic input tree.
+
+    Fields:
+        name (str): the name of the configuration
+        pages (int): the number of template files
+        depth (int): the depth of the directories holding the pages
+        fanout (int): the number of files `$include`d by each page
+        runs (int): the number of `$run` calls in each page
+        paste_size (int): the size in bytes of a file `$paste`d by each
+            page, or 0 for none
+        binary_files (int): the number of plain binary files
+        binary_size (int): the size in bytes of each binary file
+    """
+
+    name: str
+    pages: int = 200
+    depth: int = 2
+    fanout: int = 4
+    runs: int = 0
+    paste_size: int = 0
+    binary_files: int = 0
+    binary_size: int = 64 * 1024
+
+
+CONFIGS = {
+    c.name: c
+    for c in (
+        SiteConfig("pages", pages=2000),
+        SiteConfig("deep", depth=10),
+        SiteConfig("includes", fanout=50),
+        SiteConfig("runs", runs=2),
+        SiteConfig("paste", paste_size=1024 * 1024),
+        SiteConfig("binary", pages=10, binary_files=2000),
+    )
+}
+
+# Number of subdirectories of each directory in a synthetic tree.
+DIRECTORY_BRANCHING = 4
+
+
+def page_directory(i: int, depth: int) -> Path:
+    """Return the directory of page `i` in a tree of depth `depth`."""
+    return Path(
+        *(
+            f"dir{(i // DIRECTORY_BRANCHING**k) % DIRECTORY_BRANCHING}"
+            for k in range(depth)
+        )
+    )
+
+
+def generate_site(root: Path, config: SiteConfig) -> int:
+    """Generate a synthetic input tree.
+
+    Args:
+        root (Path): the directory in which to make the tree
+        config (SiteConfig): the shape of the tree
+
+    Returns:
+        int: the number of files to be processed
+    """
+    root.mkdir(parents=True, exist_ok=True)
+    for j in range(config.fanout):
+        (root / f"part{j}.in.html").write_text(
+            f"<div>Part {j} of $path</div>\n" + "Lorem ipsum dolor sit amet. " * 20
+        )
+    if config.paste_size > 0:
+        (root / "data.in.txt").write_bytes(b"x" * config.paste_size)
+    for i in range(config.pages):
+        dir = root / page_directory(i, config.depth)
+        dir.mkdir(parents=True, exist_ok=True)
+        body = [f"<h1>Page {i}</h1>\n"]
+        body += [f"$include(part{j}.in.html)\n" for j in range(config.fanout)]
+        body += [f"$run(echo,page {i} run {r})\n" for r in range(config.runs)]
+        if config.paste_size > 0:
+            body.append("$paste(data.in.txt)\n")
+        (dir / f"page{i}.nancy.html").write_text("".join(body))
+    for i in range(config.binary_files):
+        dir = root / page_directory(i, config.depth)
+        dir.mkdir(parents=True, exist_ok=True)
+        (dir / f"file{i}.dat").write_bytes(os.urandom(config.binary_size))
+    return config.pages + config.binary_files
+
+
+def syscall_counts() -> dict[str, int] | None:
+    """Return the read and write system calls made by this process so far."""
+    try:
+        with open("/proc/self/io", encoding="ascii") as fh:
+            counts = dict(line.split(": ") for line in fh.read().splitlines())
+    except OSError:  # pragma: no cover
+        return None
+    return {"read": int(counts["syscr"]), "write": int(counts["syscw"])}
+
+
+def measure(
+    input: Path, output: Path, files: int, jobs: int, backend: str
+) -> dict[str, Any]:
+    """Build `input` into `output`, and measure the build.
+
+    Args:
+        input (Path): the input tree
+        output (Path): the output directory
+        files (int): the number of files processed
+        jobs (int): the number of tasks to use
+        backend (str): as for `--backend`
+
+    Returns:
+        dict[str, Any]: the measurements
+    """
+    cpus = os.process_cpu_count() or 1
+    tree = Tree(
+        input,
+        output,
+        False,
+        processes=cpus if backend == "processes" else 1,
+        threads=cpus if backend == "threads" else 1,
+    )
+    syscalls_before = syscall_counts()
+    start = time.perf_counter()
+    asyncio.run(tree.process(jobs))
+    seconds = time.perf_counter() - start
+    syscalls_after = syscall_counts()
+    syscalls = None
+    if syscalls_before is not None and syscalls_after is not None:
+        syscalls = {k: syscalls_after[k] - syscalls_before[k] for k in syscalls_after}
+    # `ru_maxrss` is in bytes on macOS, and in KiB elsewhere.
+    rss_unit = 1 if sys.platform == "darwin" else 1024
+    return {
+        "files": files,
+        "seconds": seconds,
+        "files_per_second": files / seconds,
+        "peak_rss": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * rss_unit,
+        "children_peak_rss": resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+        * rss_unit,
+        "syscalls": syscalls,
+    }
+
+
+def benchmark(config: SiteConfig, jobs: int, backend: str) -> dict[str, Any]:
+    """Generate a tree with `config`, and measure building it.
+
+    The build runs in a new process.
+
+    Returns:
+        dict[str, Any]: the configuration and the measurements
+    """
+    with TemporaryDirectory() as tmp_dir:
+        input = Path(tmp_dir) / "input"
+        files = generate_site(input, config)
+        with ProcessPoolExecutor(
+            1, mp_context=multiprocessing.get_context("spawn")
+        ) as executor:
+            result = executor.submit(
+                measure, input, Path(tmp_dir) / "output", files, jobs, backend
+            ).result()
+    return {"config": asdict(config), "jobs": jobs, "backend": backend} | result
+
+
+def compare(results: list[dict[str, Any]], baseline: list[dict[str, Any]]) -> None:
+    """Print the change in throughput of `results` relative to `baseline`."""
+    baseline_rates = {r["config"]["name"]: r["files_per_second"] for r in baseline}
+    for result in results:
+        name = result["config"]["name"]
+        if name in baseline_rates:
+            change = result["files_per_second"] / baseline_rates[name] - 1
+            print(f"{name}: {result['files_per_second']:.1f} files/s ({change:+.1%})")
+
+
+def main(argv: list[str] = sys.argv[1:]) -> None:
+    parser = argparse.ArgumentParser(description="Benchmark Nancy.")
+    parser.add_argument(
+        "configs",
+        metavar="CONFIG",
+        nargs="*",
+        help=f"configurations to run, from: {', '.join(CONFIGS)} [default: all]",
+    )
+    parser.add_argument(
+        "--scale",
+        type=float,
+        default=1.0,
+        help="multiply the number of files by SCALE [default: %(default)s]",
+    )
+    parser.add_argument(
+        "--jobs",
+        type=int,
+        default=os.cpu_count() or 1,
+        help="number of parallel tasks [default: %(default)s]",
+    )
+    parser.add_argument(
+        "--backend",
+        choices=["tasks", "processes", "threads"],
+        default="tasks",
+        help="as for Nancy's --backend [default: %(default)s]",
+    )
+    parser.add_argument("--output", metavar="FILE", help="write the results to FILE")
+    parser.add_argument(
+        "--compare", metavar="FILE", help="compare the results with those in FILE"
+    )
+    args = parser.parse_args(argv)
+
+    results = []
+    for name in args.configs or CONFIGS:
+        if name not in CONFIGS:
+            parser.error(f"unknown configuration '{name}'")
+        config = CONFIGS[name]
+        config = replace(
+            config,
+            pages=max(1, round(config.pages * args.scale)),
+            binary_files=round(config.binary_files * args.scale),
+        )
+        results.append(benchmark(config, args.jobs, args.backend))
+    report = {
+        "nancy": VERSION,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": os.process_cpu_count(),
+        "time": time.time(),
+        "results": results,
+    }
+    if args.output is not None:
+        with open(args.output, "w", encoding="utf-8") as fh:
+            json.dump(report, fh, indent=1)
+    else:
+        json.dump(report, sys.stdout, indent=1)
+        print()
+    if args.compare is not None:
+        with open(args.compare, encoding="utf-8") as fh:
+            compare(results, json.load(fh)["results"])
+
+
+if __name__ == "__main__":  # pragma: no cover
+    main()
@@ -5,8 +5,12 @@
 Released under the GPL version 3, or (at your option) any later version.
 """
 
+from collections.abc import Iterator
+
 from pytest import FixtureRequest, Parser, fixture
 
+from nancy import log
+
 
 def pytest_addoption(parser: Parser) -> None:
     parser.addoption(
@@ -21,3 +25,14 @@ def regenerate_expected(request: FixtureRequest) -> bool:  # pragma: no cover
     opt = request.config.getoption("--regenerate-expected")
     assert isinstance(opt, bool)
     return opt
+
+
+@fixture
+def log_channels() -> Iterator[None]:
+    """Enable all the debug log channels, so that the logging code is run."""
+    log.configure("1")
+    try:
+        yield
+    finally:
+        for channel in log.CHANNELS.values():
+            channel.enabled = False
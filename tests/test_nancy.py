@@ -5,27 +5,86 @@
 Released under the GPL version 3, or (at your option) any later version.
 """
 
+import asyncio
+import errno
+import io
+import json
+import logging
 import os
+import pickle
 import shutil
 import socket
 import stat
+import subprocess
+import sys
+import tarfile
+import threading
+import zipfile
+from collections.abc import AsyncIterator, Callable
 from pathlib import Path
 from tempfile import TemporaryDirectory
 from unittest import mock
 
 import pytest
+from benchmark import SiteConfig, generate_site, measure
+from benchmark import main as benchmark_main
 from pytest import CaptureFixture, LogCaptureFixture
 from pytest_chdir import define_chdir_fixture
 from testutils import (
     check_links,
     failing_cli_test,
     failing_test,
+    file_objects_equal,
     passing_cli_test,
     passing_test,
     tree_mtimes,
 )
 
-from nancy import main
+from _nancy_client import connect, connect_socket
+from _nancy_client import main as client_main
+from nancy import (
+    DATABASE_NAME,
+    TEMPLATE_SEGMENT_SIZE,
+    WORK_QUEUE_SIZE_PER_WORKER,
+    Caches,
+    ContentCache,
+    Expand,
+    ExpandResult,
+    MacroCall,
+    NameKind,
+    ObjectKind,
+    ProcessScheduler,
+    RunMacros,
+    SizedCache,
+    Tree,
+    WorkerConfig,
+    WorkerResult,
+    compile_template,
+    log,
+    main,
+    process_files_in_worker,
+    real_main,
+    stat_signature,
+    stream_strip_final_newline,
+    template_size,
+)
+from nancy.daemon import serve
+from nancy.database import Database, file_digest
+from nancy.fileio import BatchedWriter, FileIO
+from nancy.link import FICLONE, LinkMethod, copy_range, link_file
+from nancy.profiling import Profiler
+from nancy.run_cache import RunCache
+from nancy.server import Servers
+from nancy.storage import (
+    LocalOutput,
+    MemoryOutput,
+    MemoryStore,
+    OutputFile,
+    TarStore,
+    ZipStore,
+    open_store,
+)
+from nancy.watch import Changes, snapshot
 
 
 tests_dir = Path(__file__).parent.resolve() / "test-files"
@@ -113,8 +172,1010 @@ async def test_update_overwriting_some_input(chtestdir) -> None:
             assert mtime == new_mtimes[file]
 
 
+async def test_update_uses_build_database() -> None:
+    with TemporaryDirectory() as tmp_dir:
+        input = Path(tmp_dir) / "input"
+        output = Path(tmp_dir) / "output"
+        shutil.copytree(tests_dir / "webpage-src", input)
+        await Tree(input, output, False, None, False, True).process(1)
+        database = Database(output / DATABASE_NAME)
+        entry = database.entries[Path("people/adam/index.nancy.html")]
+        assert entry.output == Path("people/adam/index.html")
+        assert (input / "people/adam/body.in.html").absolute() in [
+            d.path for d in entry.dependencies
+        ]
+
+        # Make one page out of date, and remove another.
+        orig_mtimes = tree_mtimes(output)
+        adam_output = output / "people/adam/index.html"
+        newer = orig_mtimes[adam_output] + 10
+        os.utime(input / "people/adam/body.in.html", times=(newer, newer))
+        shutil.rmtree(input / "people/eve")
+        with mock.patch.object(
+            Expand, "stream_include", autospec=True, side_effect=Expand.stream_include
+        ) as include:
+            await Tree(input, output, False, None, False, True).process(1)
+        # Only the out-of-date page should have been expanded, and without
+        # expanding it first to find its dependencies.
+        assert include.call_count > 0
+        assert all(isinstance(c.args[0]._macros, RunMacros) for c in include.mock_calls)
+        new_mtimes = tree_mtimes(output)
+        assert orig_mtimes.pop(adam_output) < new_mtimes.pop(adam_output)
+        del orig_mtimes[output / DATABASE_NAME]
+        del new_mtimes[output / DATABASE_NAME]
+        assert orig_mtimes == new_mtimes
+        database = Database(output / DATABASE_NAME)
+        assert Path("people/adam/index.nancy.html") in database.entries
+        assert Path("people/eve/index.nancy.html") not in database.entries
+
+        # A missing dependency makes a file out of date.
+        (input / "people/body.in.html").unlink()
+        (input / "people/index.nancy.html").write_bytes(b"new")
+        await Tree(input, output, False, None, False, True).process(1)
+        assert (output / "people/index.html").read_bytes() == b"new"
+
+
+async def test_update_notices_a_nearer_input() -> None:
+    for hash_dependencies in (False, True):
+        with TemporaryDirectory() as tmp_dir:
+            input = Path(tmp_dir) / "input"
+            output = Path(tmp_dir) / "output"
+            (input / "sub").mkdir(parents=True)
+            (input / "t.in.txt").write_text("top")
+            (input / "lib").mkdir()
+            (input / "lib/u.in.txt").write_text("top")
+            (input / "sub/p.nancy.txt").write_text(
+                "$include(t.in.txt) $include(lib/u.in.txt)"
+            )
+
+            async def build() -> str:
+                await Tree(
+                    input, output, False, None, False, True, hash_dependencies
+                ).process(1)
+                return (output / "sub/p.txt").read_text()
+
+            assert await build() == "top top"
+            entry = Database(output / DATABASE_NAME).entries[Path("sub/p.nancy.txt")]
+            assert entry.missing == [Path("sub/lib/u.in.txt"), Path("sub/t.in.txt")]
+            assert await build() == "top top"
+
+            (input / "sub/t.in.txt").write_text("near")
+            assert await build() == "near top"
+            (input / "sub/lib").mkdir()
+            (input / "sub/lib/u.in.txt").write_text("near")
+            assert await build() == "near near"
+
+
+async def test_processes_backend(chtestdir) -> None:
+    with TemporaryDirectory() as tmp_dir:
+        output = Path(tmp_dir) / "output"
+        await Tree(Path("webpage-src"), output, False, processes=2).process(2)
+        assert file_objects_equal(output, "webpage-expected")
+
+        # Output files and dependencies are merged for --delete and --update.
+        (output / "stray.txt").write_text("")
+        tree = Tree(
+            Path("webpage-src"),
+            output,
+            False,
+            None,
+            True,
+            True,
+            servers=Servers(set()),
+            run_cache=RunCache(),
+            max_procs=3,
+            processes=2,
+        )
+        await tree.process(2)
+        tree.__del__()
+        assert file_objects_equal(output, "webpage-expected")
+        database = Database(output / DATABASE_NAME)
+        assert Path("people/adam/index.nancy.html") in database.entries
+        assert Path("people/adam/index.nancy.html") in tree.dependencies
+
+
+async def test_processes_backend_errors(chtestdir) -> None:
+    with TemporaryDirectory() as tmp_dir:
+        input = Path(tmp_dir) / "input"
+        shutil.copytree("webpage-src", input)
+        (input / "bad.nancy.txt").write_text("$include(missing.txt)")
+        tree = Tree(input, Path(tmp_dir) / "output", False, processes=2)
+        with pytest.raises(ValueError, match="cannot find 'missing.txt'"):
+            await tree.process(1)
+
+
+def test_process_files_in_worker(chtestdir) -> None:
+    with TemporaryDirectory() as tmp_dir, mock.patch("nancy._worker_state", None):
+        output = Path(tmp_dir) / "output"
+        config = WorkerConfig(
+            Path("webpage-src"),
+            output,
+            False,
+            Path(),
+            True,
+            False,
+            (None, frozenset()),
+            1,
+            None,
+            frozenset(),
+        )
+        files = [(Path("index.nancy.html"), NameKind.TEMPLATE)]
+        result = process_files_in_worker(config, files, 1, False)
+        assert result.output_files == {output / "index.html"}
+        assert Path("index.nancy.html") in result.entries
+        assert Path("index.nancy.html") in result.dependencies
+        # The worker's `Tree` is reused for later batches.
+        files = [(Path("foo.in.html"), NameKind.INPUT)]
+        result = process_files_in_worker(config, files, 1, False)
+        assert result == WorkerResult(set(), {}, {})
+
+
+def test_link_from_the_command_line(chtestdir) -> None:
+    with TemporaryDirectory() as tmp_dir:
+        main(["--link=hardlink", "copy-src", tmp_dir])
+        assert file_objects_equal(tmp_dir, "copy-expected")
+        assert os.path.samefile("copy-src/test.copy.in", Path(tmp_dir) / "test.in")
+
+
+def test_io_threads_from_the_command_line(chtestdir) -> None:
+    for io_threads in ("0", "2"):
+        with TemporaryDirectory() as tmp_dir:
+            main([f"--io-threads={io_threads}", "webpage-src", tmp_dir])
+            assert file_objects_equal(tmp_dir, "webpage-expected")
+
+
+def test_profile_from_the_command_line(chtestdir) -> None:
+    with TemporaryDirectory() as tmp_dir:
+        output = Path(tmp_dir) / "output"
+        profile = Path(tmp_dir) / "profile.json"
+        trace = Path(tmp_dir) / "trace.json"
+        main(
+            [
+                f"--profile={profile}",
+                f"--trace={trace}",
+                "webpage-src",
+                str(output),
+            ]
+        )
+        assert file_objects_equal(output, "webpage-expected")
+        report = json.loads(profile.read_text())
+        assert "index.nancy.html" in {file["path"] for file in report["files"]}
+        assert len(json.loads(trace.read_text())["traceEvents"]) > 0
+
+
+def test_processes_backend_from_the_command_line(chtestdir) -> None:
+    with TemporaryDirectory() as tmp_dir:
+        output = Path(tmp_dir) / "output"
+        main(["--backend=processes", "webpage-src", str(output)])
+        assert file_objects_equal(output, "webpage-expected")
+
+
+async def test_threads_backend(chtestdir) -> None:
+    with TemporaryDirectory() as tmp_dir:
+        output = Path(tmp_dir) / "output"
+        tree = Tree(Path("webpage-src"), output, False, threads=2)
+        await tree.process(2)
+        assert file_objects_equal(output, "webpage-expected")
+        # The worker threads share the caches.
+        assert len(tree.templates) > 0
+
+        # Output files and dependencies are merged for --delete and --update.
+        (output / "stray.txt").write_text("")
+        tree = Tree(
+            Path("webpage-src"),
+            output,
+            False,
+            None,
+            True,
+            True,
+            servers=Servers(set()),
+            run_cache=RunCache(),
+            max_procs=3,
+            threads=2,
+        )
+        await tree.process(2)
+        tree.__del__()
+        assert file_objects_equal(output, "webpage-expected")
+        database = Database(output / DATABASE_NAME)
+        assert Path("people/adam/index.nancy.html") in database.entries
+        assert Path("people/adam/index.nancy.html") in tree.dependencies
+
+
+async def test_threads_backend_errors(chtestdir) -> None:
+    with TemporaryDirectory() as tmp_dir:
+        input = Path(tmp_dir) / "input"
+        shutil.copytree("webpage-src", input)
+        (input / "bad.nancy.txt").write_text("$include(missing.txt)")
+        tree = Tree(input, Path(tmp_dir) / "output", False, threads=2)
+        with pytest.raises(ValueError, match="cannot find 'missing.txt'"):
+            await tree.process(1)
+
+
+def test_threads_backend_from_the_command_line(chtestdir) -> None:
+    with TemporaryDirectory() as tmp_dir:
+        output = Path(tmp_dir) / "output"
+        main(["--backend=threads", "webpage-src", str(output)])
+        assert file_objects_equal(output, "webpage-expected")
+
+
+async def test_update_by_hash_ignores_modification_times() -> None:
+    with TemporaryDirectory() as tmp_dir:
+        input = Path(tmp_dir) / "input"
+        output = Path(tmp_dir) / "output"
+        shutil.copytree(tests_dir / "webpage-src", input)
+        # An existing output without a database is rebuilt.
+        shutil.copytree(tests_dir / "webpage-expected", output)
+        os.utime(output / "index.html", times=(0, 0))
+        await Tree(input, output, False, None, False, True, True).process(1)
+        assert file_objects_equal(output, tests_dir / "webpage-expected")
+        assert (output / "index.html").stat().st_mtime > 0
+
+        # Touch all the inputs, as a fresh checkout would.
+        orig_mtimes = tree_mtimes(output)
+        newer = max(orig_mtimes.values()) + 10
+        for obj in tree_mtimes(input):
+            os.utime(obj, times=(newer, newer))
+        with mock.patch("nancy.storage.file_digest", side_effect=file_digest) as digest:
+            await Tree(input, output, False, None, False, True, True).process(1)
+            hashed = digest.call_count
+            assert hashed > 0
+            new_mtimes = tree_mtimes(output)
+            del orig_mtimes[output / DATABASE_NAME]
+            del new_mtimes[output / DATABASE_NAME]
+            assert orig_mtimes == new_mtimes
+
+            # Unchanged signatures are not hashed again.
+            await Tree(input, output, False, None, False, True, True).process(1)
+            assert digest.call_count == hashed
+
+        # Change the contents of one input.
+        (input / "people/adam/body.in.html").write_text("Adam's new body")
+        await Tree(input, output, False, None, False, True, True).process(1)
+        assert (output / "people/adam/index.html").read_text().find(
+            "Adam's new body"
+        ) != -1
+        assert (
+            tree_mtimes(output)[output / "index.html"]
+            == new_mtimes[output / "index.html"]
+        )
+
+        # Remove an input.
+        (input / "people/body.in.html").unlink()
+        (input / "people/index.nancy.html").write_bytes(b"new")
+        await Tree(input, output, False, None, False, True, True).process(1)
+        assert (output / "people/index.html").read_bytes() == b"new"
+
+        # Remove an output.
+        (output / "people/index.html").unlink()
+        await Tree(input, output, False, None, False, True, True).process(1)
+        assert (output / "people/index.html").read_bytes() == b"new"
+
+
+def test_digest_of_empty_file() -> None:
+    with TemporaryDirectory() as tmp_dir:
+        path = Path(tmp_dir) / "empty"
+        path.write_bytes(b"")
+        assert file_digest(path) == "cae66941d9efbd404e4d88758ea67670"
+
+
+async def test_update_keeps_build_database_when_deleting() -> None:
+    with TemporaryDirectory() as tmp_dir:
+        output = Path(tmp_dir) / "output"
+        for _ in range(2):
+            tree = Tree(tests_dir / "copy-src", output, True, None, True, True)
+            await tree.process(1)
+            tree.__del__()
+            assert (output / DATABASE_NAME).exists()
+
+
+def test_bad_build_databases_are_ignored(log_channels) -> None:
+    with TemporaryDirectory() as tmp_dir:
+        path = Path(tmp_dir) / DATABASE_NAME
+        path.write_text("{")
+        assert Database(path).entries == {}
+        path.write_text('{"version": 0, "files": {"a": ["a", []]}}')
+        assert Database(path).entries == {}
+
+
+def make_counting_tree(root: Path) -> tuple[Path, Path]:
+    input = root / "input"
+    input.mkdir()
+    count = input / "count.in.sh"
+    count.write_text('#!/bin/sh\necho x >> "$NANCY_INPUT/../count"\necho "$@"\ncat\n')
+    count.chmod(0o755)
+    (input / "page.nancy.txt").write_text(
+        "$run(count.in.sh,a)$run(count.in.sh,a)$run(count.in.sh,b){$path}"
+    )
+    return input, root / "count"
+
+
+async def test_run_outputs_are_cached(log_channels) -> None:
+    with TemporaryDirectory() as tmp_dir:
+        root = Path(tmp_dir)
+        input, count = make_counting_tree(root)
+        cache = RunCache()
+        await Tree(input, root / "output", False, run_cache=cache).process(1)
+        assert (root / "output/page.txt").read_text() == "a\na\nb\npage.nancy.txt"
+        assert count.read_text() == "x\nx\n"
+        assert (cache.hits, cache.misses) == (1, 2)
+        # The cache is reused across builds.
+        await Tree(input, root / "output", False, run_cache=cache).process(1)
+        assert count.read_text() == "x\nx\n"
+
+
+async def test_impure_run_outputs_are_not_cached() -> None:
+    with TemporaryDirectory() as tmp_dir:
+        root = Path(tmp_dir)
+        input, count = make_counting_tree(root)
+        cache = RunCache(None, {"count.in.sh"})
+        await Tree(input, root / "output", False, run_cache=cache).process(1)
+        assert count.read_text() == "x\nx\nx\n"
+
+
+async def test_profile_records_files_and_runs() -> None:
+    with TemporaryDirectory() as tmp_dir:
+        root = Path(tmp_dir)
+        input, _ = make_counting_tree(root)
+        (input / "plain.txt").write_text("plain")
+        (input / "paste.nancy.txt").write_text("$paste(plain.txt)")
+        profiler = Profiler()
+        tree = Tree(
+            input, root / "output", False, run_cache=RunCache(), profiler=profiler
+        )
+        await tree.process(1)
+        records = {record.path: record for record in profiler.records}
+        assert set(records) == {"page.nancy.txt", "plain.txt", "paste.nancy.txt"}
+        page = records["page.nancy.txt"]
+        assert page.output == "page.txt"
+        assert page.bytes_out == len("a\na\nb\npage.nancy.txt")
+        assert page.templates == {str(input / "page.nancy.txt")}
+        assert sorted((run.program, run.cached) for run in page.runs) == [
+            ("count.in.sh", False),
+            ("count.in.sh", False),
+            ("count.in.sh", True),
+        ]
+        assert records["plain.txt"].bytes_out == len("plain")
+        assert records["paste.nancy.txt"].pastes == 1
+        assert records["paste.nancy.txt"].bytes_in > len("plain")
+        report = profiler.report()
+        walls = [file["wall"] for file in report["files"]]
+        assert walls == sorted(walls, reverse=True)
+        assert report["programs"]["count.in.sh"]["calls"] == 3
+        assert report["programs"]["count.in.sh"]["cached"] == 1
+        assert report["templates"][str(input / "page.nancy.txt")]["files"] == 1
+        events = profiler.trace_events()
+        assert [e["ph"] for e in events].count("b") == 6
+        assert all(e["ts"] >= 0 for e in events)
+        assert profiler.take_records() == list(records.values())
+        assert profiler.records == []
+
+
+async def test_profile_records_are_merged_from_processes(chtestdir) -> None:
+    with TemporaryDirectory() as tmp_dir:
+        profiler = Profiler()
+        await Tree(
+            Path("webpage-src"),
+            Path(tmp_dir) / "output",
+            False,
+            processes=2,
+            profiler=profiler,
+        ).process(2)
+        paths = {record.path for record in profiler.records}
+        assert "people/adam/index.nancy.html" in paths
+        assert os.getpid() not in {record.process for record in profiler.records}
+
+
+async def test_run_outputs_are_cached_on_disk() -> None:
+    with TemporaryDirectory() as tmp_dir:
+        root = Path(tmp_dir)
+        input, count = make_counting_tree(root)
+        for _ in range(2):
+            cache = RunCache(root / "cache")
+            await Tree(input, root / "output", False, run_cache=cache).process(1)
+            assert count.read_text() == "x\nx\n"
+        # Changing the program invalidates its outputs.
+        with open(input / "count.in.sh", "a") as fh:
+            fh.write("\n")
+        cache = RunCache(root / "cache")
+        await Tree(input, root / "output", False, run_cache=cache).process(1)
+        assert count.read_text() == "x\nx\nx\nx\n"
+
+
+def test_run_cache_is_bounded() -> None:
+    cache = RunCache(max_size=8)
+    cache.put("a", b"1234")
+    cache.put("b", b"1234")
+    assert cache.get("a") == b"1234"
+    cache.put("c", b"1234")
+    cache.put("big", b"123456789")
+    assert cache.get("b") is None
+    assert cache.get("big") is None
+    assert (cache.get("a"), cache.get("c"), cache.size) == (b"1234", b"1234", 8)
+    cache.put("a", b"12")
+    assert cache.size == 6
+
+
+def test_run_cache_directory_is_pruned(log_channels) -> None:
+    with TemporaryDirectory() as tmp_dir:
+        directory = Path(tmp_dir)
+        cache = RunCache(directory, max_directory_size=8)
+        for n, key in enumerate(("aa0", "bb0", "cc0")):
+            cache.put(key, b"1234")
+            os.utime(directory / key[:2] / key[2:], ns=(0, n * 10**9))
+        (directory / "dd").mkdir()
+        (directory / "dd/0.1.tmp").write_bytes(b"being written")
+        # Reading an output marks it as recently used.
+        assert RunCache(directory).get("aa0") == b"1234"
+        # Another process may remove outputs meanwhile.
+        glob = Path.glob
+        with mock.patch.object(
+            Path,
+            "glob",
+            lambda self, pattern: [*glob(self, pattern), directory / "ee/0"],
+        ):
+            cache.prune()
+        assert {file.parent.name for file in directory.glob("*/*")} == {
+            "aa",
+            "cc",
+            "dd",
+        }
+        RunCache().prune()
+
+
+async def test_process_scheduler_is_fair() -> None:
+    scheduler = ProcessScheduler(1)
+    started = []
+
+    async def run(owner: str, n: int) -> None:
+        await scheduler.acquire(owner)
+        started.append((owner, n))
+
+    await scheduler.acquire("first")
+    tasks = [
+        asyncio.create_task(run(owner, n))
+        for owner, n in (("a", 1), ("a", 2), ("a", 3), ("b", 1), ("c", 1))
+    ]
+    await asyncio.sleep(0)
+    # Cancel a waiting task.
+    tasks[3].cancel()
+    for _ in range(4):
+        scheduler.release()
+        await asyncio.sleep(0)
+    assert started == [("a", 1), ("c", 1), ("a", 2), ("a", 3)]
+    scheduler.release()
+    assert scheduler.running == 0
+
+
+async def test_process_scheduler_passes_on_slot_of_cancelled_task() -> None:
+    scheduler = ProcessScheduler(1)
+    await scheduler.acquire("a")
+    task = asyncio.create_task(scheduler.acquire("b"))
+    await asyncio.sleep(0)
+    scheduler.release()
+    task.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await task
+    assert scheduler.running == 0
+
+
+async def test_run_with_limited_processes(chtestdir) -> None:
+    with TemporaryDirectory() as tmp_dir:
+        tree = Tree(Path("cookbook-example-website-src"), Path(tmp_dir), False)
+        tree.scheduler = ProcessScheduler(1)
+        await tree.process(4)
+        assert file_objects_equal(tmp_dir, "cookbook-example-website-expected")
+
+
+async def test_run_timeout() -> None:
+    with TemporaryDirectory() as tmp_dir:
+        input = Path(tmp_dir) / "input"
+        input.mkdir()
+        (input / "slow.nancy.txt").write_text("$run(sleep,10)")
+        tree = Tree(input, Path(tmp_dir) / "output", False, run_timeout=0.1)
+        with pytest.raises(ValueError, match="timed out after 0.1 seconds running"):
+            await tree.process(1)
+
+
+async def test_run_streams_large_input_and_output() -> None:
+    with TemporaryDirectory() as tmp_dir:
+        input = Path(tmp_dir) / "input"
+        input.mkdir()
+        data = b"0123456789abcdef\n" * (300 * 1024)
+        (input / "data.in.txt").write_bytes(data)
+        (input / "cat.nancy.txt").write_text("$run(cat){$paste(data.in.txt)}")
+        (input / "head.nancy.txt").write_text("$run(head,-c,4){$paste(data.in.txt)}")
+        await Tree(input, Path(tmp_dir) / "output", False).process(1)
+        assert (Path(tmp_dir) / "output/cat.txt").read_bytes() == data
+        assert (Path(tmp_dir) / "output/head.txt").read_bytes() == b"0123"
+
+
+SERVER_SCRIPT = """#!/usr/bin/env python3
+import os, sys, time
+from pathlib import Path
+
+here = Path(__file__).parent
+if "NANCY_SERVER" not in os.environ:
+    print("one-shot", *sys.argv[1:], end="")
+    sys.exit(0)
+with open(here / "../starts", "a") as fh:
+    fh.write("x")
+stdin, stdout = sys.stdin.buffer, sys.stdout.buffer
+stdout.write(b"nancy-server 1\\n")
+stdout.flush()
+
+def number():
+    data = stdin.read(4)
+    if len(data) < 4:
+        sys.exit(0)
+    return int.from_bytes(data)
+
+def string(data):
+    return len(data).to_bytes(4) + data
+
+while True:
+    args = [stdin.read(number()) for _ in range(number())]
+    command = args[0] if args else b""
+    input = stdin.read(number()) if number() == 1 else b""
+    if command == b"crash" and (here / "../crash").exists():
+        (here / "../crash").unlink()
+        sys.exit(1)
+    if command == b"die":
+        sys.exit(1)
+    if command == b"sleep":
+        time.sleep(10)
+    status = 1 if command == b"fail" else 0
+    stdout.write(status.to_bytes(4) + string(b" ".join(args) + input) + string(b"oops"))
+    stdout.flush()
+"""
+
+
+def make_server_tree(root: Path, page: str) -> Path:
+    input = root / "input"
+    input.mkdir()
+    server = input / "serve.in.py"
+    server.write_text(SERVER_SCRIPT)
+    server.chmod(0o755)
+    (input / "page.nancy.txt").write_text(page)
+    return input
+
+
+async def process_with_servers(
+    input: Path, output: Path, names: set[str], run_timeout: float | None = None
+) -> None:
+    servers = Servers(names)
+    try:
+        await Tree(
+            input, output, False, run_timeout=run_timeout, servers=servers
+        ).process(1)
+    finally:
+        await servers.stop()
+
+
+async def test_run_servers_are_started_once() -> None:
+    with TemporaryDirectory() as tmp_dir:
+        root = Path(tmp_dir)
+        input = make_server_tree(
+            root, "$run(serve.in.py,a)|$run(serve.in.py,b,c)|$run(serve.in.py){d}"
+        )
+        await process_with_servers(input, root / "output", {"serve.in.py"})
+        assert (root / "output/page.txt").read_text() == "a|b c|d"
+        assert (root / "starts").read_text() == "x"
+
+
+async def test_run_servers_are_restarted_after_a_crash() -> None:
+    with TemporaryDirectory() as tmp_dir:
+        root = Path(tmp_dir)
+        input = make_server_tree(root, "$run(serve.in.py,a)$run(serve.in.py,crash)")
+        (root / "crash").touch()
+        await process_with_servers(input, root / "output", {"serve.in.py"})
+        assert (root / "output/page.txt").read_text() == "acrash"
+        assert (root / "starts").read_text() == "xx"
+
+
+async def test_run_server_that_keeps_crashing_causes_an_error(log_channels) -> None:
+    with TemporaryDirectory() as tmp_dir:
+        root = Path(tmp_dir)
+        input = make_server_tree(root, "$run(serve.in.py,die)")
+        with pytest.raises(ValueError, match="server .*serve.in.py crashed"):
+            await process_with_servers(input, root / "output", {"serve.in.py"})
+
+
+async def test_run_server_failure_causes_an_error(
+    capsys: CaptureFixture[str],
+) -> None:
+    with TemporaryDirectory() as tmp_dir:
+        root = Path(tmp_dir)
+        input = make_server_tree(root, "$run(serve.in.py,fail)")
+        with pytest.raises(ValueError, match="Error code 1 running: .*serve.in.py"):
+            await process_with_servers(input, root / "output", {"serve.in.py"})
+        assert "oops" in capsys.readouterr().err
+
+
+async def test_run_server_timeout_causes_an_error() -> None:
+    with TemporaryDirectory() as tmp_dir:
+        root = Path(tmp_dir)
+        input = make_server_tree(root, "$run(serve.in.py,sleep)")
+        with pytest.raises(ValueError, match="timed out after 0.5 seconds running"):
+            await process_with_servers(input, root / "output", {"serve.in.py"}, 0.5)
+
+
+async def test_run_programs_that_are_not_servers_are_run_normally(log_channels) -> None:
+    with TemporaryDirectory() as tmp_dir:
+        root = Path(tmp_dir)
+        input = make_server_tree(root, "$run(echo,-n,a)$run(echo,-n,b)$run(cat){c}")
+        with mock.patch("nancy.server.HANDSHAKE_TIMEOUT", 0.1):
+            await process_with_servers(input, root / "output", {"echo", "cat"})
+        assert (root / "output/page.txt").read_text() == "abc"
+
+
+def test_run_servers_from_the_command_line() -> None:
+    with TemporaryDirectory() as tmp_dir:
+        root = Path(tmp_dir)
+        input = make_server_tree(root, "$run(serve.in.py,a)$run(serve.in.py,b)")
+        main(["--server=serve.in.py", str(input), str(root / "output")])
+        assert (root / "output/page.txt").read_text() == "ab"
+        assert (root / "starts").read_text() == "x"
+        main([str(input), str(root / "output2")])
+        assert (root / "output2/page.txt").read_text() == "one-shot aone-shot b"
+
+
+async def wait_until(condition: Callable[[], bool]) -> None:
+    async with asyncio.timeout(10):
+        while not condition():
+            await asyncio.sleep(0.02)
+
+
+def read_if_exists(path: Path) -> str | None:
+    return path.read_text() if path.exists() else None
+
+
+async def test_watch_rebuilds_affected_files(log_channels) -> None:
+    with TemporaryDirectory() as tmp_dir:
+        root = Path(tmp_dir)
+        input, output = root / "input", root / "output"
+        (input / "sub").mkdir(parents=True)
+        (input / "header.in.txt").write_text("H")
+        (input / "a.nancy.txt").write_text("$include(header.in.txt)A")
+        (input / "b.nancy.txt").write_text("B$run(echo,-n,!)")
+        (input / "sub/c.nancy.txt").write_text("$include(header.in.txt)C")
+        tree = Tree(input, output, False, update_newer=True)
+        task = asyncio.create_task(tree.watch(1, 0.02))
+        try:
+            await wait_until(lambda: read_if_exists(output / "sub/c.txt") == "HC")
+            b_mtime = (output / "b.txt").stat().st_mtime_ns
+
+            # Modifying a file rebuilds the files that use it.
+            (input / "header.in.txt").write_text("H2")
+            await wait_until(lambda: read_if_exists(output / "a.txt") == "H2A")
+            await wait_until(lambda: read_if_exists(output / "sub/c.txt") == "H2C")
+            assert (output / "b.txt").stat().st_mtime_ns == b_mtime
+
+            # Adding a file builds it, and rebuilds files that may now find it.
+            (input / "sub/header.in.txt").write_text("S")
+            (input / "d.nancy.txt").write_text("D")
+            (input / ".hidden.nancy.txt").write_text("hidden")
+            (input / "sub.in").mkdir()
+            (input / "sub.in/e.nancy.txt").write_text("E")
+            await wait_until(lambda: read_if_exists(output / "sub/c.txt") == "SC")
+            await wait_until(lambda: read_if_exists(output / "d.txt") == "D")
+            assert read_if_exists(output / "a.txt") == "H2A"
+            assert not (output / ".hidden.txt").exists()
+            assert not (output / "sub.in").exists()
+
+            # Removing a file forgets it.
+            (input / "d.nancy.txt").unlink()
+            await wait_until(lambda: Path("d.nancy.txt") not in tree.dependencies)
+            assert tree.database is not None
+            assert Path("d.nancy.txt") not in tree.database.entries
+
+            # Errors are reported, and the files are tried again.
+            with pytest.warns(UserWarning, match="cannot find 'missing.txt'") as record:
+                (input / "b.nancy.txt").write_text("$include(missing.txt)")
+                await wait_until(lambda: len(record) > 0)
+            (input / "b.nancy.txt").write_text("B2")
+            await wait_until(lambda: read_if_exists(output / "b.txt") == "B2")
+        finally:
+            task.cancel()
+            with pytest.raises(asyncio.CancelledError):
+                await task
+
+
+async def test_watch_notices_changes_during_the_first_build() -> None:
+    with TemporaryDirectory() as tmp_dir:
+        root = Path(tmp_dir)
+        input, output = root / "input", root / "output"
+        input.mkdir()
+        (input / "a.nancy.txt").write_text("A")
+        tree = Tree(input, output, False)
+        process_objects = tree.process_objects
+
+        async def edit_during_build(*args) -> None:
+            await process_objects(*args)
+            if (input / "a.nancy.txt").read_text() == "A":
+                (input / "a.nancy.txt").write_text("A2")
+
+        with mock.patch.object(tree, "process_objects", side_effect=edit_during_build):
+            task = asyncio.create_task(tree.watch(1, 0.02))
+            try:
+                await wait_until(lambda: read_if_exists(output / "a.txt") == "A2")
+            finally:
+                task.cancel()
+                with pytest.raises(asyncio.CancelledError):
+                    await task
+
+
+def test_watch_snapshot() -> None:
+    with TemporaryDirectory() as tmp_dir:
+        root = Path(tmp_dir)
+        (root / "file").write_text("x")
+        (root / "loop").symlink_to(root)
+        assert set(snapshot([root])) == {root / "file"}
+        assert snapshot([root / "missing"], [root / "file", root / "missing"]) == {
+            root / "file": stat_signature(os.stat(root / "file"))
+        }
+
+
+def test_watch_from_the_command_line(chtestdir) -> None:
+    with mock.patch("nancy.Tree.watch") as watch:
+        main(["--watch", "--watch-interval=5", "webpage-src", "output"])
+    watch.assert_called_once()
+    assert watch.call_args.args[1] == 5
+
+
+def test_interrupting_the_command_line_exits_cleanly() -> None:
+    with mock.patch("nancy.real_main", side_effect=KeyboardInterrupt):
+        with pytest.raises(SystemExit) as e:
+            main([])
+    assert e.value.code == 130
+
+
+async def test_caches_are_revalidated_between_trees(log_channels) -> None:
+    with TemporaryDirectory() as tmp_dir:
+        root = Path(tmp_dir)
+        input, output = root / "input", root / "output"
+        (input / "a").mkdir(parents=True)
+        (input / "inc").mkdir()
+        (input / "inc/x.in.txt").write_text("1")
+        (input / "a/page.nancy.txt").write_text("$include(inc/x.in.txt)")
+        caches = Caches()
+        await Tree(input, output, False, caches=caches).process(1)
+        assert (output / "a/page.txt").read_text() == "1"
+        assert caches.index[Path("a/inc")] is None
+        misses = caches.contents.misses
+        await Tree(input, output, False, caches=caches).process(1)
+        assert caches.contents.misses == misses
+
+        # Adding a file that shadows an included file is noticed.
+        (input / "a/inc").mkdir()
+        (input / "a/inc/x.in.txt").write_text("2")
+        await Tree(input, output, False, caches=caches).process(1)
+        assert (output / "a/page.txt").read_text() == "2"
+
+        # So is removing it again.
+        shutil.rmtree(input / "a/inc")
+        await Tree(input, output, False, caches=caches).process(1)
+        assert (output / "a/page.txt").read_text() == "1"
+
+
+def is_listening(socket_path: Path) -> bool:
+    with socket.socket(socket.AF_UNIX) as sock:
+        try:
+            sock.connect(str(socket_path))
+        except (FileNotFoundError, ConnectionRefusedError):
+            return False
+    return True
+
+
+async def test_serve_and_connect(chtestdir) -> None:
+    with TemporaryDirectory() as tmp_dir:
+        socket_path = Path(tmp_dir) / "socket"
+        server = asyncio.create_task(real_main(["--serve", str(socket_path)]))
+        await wait_until(lambda: is_listening(socket_path))
+        try:
+            # Expand a single file to stdout.
+            stdout, stderr = io.BytesIO(), io.BytesIO()
+            status = await asyncio.to_thread(
+                connect,
+                socket_path,
+                ["file-root-relative-include.nancy.txt", "-"],
+                stdout,
+                stderr,
+            )
+            assert status == 0
+            expected = Path("file-root-relative-include-expected.txt").read_bytes()
+            assert stdout.getvalue() == expected
+
+            # Errors are returned.
+            status = await asyncio.to_thread(
+                connect, socket_path, ["missing-include.nancy.txt", "-"], stdout, stderr
+            )
+            assert status == 1
+            assert b"cannot find" in stderr.getvalue()
+            status = await asyncio.to_thread(
+                connect, socket_path, ["--serve", str(socket_path)], stdout, stderr
+            )
+            assert status == 1
+            assert b"cannot start a server from a server" in stderr.getvalue()
+
+            # Build a tree from the command line.
+            output = Path(tmp_dir) / "output"
+            await asyncio.to_thread(
+                main, ["--connect", str(socket_path), "webpage-src", str(output)]
+            )
+            assert file_objects_equal(output, "webpage-expected")
+            with pytest.raises(SystemExit) as e:
+                await asyncio.to_thread(
+                    main, ["--connect", str(socket_path), "webpage-src", "-"]
+                )
+            assert e.value.code == 1
+
+            # The lightweight client gives the same results.
+            shutil.rmtree(output)
+            await asyncio.to_thread(
+                client_main, ["--connect", str(socket_path), "webpage-src", str(output)]
+            )
+            assert file_objects_equal(output, "webpage-expected")
+            with pytest.raises(SystemExit) as e:
+                await asyncio.to_thread(
+                    client_main, [f"--connect={socket_path}", "webpage-src", "-"]
+                )
+            assert e.value.code == 1
+
+            # Only one server may use a socket.
+            with pytest.raises(ValueError, match="already listening"):
+                await serve(socket_path, real_main)
+        finally:
+            server.cancel()
+            with pytest.raises(asyncio.CancelledError):
+                await server
+        assert not socket_path.exists()
+
+
+async def test_serve_exit_statuses(log_channels) -> None:
+    async def handle(argv: list[str]) -> None:
+        sys.exit(argv[0] if argv[0] != "none" else None)
+
+    with TemporaryDirectory() as tmp_dir:
+        socket_path = Path(tmp_dir) / "socket"
+        # A stale socket is replaced.
+        with socket.socket(socket.AF_UNIX) as sock:
+            sock.bind(str(socket_path))
+        server = asyncio.create_task(serve(socket_path, handle))
+        await wait_until(lambda: is_listening(socket_path))
+        try:
+            stdout, stderr = io.BytesIO(), io.BytesIO()
+            assert (
+                await asyncio.to_thread(connect, socket_path, ["none"], stdout, stderr)
+                == 0
+            )
+            assert (
+                await asyncio.to_thread(connect, socket_path, ["bad"], stdout, stderr)
+                == 1
+            )
+            assert stderr.getvalue() == b"bad\n"
+        finally:
+            server.cancel()
+            with pytest.raises(asyncio.CancelledError):
+                await server
+
+
+async def test_serve_resets_debug_logging_for_each_request() -> None:
+    async def handle(argv: list[str]) -> None:
+        print(log.run.enabled)
+        log.configure("run")
+
+    with TemporaryDirectory() as tmp_dir:
+        socket_path = Path(tmp_dir) / "socket"
+        server = asyncio.create_task(serve(socket_path, handle))
+        await wait_until(lambda: is_listening(socket_path))
+        try:
+            assert stat.S_IMODE(socket_path.stat().st_mode) == 0o600
+            for _ in range(2):
+                stdout, stderr = io.BytesIO(), io.BytesIO()
+                await asyncio.to_thread(connect, socket_path, [], stdout, stderr)
+                assert stdout.getvalue() == b"False\n"
+            assert not log.run.enabled
+        finally:
+            server.cancel()
+            with pytest.raises(asyncio.CancelledError):
+                await server
+
+
+async def test_serve_writes_from_other_threads() -> None:
+    async def handle(argv: list[str]) -> None:
+        def write(text: str) -> None:
+            sys.stdout.write(text)
+            sys.stdout.flush()
+
+        write("a")
+        await asyncio.to_thread(write, "b")
+        write("c")
+
+    with TemporaryDirectory() as tmp_dir:
+        socket_path = Path(tmp_dir) / "socket"
+        server = asyncio.create_task(serve(socket_path, handle))
+        await wait_until(lambda: is_listening(socket_path))
+        try:
+            stdout, stderr = io.BytesIO(), io.BytesIO()
+            await asyncio.to_thread(connect, socket_path, [], stdout, stderr)
+            assert stdout.getvalue() == b"abc"
+        finally:
+            server.cancel()
+            with pytest.raises(asyncio.CancelledError):
+                await server
+
+
+def test_connect_socket() -> None:
+    assert connect_socket(["--connect", "s", "in", "out"]) == "s"
+    assert connect_socket(["in", "out", "--connect=s"]) == "s"
+    assert connect_socket(["in", "out"]) is None
+    assert connect_socket(["--connect"]) is None
+    assert connect_socket(["--connect", "s", "--serve", "t"]) is None
+    assert connect_socket(["--serve=t", "--connect", "s"]) is None
+    assert connect_socket(["--", "--connect", "s"]) is None
+
+
+def test_client_does_not_load_nancy() -> None:
+    result = subprocess.run(
+        [
+            sys.executable,
+            "-c",
+            "import sys, _nancy_client; print('nancy' in sys.modules)",
+        ],
+        capture_output=True,
+        text=True,
+        check=True,
+        env={**os.environ, "PYTHONPATH": os.pathsep.join(sys.path)},
+    )
+    assert result.stdout == "False\n"
+
+
+def test_client_runs_nancy_without_connect(capsys: CaptureFixture[str]) -> None:
+    with pytest.raises(SystemExit) as e:
+        client_main(["--version"])
+    assert e.value.code == 0
+    assert "GNU General Public License" in capsys.readouterr().out
+
+
+def test_client_without_a_server_causes_an_error(
+    capsys: CaptureFixture[str],
+) -> None:
+    with TemporaryDirectory() as tmp_dir:
+        with pytest.raises(SystemExit) as e:
+            client_main(["--connect", str(Path(tmp_dir) / "socket"), "in", "out"])
+        assert e.value.code == 1
+    assert "No such file or directory" in capsys.readouterr().err
+
+
+def test_client_interrupted() -> None:
+    with mock.patch("_nancy_client.connect", side_effect=KeyboardInterrupt):
+        with pytest.raises(SystemExit) as e:
+            client_main(["--connect", "socket", "in", "out"])
+    assert e.value.code == 130
+
+
+async def test_connect_to_a_server_that_closes_the_connection() -> None:
+    with TemporaryDirectory() as tmp_dir:
+        socket_path = Path(tmp_dir) / "socket"
+
+        async def hang_up(
+            reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+        ) -> None:
+            await reader.readline()
+            writer.close()
+
+        server = await asyncio.start_unix_server(hang_up, socket_path)
+        async with server:
+            with pytest.raises(ValueError, match="closed the connection"):
+                await asyncio.to_thread(
+                    connect, socket_path, [], io.BytesIO(), io.BytesIO()
+                )
+
+
 async def test_env_vars(chtestdir) -> None:
     await passing_test("env-vars-src", "env-vars-expected")
+    # NANCY_INPUT is only set for the programs run.
+    assert "NANCY_INPUT" not in os.environ
 
 
 async def test_nested_macro_invocations(chtestdir) -> None:
@@ -198,11 +1259,23 @@ async def test_copy_suffix(chtestdir) -> None:
         assert stats.st_mode & stat.S_IXUSR != 0
 
 
+async def test_executable_template(chtestdir) -> None:
+    with TemporaryDirectory() as tmp_dir:
+        input = Path(tmp_dir) / "input"
+        input.mkdir()
+        script = input / "script.nancy.sh"
+        script.write_text("#!/bin/sh\necho $path\n")
+        script.chmod(0o755)
+        await Tree(input, Path(tmp_dir) / "output", False).process(1)
+        stats = os.stat(Path(tmp_dir) / "output/script.sh")
+        assert stats.st_mode & stat.S_IXUSR != 0
+
+
 async def test_update_copy_suffix(chtestdir) -> None:
     await passing_test("copy-src", "copy-expected", None, None, False, False, True)
 
 
-async def test_delete_ungenerated(chtestdir) -> None:
+async def test_delete_ungenerated(chtestdir, log_channels) -> None:
     # Create temporary directory to copy initial files into
     with TemporaryDirectory() as tmp_dir:
         shutil.copytree("webpage-src", tmp_dir, dirs_exist_ok=True)
@@ -445,6 +1518,944 @@ async def test_trying_to_output_multiple_files_to_stdout_causes_an_error(
     )
 
 
+def test_compile_template() -> None:
+    assert compile_template(b"a $f(x\\,y,$g){$h} \\$i(j) b") == (
+        b"a ",
+        MacroCall(
+            b"f",
+            ((b"x,y",), (MacroCall(b"g", None, None),)),
+            (MacroCall(b"h", None, None),),
+        ),
+        b" $i(j) b",
+    )
+
+
+def test_compile_template_escapes_commas_at_each_level() -> None:
+    # Each level of nesting removes one backslash before a comma.
+    assert compile_template(rb"$f($g(a\,b,c\\\,d))") == (
+        MacroCall(
+            b"f",
+            ((MacroCall(b"g", ((b"a",), (b"b",), (rb"c\,d",)), None),),),
+            None,
+        ),
+    )
+    # Escaped macro calls keep their text, unescaped to their level.
+    assert compile_template(rb"$f(\$g(a\\,b){c}){d\,e}") == (
+        MacroCall(b"f", ((rb"$g(a\,b){c}",),), (b"d,e",)),
+    )
+
+
+def test_compile_template_reports_unclosed_brackets() -> None:
+    with pytest.raises(ValueError, match="missing }"):
+        compile_template(b"$f($g{(})")
+    with pytest.raises(ValueError, match="missing }"):
+        compile_template(rb"\$f({)")
+    with pytest.raises(ValueError, match="missing \\)"):
+        compile_template(rb"\$f((")
+
+
+def test_compile_deeply_nested_template() -> None:
+    depth = 200
+    template = compile_template(b"$f(a," * depth + b"x" + b")" * depth)
+    for _ in range(depth):
+        assert isinstance(template[0], MacroCall) and template[0].args is not None
+        template = template[0].args[1]
+    assert template == (b"x",)
+
+
+async def test_stream_strip_final_newline() -> None:
+    async def stream(chunks: list[bytes]) -> list[bytes]:
+        async def iterate() -> AsyncIterator[bytes]:
+            for chunk in chunks:
+                yield chunk
+
+        return [bytes(c) async for c in stream_strip_final_newline(iterate())]
+
+    assert await stream([b"a\n", b"b\n"]) == [b"a", b"\n", b"b"]
+    assert await stream([b"a\n", b"\n", b"\n"]) == [b"a", b"\n"]
+    assert b"".join(await stream([b"a", b"\n\n\n", b""])) == b"a\n"
+    assert await stream([]) == []
+
+
+async def test_output_is_streamed() -> None:
+    with TemporaryDirectory() as tmp_dir:
+        input = Path(tmp_dir) / "input"
+        input.mkdir()
+        (input / "part.txt").write_bytes(b"part\n")
+        (input / "page.nancy.txt").write_bytes(b"a $include(part.txt) b\n")
+        output = Path(tmp_dir) / "output"
+        writes: list[bytes] = []
+        real_open = open
+
+        def recording_open(file, mode="r", *args, **kwargs):
+            fh = real_open(file, mode, *args, **kwargs)
+            if mode == "wb":
+                write = fh.write
+                fh.write = lambda data: writes.append(bytes(data)) or write(data)
+            return fh
+
+        with mock.patch("builtins.open", recording_open):
+            await Tree(input, output, False).process(1)
+        assert (output / "page.txt").read_bytes() == b"a part b\n"
+        assert writes == [b"a ", b"part", b" b\n"]
+
+
+async def test_runs_separated_by_include_run_in_parallel() -> None:
+    with TemporaryDirectory() as tmp_dir:
+        input = Path(tmp_dir) / "input"
+        input.mkdir()
+        flag = Path(tmp_dir) / "flag"
+        # `wait` finishes only once `signal`, which comes after the
+        # `$include`, has run.
+        wait = input / "wait.in.sh"
+        wait.write_text(
+            f"#!/bin/sh\nwhile [ ! -e '{flag}' ]; do sleep 0.01; done\nprintf a\n"
+        )
+        wait.chmod(0o755)
+        signal = input / "signal.in.sh"
+        signal.write_text(f"#!/bin/sh\ntouch '{flag}'\nprintf c\n")
+        signal.chmod(0o755)
+        (input / "part.txt").write_bytes(b"b\n")
+        (input / "page.nancy.txt").write_bytes(
+            b"$run(wait.in.sh)$include(part.txt)$run(signal.in.sh)\n"
+        )
+        output = Path(tmp_dir) / "output"
+        await Tree(input, output, False, run_timeout=10).process(1)
+        assert (output / "page.txt").read_bytes() == b"abc\n"
+
+
+async def test_failed_expansion_leaves_no_output() -> None:
+    with TemporaryDirectory() as tmp_dir:
+        input = Path(tmp_dir) / "input"
+        input.mkdir()
+        (input / "page.nancy.txt").write_bytes(b"text $run(false)")
+        output = Path(tmp_dir) / "output"
+        output.mkdir()
+        (output / "page.txt").write_bytes(b"old")
+        with pytest.raises(ValueError, match="Error code 1"):
+            await Tree(input, output, False).process(1)
+        assert not (output / "page.txt").exists()
+
+
+async def test_compiled_templates_are_cached() -> None:
+    with TemporaryDirectory() as tmp_dir:
+        file = Path(tmp_dir) / "template.txt"
+        file.write_bytes(b"$path")
+        tree = Tree(Path(tmp_dir), Path(tmp_dir) / "output", False)
+        template = await tree.compile_file(file)
+        assert await tree.compile_file(file) is template
+        file.write_bytes(b"$outputpath")
+        assert await tree.compile_file(file) == (MacroCall(b"outputpath", None, None),)
+
+
+def test_content_cache_evicts_least_recently_used() -> None:
+    with TemporaryDirectory() as tmp_dir:
+        files = [Path(tmp_dir) / name for name in ("a", "b", "c")]
+        for f in files:
+            f.write_bytes(b"1234")
+        cache = ContentCache(8)
+        assert cache.read(files[0]) == b"1234"
+        assert cache.read(files[1]) == b"1234"
+        assert cache.read(files[0]) == b"1234"
+        assert cache.read(files[2]) == b"1234"
+        assert (cache.hits, cache.misses, cache.size) == (1, 3, 8)
+        assert cache.get(files[1], files[1].stat()) is None
+        files[0].write_bytes(b"12345")
+        assert cache.read(files[0]) == b"12345"
+        assert (cache.hits, cache.misses, cache.size) == (1, 4, 5)
+
+
+def test_content_cache_does_not_store_oversized_files() -> None:
+    with TemporaryDirectory() as tmp_dir:
+        file = Path(tmp_dir) / "big"
+        file.write_bytes(b"123456789")
+        cache = ContentCache(8)
+        assert cache.read(file) == b"123456789"
+        assert cache.size == 0
+
+
+def test_content_cache_concurrent_reads() -> None:
+    with TemporaryDirectory() as tmp_dir:
+        file = Path(tmp_dir) / "file"
+        file.write_bytes(b"1234")
+        cache = ContentCache(8)
+        read_bytes = Path.read_bytes
+
+        def read_meanwhile(path: Path) -> bytes:
+            # Another thread reads the file while this one is reading it.
+            with mock.patch.object(Path, "read_bytes", read_bytes):
+                cache.read(path)
+            return read_bytes(path)
+
+        with mock.patch.object(Path, "read_bytes", read_meanwhile):
+            assert cache.read(file) == b"1234"
+        assert cache.size == 4
+
+
+async def test_template_cache_is_bounded() -> None:
+    with TemporaryDirectory() as tmp_dir:
+        input = Path(tmp_dir) / "input"
+        input.mkdir()
+        for name in ("a", "b", "c"):
+            (input / f"{name}.nancy.txt").write_bytes(b"$path")
+        (input / "big.nancy.txt").write_bytes(b"$path $path")
+        size = template_size(compile_template(b"$path"))
+        caches = Caches()
+        caches.templates = SizedCache(2 * size)
+        await Tree(input, Path(tmp_dir) / "output", False, caches=caches).process(1)
+        assert (len(caches.templates), caches.templates.size) == (2, 2 * size)
+        assert input / "big.nancy.txt" not in caches.templates
+
+
+def test_template_size() -> None:
+    assert template_size(compile_template(b"abc")) == TEMPLATE_SEGMENT_SIZE + 3
+    assert template_size(compile_template(b"$a(b){c}")) == 3 * TEMPLATE_SEGMENT_SIZE + 2
+
+
+async def test_files_are_queued_as_workers_are_ready() -> None:
+    with TemporaryDirectory() as tmp_dir:
+        root = Path(tmp_dir)
+        input = root / "input"
+        (input / "dir").mkdir(parents=True)
+        for i in range(50):
+            (input / f"{i}.nancy.txt").write_text(f"{i}")
+            (input / "dir" / f"{i}.txt").write_text(f"{i}")
+        (input / "ignored.in.txt").write_text("")
+        tree = Tree(input, root / "output", False)
+        queue_sizes = []
+        process_file = tree.process_file
+
+        async def recording_process_file(
+            obj: Path, only_newer: bool, kind: NameKind
+        ) -> None:
+            queue_sizes.append(tree.work_queue.qsize())
+            await process_file(obj, only_newer, kind)
+
+        with mock.patch.object(tree, "process_file", recording_process_file):
+            await tree.process(2)
+        assert len(queue_sizes) == 100
+        assert max(queue_sizes) <= 2 * WORK_QUEUE_SIZE_PER_WORKER
+        assert (root / "output/49.txt").read_text() == "49"
+        assert not (root / "output/ignored.in.txt").exists()
+
+
+def test_input_tree_index() -> None:
+    with TemporaryDirectory() as tmp_dir:
+        root = Path(tmp_dir)
+        input = root / "input"
+        (input / "dir").mkdir(parents=True)
+        (input / "dir" / "file").write_bytes(b"")
+        (input / "dangling").symlink_to("nonexistent")
+        os.mkfifo(input / "fifo")
+        (root / "outside").write_bytes(b"")
+        os.mkfifo(root / "outside-fifo")
+        tree = Tree(input, root / "output", False)
+        assert tree.object_kind(Path()) == ObjectKind.DIRECTORY
+        assert tree.object_kind(Path("dir")) == ObjectKind.DIRECTORY
+        assert tree.object_kind(Path("dir/file")) == ObjectKind.FILE
+        assert tree.object_kind(Path("dir/../dir/file")) == ObjectKind.FILE
+        assert tree.object_kind(Path("dir/file/foo")) is None
+        assert tree.object_kind(Path("fifo")) == ObjectKind.OTHER
+        assert not tree.object_exists(Path("dangling"))
+        assert tree.object_exists(Path("dir/file"))
+        assert tree.list_directory(Path()) == {
+            "dir": ObjectKind.DIRECTORY,
+            "fifo": ObjectKind.OTHER,
+        }
+        assert tree.object_kind(Path("../input")) == ObjectKind.DIRECTORY
+        assert tree.object_kind(Path("../outside")) == ObjectKind.FILE
+        assert tree.object_kind(Path("../outside-fifo")) == ObjectKind.OTHER
+        assert tree.object_kind(Path("../nonexistent")) is None
+
+
+def make_overlay_inputs(root: Path) -> tuple[Path, Path]:
+    site, theme = root / "site", root / "theme"
+    (site / "sub").mkdir(parents=True)
+    (theme / "sub").mkdir(parents=True)
+    (theme / "shadowed").mkdir()
+    (theme / "shadowed/x.txt").write_text("theme x")
+    (theme / "base.in.txt").write_text("theme base")
+    (theme / "style.css").write_text("theme style")
+    (theme / "sub/page.nancy.txt").write_text(
+        "$include(base.in.txt) $include(part.in.txt)"
+    )
+    (theme / "sub/part.in.txt").write_text("theme part")
+    (site / "style.css").write_text("site style")
+    (site / "sub/part.in.txt").write_text("site part")
+    (site / "index.nancy.txt").write_text("$paste(style.css)")
+    (site / "shadowed").write_text("site file")
+    return site, theme
+
+
+async def test_input_overlay() -> None:
+    with TemporaryDirectory() as tmp_dir:
+        root = Path(tmp_dir)
+        site, theme = make_overlay_inputs(root)
+        output = root / "output"
+        tree = Tree([site, theme], output, False)
+        await tree.process(1)
+        assert (output / "style.css").read_text() == "site style"
+        assert (output / "index.txt").read_text() == "site style"
+        assert (output / "sub/page.txt").read_text() == "theme base site part"
+        assert (output / "shadowed").read_text() == "site file"
+        assert tree.object_roots(Path("sub")) == (site, theme)
+        assert tree.object_roots(Path("sub/page.nancy.txt")) == (theme,)
+        assert tree.input_path(Path("sub/../style.css")) == site / "style.css"
+        assert tree.object_kind(Path("shadowed/x.txt")) is None
+        assert tree.nancy_input() == f"{site}{os.pathsep}{theme}"
+        assert tree.worker_config().input == (site, theme)
+        assert Tree(site, output, False).worker_config().input == site
+
+        # Removing a file from one input uncovers it in another.
+        (site / "style.css").unlink()
+        changes = Changes(set(), set(), {Path(os.path.abspath(site / "style.css"))})
+        objs = tree.affected_objects(changes)
+        assert Path("style.css") in objs
+        assert Path("index.nancy.txt") in objs
+        await tree.process_objects(objs, 1, False)
+        assert (output / "style.css").read_text() == "theme style"
+        assert (output / "index.txt").read_text() == "theme style"
+
+
+async def test_input_overlay_caches_are_revalidated() -> None:
+    with TemporaryDirectory() as tmp_dir:
+        root = Path(tmp_dir)
+        site, theme = make_overlay_inputs(root)
+        output = root / "output"
+        caches = Caches()
+        await Tree([site, theme], output, False, caches=caches).process(1)
+        assert (output / "sub/page.txt").read_text() == "theme base site part"
+
+        # Shadowing a file in a later input is noticed.
+        (site / "base.in.txt").write_text("site base")
+        await Tree([site, theme], output, False, caches=caches).process(1)
+        assert (output / "sub/page.txt").read_text() == "site base site part"
+
+        # Shadowing a directory hides its subdirectories too.
+        (theme / "extra/deep").mkdir(parents=True)
+        (theme / "extra/deep/file.txt").write_text("deep")
+        tree = Tree([site, theme], output, False, caches=caches)
+        assert tree.object_kind(Path("extra/deep/file.txt")) == ObjectKind.FILE
+        (site / "extra").write_text("")
+        tree = Tree([site, theme], output, False, caches=caches)
+        assert tree.object_kind(Path("extra/deep/file.txt")) is None
+
+
+def test_input_overlay_shadowing() -> None:
+    with TemporaryDirectory() as tmp_dir:
+        roots = [Path(tmp_dir) / name for name in ("a", "b", "c")]
+        (roots[0] / "dir").mkdir(parents=True)
+        (roots[0] / "dir/one.txt").write_text("one")
+        (roots[0] / "dir/dangling").symlink_to("missing")
+        roots[1].mkdir()
+        (roots[1] / "dir").write_text("shadowed file")
+        (roots[2] / "dir").mkdir(parents=True)
+        (roots[2] / "dir/three.txt").write_text("three")
+        tree = Tree(roots, Path(tmp_dir) / "output", False)
+        assert tree.list_directory(Path("dir")) == {"one.txt": ObjectKind.FILE}
+        assert tree.object_roots(Path("dir")) == (roots[0],)
+        assert tree.object_roots(Path("missing")) == (roots[0],)
+        assert tree.input_path(Path("dir/three.txt")) == roots[0] / "dir/three.txt"
+        with pytest.raises(ValueError, match="no input given"):
+            Tree([], Path(tmp_dir) / "output", False)
+
+
+def test_input_overlay_from_the_command_line() -> None:
+    with TemporaryDirectory() as tmp_dir:
+        root = Path(tmp_dir)
+        site, theme = make_overlay_inputs(root)
+        main([f"{site}{os.pathsep}{theme}", str(root / "output")])
+        assert (root / "output/sub/page.txt").read_text() == "theme base site part"
+
+
+def make_expand_tree(root: Path) -> Path:
+    input = root / "input"
+    (input / "sub").mkdir(parents=True)
+    (input / "base.in.txt").write_text("base $path\n")
+    (input / "sub/page.nancy.txt").write_text("$include(base.in.txt)!")
+    (input / ".hidden").mkdir()
+    (input / ".hidden/bad.nancy.txt").write_text("$include(missing.txt)")
+    return input
+
+
+async def test_expand_in_memory() -> None:
+    with TemporaryDirectory() as tmp_dir:
+        input = make_expand_tree(Path(tmp_dir))
+        output = Path(tmp_dir) / "output"
+        profiler = Profiler()
+        tree = Tree(input, output, False, profiler=profiler)
+        await tree.preload()
+        assert input / "sub/page.nancy.txt" in tree.templates
+        assert tree.index[Path("sub")] == {"page.nancy.txt": ObjectKind.FILE}
+        assert Path(".hidden") not in tree.index
+
+        assert await tree.expand_path(Path("sub/page.nancy.txt")) == ExpandResult(
+            Path("sub/page.nancy.txt"),
+            Path("sub/page.txt"),
+            b"base sub/base.in.txt!",
+            {input / "base.in.txt", input / "sub/page.nancy.txt"},
+        )
+        assert await tree.expand_bytes(
+            Path("sub/new.nancy.txt"), b"$include(base.in.txt) $outputpath"
+        ) == ExpandResult(
+            Path("sub/new.nancy.txt"),
+            Path("sub/new.txt"),
+            b"base sub/base.in.txt sub/new.txt",
+            {input / "base.in.txt"},
+        )
+        with pytest.raises(ValueError, match="'missing' matches no path"):
+            await tree.expand_path(Path("missing"))
+        with pytest.raises(ValueError, match="'sub' is not a file"):
+            await tree.expand_path(Path("sub"))
+        # Other files are not expanded, as by `process`.
+        with pytest.raises(ValueError, match="'base.in.txt' is an input file"):
+            await tree.expand_path(Path("base.in.txt"))
+        (input / "plain.txt").write_text("$path")
+        (input / "sub/kept.copy.txt").write_text("$path")
+        tree = Tree(input, output, False, profiler=profiler)
+        assert await tree.expand_path(Path("plain.txt")) == ExpandResult(
+            Path("plain.txt"), Path("plain.txt"), b"$path", {input / "plain.txt"}
+        )
+        assert await tree.expand_path(Path("sub/kept.copy.txt")) == ExpandResult(
+            Path("sub/kept.copy.txt"),
+            Path("sub/kept.txt"),
+            b"$path",
+            {input / "sub/kept.copy.txt"},
+        )
+        assert not output.exists()
+        records = {record.path: record for record in profiler.records}
+        assert records["sub/new.nancy.txt"].output == "sub/new.txt"
+        assert records["sub/new.nancy.txt"].bytes_out == len(
+            "base sub/base.in.txt sub/new.txt"
+        )
+
+
+async def test_expand_batch() -> None:
+    with TemporaryDirectory() as tmp_dir:
+        input = make_expand_tree(Path(tmp_dir))
+        tree = Tree(input, Path(tmp_dir) / "output", False)
+        requests: list[tuple[Path, bytes | None]] = [
+            (Path(f"page{i}.nancy.txt"), f"{i} $path".encode()) for i in range(20)
+        ]
+        requests.append((Path("sub/page.nancy.txt"), None))
+        results = await tree.expand_batch(requests, 4)
+        assert [result.output for result in results] == [
+            f"{i} page{i}.nancy.txt".encode() for i in range(20)
+        ] + [b"base sub/base.in.txt!"]
+        with pytest.raises(ValueError, match="cannot find 'missing.txt'"):
+            await tree.expand_batch([(Path("x.nancy.txt"), b"$paste(missing.txt)")], 2)
+
+
+def make_storage_tree(root: Path) -> Path:
+    input = root / "input"
+    (input / "sub").mkdir(parents=True)
+    (input / "part.in.txt").write_text("part")
+    (input / "tool.in.sh").write_text("#!/bin/sh\nprintf 'tool %s' \"$1\"\n")
+    (input / "tool.in.sh").chmod(0o755)
+    (input / "page.nancy.txt").write_text("$include(part.in.txt) $run(tool.in.sh,1)\n")
+    (input / "sub/page.nancy.txt").write_text(
+        "$include(part.in.txt) $run(tool.in.sh,2) $path\n"
+    )
+    (input / "sub/plain.txt").write_text("plain\n")
+    (input / "sub/script.nancy.sh").write_text("#!/bin/sh\necho $path\n")
+    (input / "sub/script.nancy.sh").chmod(0o755)
+    return input
+
+
+def output_files(output: Path) -> dict[str, tuple[bytes, bool]]:
+    """Return the contents and executability of each file in an output."""
+    files = {}
+    if zipfile.is_zipfile(output):
+        with zipfile.ZipFile(output) as zip:
+            for info in zip.infolist():
+                if not info.is_dir():
+                    mode = info.external_attr >> 16
+                    files[info.filename] = (
+                        zip.read(info),
+                        mode & stat.S_IXUSR != 0,
+                    )
+    elif output.is_file():
+        with tarfile.open(output) as tar:
+            for member in tar.getmembers():
+                fh = tar.extractfile(member)
+                if member.isfile() and fh is not None:
+                    files[member.name] = (fh.read(), member.mode & stat.S_IXUSR != 0)
+    else:
+        for obj in output.rglob("*"):
+            if obj.is_file():
+                files[obj.relative_to(output).as_posix()] = (
+                    obj.read_bytes(),
+                    os.access(obj, os.X_OK),
+                )
+    return files
+
+
+async def test_archive_inputs() -> None:
+    with TemporaryDirectory() as tmp_dir:
+        root = Path(tmp_dir)
+        input = make_storage_tree(root)
+        await Tree(input, root / "expected", False).process(1)
+        expected = output_files(root / "expected")
+        assert expected["sub/page.txt"] == (b"part tool 2 sub/page.nancy.txt\n", False)
+        assert expected["sub/script.sh"][1]
+
+        # A zip archive, with a symbolic link.
+        with zipfile.ZipFile(root / "site.zip", "w") as zip:
+            for obj in sorted(input.rglob("*")):
+                zip.write(obj, obj.relative_to(input))
+            info = zipfile.ZipInfo("alias.txt")
+            info.external_attr = (stat.S_IFLNK | 0o777) << 16
+            zip.writestr(info, "sub/plain.txt")
+        await Tree(root / "site.zip", root / "zip-output", False).process(1)
+        assert output_files(root / "zip-output") == expected | {
+            "alias.txt": (b"plain\n", False)
+        }
+
+        # A tar archive, with symbolic and hard links.
+        (input / "link.txt").symlink_to("sub/plain.txt")
+        (input / "sub-link").symlink_to("sub")
+        os.link(input / "sub/plain.txt", input / "hard.txt")
+        (input / "dangling").symlink_to("missing")
+        await Tree(input, root / "links-expected", False).process(1)
+        expected = output_files(root / "links-expected")
+        assert "sub-link/page.txt" in expected
+        with tarfile.open(root / "site.tar", "w") as tar:
+            for obj in sorted(input.iterdir()):
+                tar.add(obj, obj.name)
+            for name, target in (
+                ("outside", "../x"),
+                ("absolute", "/etc"),
+                ("loop", "loop"),
+            ):
+                info = tarfile.TarInfo(name)
+                info.type = tarfile.SYMTYPE
+                info.linkname = target
+                tar.addfile(info)
+        await Tree(root / "site.tar", root / "tar-output", False).process(1)
+        assert output_files(root / "tar-output") == expected
+
+        # A store is pickled to send it to worker processes.
+        await Tree(
+            root / "site.tar", root / "processes-output", False, processes=2
+        ).process(2)
+        assert output_files(root / "processes-output") == expected
+
+
+async def test_archive_store_objects() -> None:
+    with TemporaryDirectory() as tmp_dir:
+        root = Path(tmp_dir)
+        with tarfile.open(root / "site.tar", "w") as tar:
+            info = tarfile.TarInfo(".")
+            info.type = tarfile.DIRTYPE
+            tar.addfile(info)
+            info = tarfile.TarInfo("pipe")
+            info.type = tarfile.FIFOTYPE
+            tar.addfile(info)
+            info = tarfile.TarInfo("dir/file")
+            info.size = 4
+            tar.addfile(info, io.BytesIO(b"data"))
+        store = open_store(root / "site.tar")
+        assert isinstance(store, TarStore)
+        assert store.scandir(store.root) == {
+            "pipe": ObjectKind.OTHER,
+            "dir": ObjectKind.DIRECTORY,
+        }
+        assert store.digest(store.root / "dir/file") == store.digest(
+            store.root / "dir/../dir/file"
+        )
+        with pytest.raises(NotADirectoryError):
+            store.scandir(store.root / "dir/file")
+        with pytest.raises(IsADirectoryError):
+            store.read_bytes(store.root / "dir")
+        with pytest.raises(FileNotFoundError):
+            store.stat(store.root / "missing")
+        with pytest.raises(FileNotFoundError):
+            store.stat(root)
+        copy = pickle.loads(pickle.dumps(store))
+        assert copy.read_bytes(copy.root / "dir/file") == b"data"
+
+        with zipfile.ZipFile(root / "site.zip", "w") as zip:
+            zip.writestr("dir/", b"")
+            zip.writestr("dir/file", b"data")
+        store = open_store(root / "site.zip")
+        assert isinstance(store, ZipStore)
+        assert store.scandir(store.root / "dir") == {"file": ObjectKind.FILE}
+        copy = pickle.loads(pickle.dumps(store))
+        assert copy.read_bytes(copy.root / "dir/file") == b"data"
+
+        (root / "file.txt").write_text("text")
+        with pytest.raises(ValueError, match="is not a directory"):
+            open_store(root / "file.txt")
+        with pytest.raises(ValueError, match="does not exist"):
+            open_store(root / "missing")
+        with pytest.raises(ValueError, match="does not exist"):
+            open_store(root / "missing#HEAD")
+
+
+async def test_git_input() -> None:
+    with TemporaryDirectory() as tmp_dir:
+        root = Path(tmp_dir)
+        input = make_storage_tree(root)
+        (input / "link.txt").symlink_to("sub/plain.txt")
+        await Tree(input, root / "expected", False).process(1)
+
+        def git(*args: str) -> None:
+            subprocess.run(
+                ["git", "-C", input, "-c", "user.name=A", "-c", "user.email=a@b"]
+                + list(args),
+                check=True,
+                capture_output=True,
+            )
+
+        git("init")
+        git("add", ".")
+        git("commit", "-m", "Test")
+        (input / "sub/plain.txt").write_text("changed\n")
+        await Tree(Path(f"{input}#HEAD"), root / "output", False).process(1)
+        assert output_files(root / "output") == output_files(root / "expected")
+        with pytest.raises(ValueError, match="cannot read 'nonexistent'"):
+            Tree(Path(f"{input}#nonexistent"), root / "output", False)
+
+
+async def test_archive_outputs() -> None:
+    with TemporaryDirectory() as tmp_dir:
+        root = Path(tmp_dir)
+        input = make_storage_tree(root)
+        await Tree(input, root / "expected", False).process(1)
+        expected = output_files(root / "expected")
+        for name in ("site.zip", "site.tar", "site.tar.gz"):
+            await Tree(input, root / name, False).process(1)
+            assert output_files(root / name) == expected
+        with zipfile.ZipFile(root / "site.zip") as zip:
+            assert "sub/" in zip.namelist()
+        with tarfile.open(root / "site.tar.gz") as tar:
+            assert tar.getmember("sub").isdir()
+
+        # Existing directories are used as directories, whatever their names.
+        (root / "dir.zip").mkdir()
+        await Tree(input, root / "dir.zip", False).process(1)
+        assert output_files(root / "dir.zip") == expected
+        await Tree(root / "dir.zip", root / "dir.tar", False).process(1)
+        assert (root / "dir.tar").is_file()
+        shutil.copytree(input, root / "input.tar")
+        (root / "dir.tar").unlink()
+        (root / "dir.tar").mkdir()
+        await Tree(root / "input.tar", root / "dir.tar", False).process(1)
+        assert output_files(root / "dir.tar") == expected
+
+        # A single file is written as a file.
+        await Tree(input, root / "page.zip", False, Path("page.nancy.txt")).process(1)
+        assert (root / "page.zip").read_text() == "part tool 1\n"
+
+        with pytest.raises(ValueError, match="only an output directory can be updated"):
+            Tree(input, root / "site.zip", False, update_newer=True)
+        with pytest.raises(ValueError, match="multiple processes or threads"):
+            Tree(input, root / "site.tar", False, threads=2)
+        with pytest.raises(ValueError, match="only an output directory can be updated"):
+            await Tree(input, MemoryOutput(), False).watch(1)
+        with pytest.raises(ValueError, match="only input directories can be watched"):
+            await Tree(MemoryStore(), root / "output", False).watch(1)
+
+
+async def test_memory_store() -> None:
+    store = MemoryStore(
+        {
+            "page.nancy.txt": b"$include(part.in.txt)$run(true)",
+            "part.in.txt": b"one",
+            "data.bin": b"\0data",
+        }
+    )
+    caches = Caches()
+    output = MemoryOutput()
+    await Tree(store, output, False, caches=caches).process(1)
+    assert output.files == {Path("page.txt"): b"one", Path("data.bin"): b"\0data"}
+
+    # Changes are seen by a `Tree` with the same caches.
+    store.write("part.in.txt", b"two")
+    store.write("sub/dir/script.nancy.sh", b"$path", 0o755)
+    output = MemoryOutput()
+    await Tree(store, output, False, caches=caches).process(1)
+    assert output.files == {
+        Path("page.txt"): b"two",
+        Path("data.bin"): b"\0data",
+        Path("sub/dir/script.sh"): b"sub/dir/script.nancy.sh",
+    }
+    assert output.modes[Path("sub/dir/script.sh")] & stat.S_IXUSR
+    assert output.dirs == {Path(), Path("sub"), Path("sub/dir")}
+    tree = Tree(store, MemoryOutput(), False, caches=caches)
+    assert (await tree.expand_path(Path("page.nancy.txt"))).output == b"two"
+
+    # A file that cannot be expanded is not written.
+    store.write("bad.nancy.txt", b"$include(missing)")
+    output = MemoryOutput()
+    with pytest.raises(ValueError, match="cannot find 'missing'"):
+        await Tree(store, output, False, caches=caches).process(1)
+    assert Path("bad.txt") not in output.files
+
+    # Neither is a file that cannot be written.
+    output = MemoryOutput()
+    with mock.patch.object(OutputFile, "write", side_effect=OSError("full")):
+        with pytest.raises(OSError, match="full"):
+            await Tree(MemoryStore({"data.bin": b"data"}), output, False).process(1)
+    assert output.files == {}
+
+    with pytest.raises(ValueError, match="a single file can only be output to a file"):
+        Tree(store, output, False, Path("data.bin"))
+
+
+def test_local_output_removes_a_file_that_cannot_be_closed() -> None:
+    with TemporaryDirectory() as tmp_dir:
+        output = LocalOutput(Path(tmp_dir))
+        path = Path(tmp_dir) / "file"
+        fh = output.open(path, 0)
+        with mock.patch.object(fh, "close", side_effect=OSError("full")):
+            with pytest.raises(OSError, match="full"):
+                output.commit(path, fh)
+        fh.close()
+        assert not path.exists()
+
+
+async def test_update_by_hash_with_an_archive_input() -> None:
+    with TemporaryDirectory() as tmp_dir:
+        root = Path(tmp_dir)
+        input = make_storage_tree(root)
+        with zipfile.ZipFile(root / "site.zip", "w") as zip:
+            for obj in sorted(input.rglob("*")):
+                zip.write(obj, obj.relative_to(input))
+        for _ in range(2):
+            await Tree(
+                root / "site.zip",
+                root / "output",
+                False,
+                update_newer=True,
+                hash_dependencies=True,
+            ).process(1)
+        database = Database(root / "output" / DATABASE_NAME)
+        entry = database.entries[Path("page.nancy.txt")]
+        assert all(d.digest is not None for d in entry.dependencies)
+
+
+async def test_include_resolutions_are_cached(chtestdir) -> None:
+    with TemporaryDirectory() as tmp_dir:
+        tree = Tree(Path("cookbook-example-website-src"), Path(tmp_dir), False)
+        await tree.process(1)
+        assert file_objects_equal(tmp_dir, "cookbook-example-website-expected")
+        assert tree.resolutions[
+            (Path("People/Jo Bloggs"), Path("breadcrumb.in.html"))
+        ] == Path("People/Jo Bloggs/breadcrumb.in.html")
+        assert tree.resolutions[
+            (Path("Places/Timbuktu"), Path("template.in.html"))
+        ] == Path("template.in.html")
+
+
+async def test_copying_a_cached_file(chtestdir) -> None:
+    with TemporaryDirectory() as tmp_dir:
+        tree = Tree(Path("copy-src"), Path(tmp_dir), False)
+        tree.contents.read(Path("copy-src") / "test.copy.in")
+        await tree.process(1)
+        assert file_objects_equal(tmp_dir, "copy-expected")
+
+
+async def test_link_methods(chtestdir, log_channels) -> None:
+    with TemporaryDirectory() as tmp_dir:
+        input = Path(tmp_dir) / "input"
+        shutil.copytree("copy-src", input)
+        output = Path(tmp_dir) / "output"
+        for method in LinkMethod:
+            await Tree(input, output, False, link=method).process(1)
+            assert file_objects_equal(output, "copy-expected")
+            linked = os.path.samefile(input / "test.copy.in", output / "test.in")
+            assert linked == (method == LinkMethod.HARDLINK)
+
+        # Writing an output file never changes an input file.
+        (input / "page.txt").write_bytes(b"$path")
+        await Tree(input, output, False, link=LinkMethod.HARDLINK).process(1)
+        (input / "page.txt").rename(input / "page.nancy.txt")
+        await Tree(input, output, False).process(1)
+        assert (output / "page.txt").read_bytes() == b"page.nancy.txt"
+        assert (input / "page.nancy.txt").read_bytes() == b"$path"
+
+
+async def test_link_falls_back_to_copying(chtestdir, log_channels) -> None:
+    with TemporaryDirectory() as tmp_dir:
+        output = Path(tmp_dir)
+        with mock.patch("os.link", side_effect=OSError(errno.EXDEV, "")):
+            await Tree(
+                Path("copy-src"), output, False, link=LinkMethod.HARDLINK
+            ).process(1)
+        assert file_objects_equal(output, "copy-expected")
+        with (
+            mock.patch("os.link", side_effect=OSError(errno.EIO, "")),
+            pytest.raises(OSError),
+        ):
+            await Tree(
+                Path("copy-src"), output, False, link=LinkMethod.HARDLINK
+            ).process(1)
+
+
+async def test_file_io_runs_operations_in_threads() -> None:
+    io = FileIO(0)
+    assert await io.call(threading.current_thread) is threading.current_thread()
+    io = FileIO(2)
+    thread = await io.call(threading.current_thread)
+    assert thread.name.startswith("nancy-io")
+    assert await io.call(int, "10", base=16) == 16
+
+
+async def test_batched_writer_writes_in_batches() -> None:
+    fh = io.BytesIO()
+    writer = BatchedWriter(FileIO(1), fh)
+    with mock.patch("nancy.fileio.WRITE_BATCH_SIZE", 4):
+        await writer.write(b"ab")
+        assert fh.getvalue() == b""
+        await writer.write(memoryview(b"cde"))
+        await writer.write(b"f")
+        await writer.wait()
+        assert fh.getvalue() == b"abcde"
+        await writer.flush()
+    assert fh.getvalue() == b"abcdef"
+
+
+def test_log_channels(caplog: LogCaptureFixture) -> None:
+    try:
+        log.configure("resolve, run")
+        assert log.resolve.enabled and log.run.enabled
+        assert not log.expand.enabled
+        with caplog.at_level(logging.DEBUG):
+            log.expand("not logged")
+            log.run("logged")
+        assert caplog.messages == ["logged"]
+        log.configure("1")
+        assert all(channel.enabled for channel in log.CHANNELS.values())
+    finally:
+        for channel in log.CHANNELS.values():
+            channel.enabled = False
+
+
+async def test_log_during_build(caplog: LogCaptureFixture) -> None:
+    with TemporaryDirectory() as tmp_dir:
+        input = Path(tmp_dir) / "input"
+        output = Path(tmp_dir) / "output"
+        input.mkdir()
+        (input / "part.in.txt").write_text("part")
+        (input / "data.in.txt").write_text("data")
+        (input / "page.nancy.txt").write_text(
+            "$include(part.in.txt) $paste(data.in.txt) $expand{$path} "
+            "$run(echo,run){input}"
+        )
+        caches = Caches()
+        try:
+            log.configure("1")
+            with caplog.at_level(logging.DEBUG):
+                # Build, then check the recorded dependencies, then check the
+                # inputs of a single file, which has no database.
+                for build in (None, None, Path("page.nancy.txt")):
+                    await Tree(
+                        input,
+                        output,
+                        False,
+                        build,
+                        update_newer=True,
+                        hash_dependencies=True,
+                        caches=caches,
+                    ).process(1)
+                assert Tree(input, output, False).object_exists(Path("part.in.txt"))
+        finally:
+            for channel in log.CHANNELS.values():
+                channel.enabled = False
+        assert (output / "page.txt").read_text() == "part data page.nancy.txt run\n"
+        loggers = {record.name for record in caplog.records}
+        assert loggers == {f"nancy.{name}" for name in log.CHANNELS}
+        assert "Not updating" in caplog.messages
+        assert "b'$paste(data.in.txt)'" in caplog.messages
+
+
+def test_log_abbrev() -> None:
+    assert log.abbrev(b"abc") == "b'abc'"
+    assert log.abbrev(Path("abc")) == "abc"
+    long = log.abbrev(b"x" * 1000)
+    assert long.startswith("b'xxx")
+    assert long.endswith("... (1003 characters)")
+    assert len(long) < 300
+
+
+def test_benchmark(capsys: CaptureFixture[str]) -> None:
+    with TemporaryDirectory() as tmp_dir:
+        root = Path(tmp_dir)
+        config = SiteConfig(
+            "test",
+            pages=5,
+            fanout=2,
+            runs=1,
+            paste_size=10,
+            binary_files=3,
+            binary_size=10,
+        )
+        files = generate_site(root / "input", config)
+        assert files == 8
+        result = measure(root / "input", root / "output", files, 2, "tasks")
+        assert result["files"] == 8
+        assert result["files_per_second"] > 0
+        page = (root / "output/dir0/dir0/page0.html").read_text()
+        assert page.startswith("<h1>Page 0</h1>\n<div>Part 0 of")
+        assert page.endswith("page 0 run 0\n\nxxxxxxxxxx\n")
+
+        results = root / "results.json"
+        benchmark_main(["--scale=0.01", f"--output={results}", "runs", "binary"])
+        report = json.loads(results.read_text())
+        assert [r["config"]["name"] for r in report["results"]] == ["runs", "binary"]
+        assert report["results"][1]["files"] == 21
+        capsys.readouterr()
+        benchmark_main(["--scale=0.01", f"--compare={results}", "runs"])
+        assert "runs: " in capsys.readouterr().out
+        with pytest.raises(SystemExit):
+            benchmark_main(["no-such-config"])
+
+
+def test_link_file_reflinks() -> None:
+    with TemporaryDirectory() as tmp_dir:
+        src = Path(tmp_dir) / "src"
+        src.write_bytes(b"data")
+        dst = Path(tmp_dir) / "dst"
+        with mock.patch("fcntl.ioctl") as ioctl:
+            link_file(src, dst, LinkMethod.REFLINK)
+        assert ioctl.call_args.args[1] == FICLONE
+        with (
+            mock.patch("fcntl.ioctl", side_effect=OSError(errno.EIO, "")),
+            pytest.raises(OSError),
+        ):
+            link_file(src, dst, LinkMethod.REFLINK)
+        # Without reflinks or `os.copy_file_range`, files are still copied.
+        with (
+            mock.patch("fcntl.ioctl", side_effect=OSError(errno.EOPNOTSUPP, "")),
+            mock.patch("os.copy_file_range", side_effect=OSError(errno.EXDEV, "")),
+        ):
+            link_file(src, dst, LinkMethod.REFLINK)
+        assert dst.read_bytes() == b"data"
+
+
+def test_copy_range() -> None:
+    with TemporaryDirectory() as tmp_dir:
+        src = Path(tmp_dir) / "src"
+        dst = Path(tmp_dir) / "dst"
+        src.write_bytes(b"")
+        with open(src, "rb") as in_fh, open(dst, "wb") as out_fh:
+            assert copy_range(in_fh, out_fh)
+        src.write_bytes(b"data")
+        with open(src, "rb") as in_fh, open(dst, "wb") as out_fh:
+            # Some filesystems copy nothing rather than giving an error.
+            with mock.patch("os.copy_file_range", return_value=0):
+                assert not copy_range(in_fh, out_fh)
+            # Errors after copying has started are not hidden.
+            with (
+                mock.patch(
+                    "os.copy_file_range", side_effect=[2, OSError(errno.EXDEV, "")]
+                ),
+                pytest.raises(OSError),
+            ):
+                copy_range(in_fh, out_fh)
+
+
 # CLI tests
 def test_help_option_should_produce_output(capsys: CaptureFixture[str]) -> None:
     with pytest.raises(SystemExit) as e:
@@ -497,6 +2508,75 @@ async def test_copy_to_stdout_of_a_single_file_works(
     )
 
 
+def test_update_from_the_command_line(chtestdir) -> None:
+    with TemporaryDirectory() as tmp_dir:
+        main(["--update", "webpage-src", tmp_dir])
+        assert file_objects_equal(tmp_dir, "webpage-expected")
+        orig_mtimes = tree_mtimes(Path(tmp_dir))
+        main(["--update", "webpage-src", tmp_dir])
+        new_mtimes = tree_mtimes(Path(tmp_dir))
+        del orig_mtimes[Path(tmp_dir) / DATABASE_NAME]
+        del new_mtimes[Path(tmp_dir) / DATABASE_NAME]
+        assert orig_mtimes == new_mtimes
+
+
+def test_update_of_up_to_date_plain_files(chtestdir) -> None:
+    with TemporaryDirectory() as tmp_dir:
+        output = Path(tmp_dir) / "output.txt"
+        for _ in range(2):
+            main(["--update", "random-text.txt", str(output)])
+            assert output.read_bytes() == Path("random-text.txt").read_bytes()
+        output = Path(tmp_dir) / "output"
+        # Without a build database, plain and `.copy` files are checked by
+        # modification time.
+        for _ in range(2):
+            main(["--update", "copy-src", str(output)])
+            (output / DATABASE_NAME).unlink()
+        assert file_objects_equal(output, "copy-expected")
+
+
+def test_update_by_hash_from_the_command_line(chtestdir) -> None:
+    with TemporaryDirectory() as tmp_dir:
+        main(["--update", "--update-method=hash", "webpage-src", tmp_dir])
+        assert file_objects_equal(tmp_dir, "webpage-expected")
+        database = Database(Path(tmp_dir) / DATABASE_NAME)
+        entry = database.entries[Path("index.nancy.html")]
+        assert all(d.digest is not None for d in entry.dependencies)
+
+
+def test_run_cache_from_the_command_line() -> None:
+    with TemporaryDirectory() as tmp_dir:
+        root = Path(tmp_dir)
+        input, count = make_counting_tree(root)
+        for _ in range(2):
+            main(
+                [
+                    "--max-procs=1",
+                    "--run-timeout=10",
+                    "--run-cache",
+                    str(root / "cache"),
+                    "--impure",
+                    "date",
+                    str(input),
+                    str(root / "output"),
+                ]
+            )
+        assert count.read_text() == "x\nx\n"
+
+
+async def test_update_method_without_update_causes_an_error(
+    capsys: CaptureFixture[str],
+    caplog: LogCaptureFixture,
+    chtestdir,
+) -> None:
+    await failing_cli_test(
+        capsys,
+        caplog,
+        ["--update-method=hash", "webpage-src"],
+        "--update-method requires --update",
+    )
+
+
 async def test_missing_command_line_argument_causes_an_error(
     capsys: CaptureFixture[str],
     caplog: LogCaptureFixture,
@@ -542,6 +2622,16 @@ async def test_running_on_a_nonexistent_path_causes_an_error_DEBUG_coverage(
         await failing_cli_test(capsys, caplog, ["a"], "input 'a' does not exist")
 
 
+async def test_something_not_a_file_or_directory_in_a_tree_causes_an_error() -> None:
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as server:
+        with TemporaryDirectory() as temp_dir:
+            (Path(temp_dir) / "input").mkdir()
+            server.bind(os.path.join(temp_dir, "input", "foo"))
+            tree = Tree(Path(temp_dir) / "input", Path(temp_dir) / "output", False)
+            with pytest.raises(ValueError, match="is not a file or directory"):
+                await tree.process(1)
+
+
 async def test_running_on_something_not_a_file_or_directory_causes_an_error(
     capsys: CaptureFixture[str],
     caplog: LogCaptureFixture,
@@ -589,3 +2679,15 @@ async def test_empty_INPUT_PATH_causes_an_error(
     caplog: LogCaptureFixture,
 ) -> None:
     await failing_cli_test(capsys, caplog, [""], "input path must not be empty")
+
+
+def test_archives_from_the_command_line() -> None:
+    with TemporaryDirectory() as tmp_dir:
+        root = Path(tmp_dir)
+        input = make_storage_tree(root)
+        main([str(input), str(root / "expected")])
+        with tarfile.open(root / "site.tgz", "w:gz") as tar:
+            for obj in sorted(input.iterdir()):
+                tar.add(obj, obj.name)
+        main([str(root / "site.tgz"), str(root / "site.zip")])
+        assert output_files(root / "site.zip") == output_files(root / "expected")
@@ -21,7 +21,7 @@ from tempfile import TemporaryDirectory
 import pytest
 from pytest import CaptureFixture, LogCaptureFixture
 
-from nancy import Tree
+from nancy import DATABASE_NAME, Tree
 from nancy import real_main as main
 
 
@@ -42,7 +42,9 @@ def file_objects_equal(a: os.PathLike[str] | str, b: os.PathLike[str] | str) ->
     # See https://stackoverflow.com/questions/4187564
     stdout = io.StringIO()
     with contextlib.redirect_stdout(stdout):
-        filecmp.dircmp(a, b).report_full_closure()
+        filecmp.dircmp(
+            a, b, ignore=filecmp.DEFAULT_IGNORES + [DATABASE_NAME]
+        ).report_full_closure()
     match = re.search("Differing files|Only in", stdout.getvalue())
     if match is None:
         return True